@@ -7,14 +7,54 @@ Created on Tue Apr  9 10:25:48 2024
 """
 
 
+import os
 import logging
 
 import curate_data
 import util
 import load_data
 import response_comp
-
-import pdb
+import session_manifest
+import session_meta_index
+import instrumentation
+import gaze_heatmap_cube
+from artifact_cache import ArtifactCache
+
+
+# Params and session files that the ROI corners and session meta info,
+# used to label gaze, fixations and saccades, are derived from
+META_PARAMS = session_meta_index.ROI_PARAM_KEYS
+META_SOURCE_KINDS = session_meta_index.META_SOURCE_KINDS
+
+# Params of the fixation job, which detects fixations and saccades together
+DETECTION_PARAMS = ['fixation_detection_method', 'vel_thresh', 'min_samples',
+                    'smooth_func', 'compute_saccade_metrics']
+
+# Upstream stages, params and session source files that each stage result
+# depends on; used to key the stage artifacts in the artifact cache
+STAGE_DEPENDENCIES = {
+    'labelled_gaze_positions_m1': (
+        [],
+        META_PARAMS + ['map_gaze_pos_coord_to_eyelink_space'],
+        META_SOURCE_KINDS + ['M1_gaze']),
+    'labelled_fixations': (
+        ['labelled_gaze_positions_m1'],
+        DETECTION_PARAMS + META_PARAMS + ['fixation_agent_key'],
+        META_SOURCE_KINDS),
+    'labelled_saccades_m1': (
+        ['labelled_gaze_positions_m1'],
+        DETECTION_PARAMS + META_PARAMS,
+        META_SOURCE_KINDS),
+    'labelled_spiketimes': (
+        [],
+        [],
+        ['spikeTs']),
+    'labelled_fixation_rasters': (
+        ['labelled_fixations', 'labelled_saccades_m1', 'labelled_spiketimes'],
+        ['raster_bin_size', 'raster_pre_event_time', 'raster_post_event_time',
+         'raster_event_types', 'use_spike_matrix', 'spike_matrix_bin_size'],
+        ['runs'])
+}
 
 class DataManager:
     def __init__(self, params):
@@ -37,7 +77,39 @@ class DataManager:
         self.labelled_spiketimes = None
         self.labelled_fixation_rasters = None
 
+    def setup_artifact_cache(self):
+        cache_dir = self.params.get('artifact_cache_dir') or os.path.join(
+            self.params['processed_data_dir'], 'artifact_cache')
+        self.artifact_cache = ArtifactCache(
+            cache_dir,
+            max_size_gb=self.params.get('artifact_cache_max_size_gb'),
+            max_age_days=self.params.get('artifact_cache_max_age_days'))
+        self.artifact_keys = {}
+
+    def get_artifact_key(self, variable_name):
+        """
+        Computes the cache key of a stage from the keys of its upstream
+        stages, the params it depends on and the mtimes of the session files
+        it reads.
+        Parameters:
+        - variable_name (str): Name of the stage variable.
+        Returns:
+        - key (str): Cache key of the stage artifact.
+        """
+        if variable_name not in self.artifact_keys:
+            upstream, param_names, source_kinds = STAGE_DEPENDENCIES[variable_name]
+            upstream_keys = [self.get_artifact_key(name) for name in upstream]
+            stage_params = {name: self.params.get(name) for name in param_names}
+            if source_kinds:
+                stage_params['source_files'] = session_manifest.get_source_signature(
+                    self.params['session_paths'], source_kinds)
+            self.artifact_keys[variable_name] = ArtifactCache.compute_key(
+                variable_name, upstream_keys, stage_params)
+        return self.artifact_keys[variable_name]
+
     def get_or_load_variable(self, variable_name, load_function, compute_function):
+        if self.params.get('use_artifact_cache', True):
+            return self.get_or_compute_cached_variable(variable_name, compute_function)
         flag_name = f'remake_{variable_name}'
         if self.params.get(flag_name, False) or getattr(self, variable_name) is None:
             if self.params.get(flag_name, False):
@@ -48,11 +120,37 @@ class DataManager:
                 setattr(self, variable_name, load_function(self.params))
         return getattr(self, variable_name)
 
+    def get_or_compute_cached_variable(self, variable_name, compute_function):
+        """
+        Loads a stage result from the artifact cache if its inputs and params
+        are unchanged, and recomputes and stores it otherwise. A set
+        remake_* flag bypasses the cache lookup and overwrites the entry.
+        """
+        key = self.get_artifact_key(variable_name)
+        if getattr(self, variable_name) is not None:
+            return getattr(self, variable_name)
+        if self.params.get(f'remake_{variable_name}', False) \
+                or not self.artifact_cache.contains(key):
+            self.logger.info(f"Computing variable: {variable_name} ({key[:12]})")
+            value = compute_function(self.params)
+            self.artifact_cache.store(key, value, stage=variable_name)
+        else:
+            self.logger.info(f"Loading cached variable: {variable_name} ({key[:12]})")
+            value = self.artifact_cache.load(key)
+        setattr(self, variable_name, value)
+        return value
+
     def run(self):
         root_data_dir, self.params = util.fetch_root_data_dir(self.params)
         data_source_dir, self.params = util.fetch_data_source_dir(self.params)
         session_paths, self.params = util.fetch_session_subfolder_paths_from_source(self.params)
         processed_data_dir, self.params = util.fetch_processed_data_dir(self.params)
+        instrumentation.configure_run_log(self.params)
+        session_manifest.load_or_build_session_manifest(self.params)
+        self.params = curate_data.extract_and_update_meta_info(self.params)
+        self.params = curate_data.get_unique_doses(self.params)
+        if self.params.get('use_artifact_cache', True):
+            self.setup_artifact_cache()
 
         self.labelled_gaze_positions_m1 = self.get_or_load_variable(
             'labelled_gaze_positions_m1',
@@ -66,6 +164,9 @@ class DataManager:
             lambda p: curate_data.extract_fixations_and_saccades_with_labels(self.labelled_gaze_positions_m1, p)
         )
         
+        if self.params.get('make_gaze_heatmap_cubes', True):
+            gaze_heatmap_cube.build_session_cubes(self.labelled_gaze_positions_m1, self.params)
+
         # self.labelled_saccades_m1 = self.get_or_load_variable(
         #     'labelled_saccades_m1',
         #     load_data.load_saccade_labels,
@@ -88,6 +189,9 @@ class DataManager:
         if self.params.get('replot_face/eye_vs_obj_violins'):
             response_comp.compute_pre_and_post_fixation_response_to_roi_for_each_unit(self.labelled_fixation_rasters, self.params)
 
+        if self.params.get('use_artifact_cache', True):
+            self.artifact_cache.evict(keep_keys=self.artifact_keys.values())
+
 def main():
     params = util.get_params()
     params.update({
@@ -95,10 +199,10 @@ def main():
         'use_parallel': True,
         'remake_labelled_gaze_positions_m1': False,
         'fixation_detection_method': 'cluster_fix',
-        'remake_labelled_fixations': True,
+        'remake_labelled_fixations': False,
         'remake_labelled_saccades_m1': False,
         'remake_labelled_spiketimes': False,
-        'remake_labelled_fixation_rasters': True,
+        'remake_labelled_fixation_rasters': False,
         'make_plots': False,
         'recalculate_unit_ROI_responses': True,
         'replot_face/eye_vs_obj_violins': True,
@@ -116,7 +220,10 @@ def main():
         'flush_before_reload': False,
         'use_existing_variables': False,
         'reload_existing_unit_roi_comp_stats': False,
-        'submit_separate_jobs_for_sessions': True
+        'submit_separate_jobs_for_sessions': True,
+        'use_artifact_cache': True,
+        'artifact_cache_max_size_gb': 200,
+        'artifact_cache_max_age_days': 30
     })
 
     data_manager = DataManager(params)
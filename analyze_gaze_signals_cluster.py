@@ -12,8 +12,6 @@ import pandas as pd
 import os
 import pickle
 
-import pdb
-
 import load_data
 import util
 import filter_behavior
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of pipeline stage results.
+"""
+
+import os
+import json
+import time
+import pickle
+import hashlib
+import logging
+
+import numpy as np
+
+
+def _to_hashable(value):
+    """
+    Converts a param value into something with a stable JSON representation.
+    Callables (e.g. the saccade smoothing function) are represented by their
+    qualified name since their repr contains a memory address.
+    """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if callable(value):
+        return f"{getattr(value, '__module__', '')}.{getattr(value, '__qualname__', repr(value))}"
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    return repr(value)
+
+
+def _update_hash(hasher, value):
+    if isinstance(value, np.ndarray):
+        hasher.update(str((value.dtype, value.shape)).encode())
+        hasher.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        for key in sorted(value, key=str):
+            hasher.update(repr(key).encode())
+            _update_hash(hasher, value[key])
+    elif isinstance(value, (list, tuple)):
+        hasher.update(f'{type(value).__name__}{len(value)}'.encode())
+        for item in value:
+            _update_hash(hasher, item)
+    elif callable(value):
+        hasher.update(f'{value.__module__}.{value.__qualname__}'.encode())
+    else:
+        hasher.update(pickle.dumps(value, protocol=4))
+
+
+def compute_input_hash(*values):
+    """
+    Hashes the inputs of a derived file, e.g. a figure or binned counts:
+    arrays by content, containers item by item and functions by qualified
+    name.
+    Returns:
+    - input_hash (str): Hex digest.
+    """
+    hasher = hashlib.sha1()
+    for value in values:
+        _update_hash(hasher, value)
+    return hasher.hexdigest()
+
+
+class ArtifactCache:
+    """
+    Content-addressed store for pipeline stage results. Each artifact is keyed
+    by a hash of its stage name, the params that affect it, and the keys of
+    its upstream artifacts, so a changed input or param produces a new key and
+    unchanged stages are found again.
+    """
+    def __init__(self, cache_dir, max_size_gb=None, max_age_days=None):
+        self.cache_dir = cache_dir
+        self.max_size_gb = max_size_gb
+        self.max_age_days = max_age_days
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def compute_key(stage, upstream_keys, stage_params):
+        """
+        Computes the cache key of an artifact.
+        Parameters:
+        - stage (str): Name of the stage producing the artifact.
+        - upstream_keys (list): Keys of the artifacts the stage consumes.
+        - stage_params (dict): Params, and source file signatures, that affect
+        the stage result.
+        Returns:
+        - key (str): Hex digest identifying the artifact.
+        """
+        payload = json.dumps(
+            {'stage': stage, 'upstream': list(upstream_keys),
+             'params': stage_params},
+            sort_keys=True, default=_to_hashable)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.pkl')
+
+    def contains(self, key):
+        return os.path.exists(self.get_path(key))
+
+    def load(self, key):
+        """
+        Loads an artifact and marks it as recently used.
+        Parameters:
+        - key (str): Key of the artifact.
+        Returns:
+        - value: The stored artifact.
+        """
+        file_path = self.get_path(key)
+        with open(file_path, 'rb') as f:
+            value = pickle.load(f)
+        os.utime(file_path, None)
+        return value
+
+    def store(self, key, value, stage=None):
+        """
+        Stores an artifact under its key.
+        Parameters:
+        - key (str): Key of the artifact.
+        - value: Artifact to pickle.
+        - stage (str): Stage name, recorded next to the artifact for inspection.
+        """
+        file_path = self.get_path(key)
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, file_path)
+        with open(os.path.join(self.cache_dir, f'{key}.json'), 'w') as f:
+            json.dump({'stage': stage, 'created': time.time()}, f)
+        logging.info(f"Stored artifact {stage} under key {key[:12]}")
+
+    def remove(self, key):
+        for ext in ('.pkl', '.json'):
+            file_path = os.path.join(self.cache_dir, key + ext)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def evict(self, keep_keys=()):
+        """
+        Removes artifacts older than max_age_days, then the least recently used
+        ones until the cache fits into max_size_gb.
+        Parameters:
+        - keep_keys (iterable): Keys that must not be evicted, e.g. the
+        artifacts of the current run.
+        Returns:
+        - evicted (list): Keys of the removed artifacts.
+        """
+        keep_keys = set(keep_keys)
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith('.pkl'):
+                continue
+            key = file_name[:-len('.pkl')]
+            stat = os.stat(os.path.join(self.cache_dir, file_name))
+            entries.append((stat.st_mtime, stat.st_size, key))
+        entries.sort()
+        evicted = []
+        now = time.time()
+        if self.max_age_days is not None:
+            max_age_s = self.max_age_days * 24 * 3600
+            for last_used, _, key in entries:
+                if key not in keep_keys and now - last_used > max_age_s:
+                    evicted.append(key)
+        remaining = [entry for entry in entries if entry[2] not in evicted]
+        if self.max_size_gb is not None:
+            total_size = sum(size for _, size, _ in remaining)
+            max_size = self.max_size_gb * 1024 ** 3
+            for _, size, key in remaining:
+                if total_size <= max_size:
+                    break
+                if key in keep_keys:
+                    continue
+                evicted.append(key)
+                total_size -= size
+        for key in evicted:
+            self.remove(key)
+        if evicted:
+            logging.info(f"Evicted {len(evicted)} artifacts from {self.cache_dir}")
+        return evicted
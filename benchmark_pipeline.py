@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Times the pipeline hot paths on synthetic sessions and compares
+the results with a stored baseline.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import platform
+import tempfile
+from datetime import datetime
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+
+import defaults
+import timebase
+import synthetic_data
+
+
+# Session durations in seconds the benchmarks are run at by default
+DEFAULT_DURATIONS_S = [60, 300, 1200]
+
+# Relative slowdown against the baseline that is reported as a regression
+DEFAULT_TOLERANCE = 0.2
+
+
+def setup_cluster_fix(session, work_dir):
+    from cluster_fix import ClusterFixationDetector
+    detector = ClusterFixationDetector(samprate=session['info']['sampling_rate'],
+                                       use_parallel=False)
+    eyedat = (session['positions'][:, 0], session['positions'][:, 1])
+    return lambda: detector.detect_fixations(eyedat)
+
+
+def setup_eye_mvm_fix(session, work_dir):
+    from eye_mvm_fix import EyeMVMFixationDetector
+    detector = EyeMVMFixationDetector(sampling_rate=session['info']['sampling_rate'])
+    clock = timebase.SampleClock(len(session['positions']), session['info']['sampling_rate'])
+    return lambda: detector.detect_fixations(
+        session['positions'], clock, session['info']['session_name'])
+
+
+def setup_eye_mvm_saccade(session, work_dir):
+    from eye_mvm_saccade import EyeMVMSaccadeDetector
+    saccade_params = defaults.fetch_default_saccade_pars()
+    detector = EyeMVMSaccadeDetector(saccade_params['vel_thresh'],
+                                     saccade_params['min_samples'],
+                                     saccade_params['smooth_func'])
+    clock = timebase.SampleClock(len(session['positions']), session['info']['sampling_rate'])
+    return lambda: detector.extract_saccades(
+        session['positions'], clock, session['info'])
+
+
+def get_raster_params():
+    return {'raster_bin_size': 0.001, 'raster_pre_event_time': 0.5,
+            'raster_post_event_time': 0.5}
+
+
+def setup_raster_process_unit(session, work_dir):
+    from raster import RasterManager
+    params = get_raster_params()
+    params['processed_data_dir'] = work_dir
+    raster_manager = RasterManager(params)
+    raster_manager.logger.setLevel(logging.WARNING)
+    fixations = session['labelled_fixations']
+    neurons = session['labelled_spiketimes']
+    uuid = neurons['uuid'].iloc[1]
+    num_bins = int((params['raster_pre_event_time'] + params['raster_post_event_time'])
+                   / params['raster_bin_size'])
+    return lambda: raster_manager.process_unit(
+        uuid, fixations, neurons, num_bins, params['raster_bin_size'],
+        params['raster_pre_event_time'], params['raster_post_event_time'])
+
+
+def setup_response_comp_unit(session, work_dir):
+    from response_comp import ResponseComparator
+    from raster_index import RasterIndex
+    rng = np.random.default_rng(0)
+    n_per_roi = max(2, len(session['labelled_fixations']) // len(synthetic_data.ROI_NAMES))
+    rasters = synthetic_data.make_labelled_fixation_rasters(n_per_roi, rng)
+    comparator = ResponseComparator({'processed_data_dir': work_dir})
+    comparator.logger.setLevel(logging.WARNING)
+    unit = rasters['uuid'].iloc[0]
+    region = rasters['region'].iloc[0]
+    raster_index = RasterIndex(rasters)
+    return lambda: comparator.analyze_and_plot_unit(unit, region, raster_index, work_dir)
+
+
+def setup_event_table_load(session, work_dir):
+    import event_tables
+    file_path = os.path.join(work_dir, 'fixations.parquet')
+    event_tables.save_event_table(session['labelled_fixations'], file_path)
+    return lambda: event_tables.load_event_table(file_path)
+
+
+def setup_event_table_csv_load(session, work_dir):
+    import pandas as pd
+    file_path = os.path.join(work_dir, 'fixations.csv')
+    session['labelled_fixations'].to_csv(file_path, index=False)
+    return lambda: pd.read_csv(file_path)
+
+
+def setup_session_raster_load(session, work_dir):
+    import load_data
+    from raster import RasterManager
+    rasters = setup_raster_process_unit(session, work_dir)()
+    file_path = os.path.join(work_dir, 'synthetic_raster.pkl')
+    RasterManager({'processed_data_dir': work_dir}).save_to_pickle(rasters, file_path)
+    return lambda: load_data.load_session_raster_data(file_path)
+
+
+# Benchmark name -> (setup function returning the timed callable, size of
+# the session in the benchmark's item unit)
+BENCHMARKS = {
+    'cluster_fix.detect_fixations': (setup_cluster_fix, lambda s: len(s['positions'])),
+    'eye_mvm_fix.detect_fixations': (setup_eye_mvm_fix, lambda s: len(s['positions'])),
+    'eye_mvm_saccade.extract_saccades': (setup_eye_mvm_saccade, lambda s: len(s['positions'])),
+    'raster.process_unit': (setup_raster_process_unit, lambda s: len(s['labelled_fixations'])),
+    'response_comp.analyze_and_plot_unit': (setup_response_comp_unit, lambda s: len(s['labelled_fixations'])),
+    'load.event_table_parquet': (setup_event_table_load, lambda s: len(s['labelled_fixations'])),
+    'load.event_table_csv': (setup_event_table_csv_load, lambda s: len(s['labelled_fixations'])),
+    'load.session_raster_pickle': (setup_session_raster_load, lambda s: len(s['labelled_fixations'])),
+}
+
+
+def time_call(func, repeats, warmup=1):
+    """
+    Times a callable after untimed warm-up calls, which take lazy imports and
+    first-touch allocations out of the measurement.
+    Returns:
+    - timings (list): Wall time of each repeat in seconds.
+    """
+    for _ in range(warmup):
+        func()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def fit_scaling_exponent(sizes, seconds):
+    """
+    Fits seconds ~ size ** k on a log-log scale.
+    Returns:
+    - k (float or None): Scaling exponent, None with fewer than two sizes.
+    """
+    sizes = np.asarray(sizes, dtype=float)
+    seconds = np.asarray(seconds, dtype=float)
+    valid = (sizes > 0) & (seconds > 0)
+    if valid.sum() < 2 or np.ptp(sizes[valid]) == 0:
+        return None
+    return float(np.polyfit(np.log(sizes[valid]), np.log(seconds[valid]), 1)[0])
+
+
+def run_benchmarks(names, durations_s, repeats, seed, warmup=1):
+    """
+    Runs the benchmarks on synthetic sessions of each duration.
+    Parameters:
+    - names (list): Benchmark names, keys of BENCHMARKS.
+    - durations_s (list): Session durations in seconds.
+    - repeats (int): Timed repeats per benchmark and size; the best is kept.
+    - seed (int): Seed of the synthetic data.
+    - warmup (int): Untimed calls before the timed repeats.
+    Returns:
+    - results (dict): Benchmark name -> list of per-size measurements.
+    """
+    results = {name: [] for name in names}
+    for duration_s in durations_s:
+        session = synthetic_data.make_synthetic_session(duration_s, seed=seed)
+        logging.info(f"Synthetic session of {duration_s} s: {len(session['positions'])} samples, "
+                     f"{len(session['labelled_fixations'])} fixations")
+        for name in names:
+            setup, get_size = BENCHMARKS[name]
+            with tempfile.TemporaryDirectory() as work_dir:
+                try:
+                    func = setup(session, work_dir)
+                    timings = time_call(func, repeats, warmup)
+                except Exception as e:
+                    logging.error(f"Benchmark {name} failed at {duration_s} s: {e}")
+                    results[name].append({'duration_s': duration_s, 'error': str(e)})
+                    continue
+            results[name].append({
+                'duration_s': duration_s, 'size': get_size(session),
+                'best_s': min(timings), 'median_s': float(np.median(timings)),
+                'repeats': repeats})
+            logging.info(f"{name} at {duration_s} s: {min(timings):.4f} s")
+    return results
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    Compares the best times with those of a baseline run at equal durations.
+    Returns:
+    - comparisons (list): List of (name, duration_s, baseline_s, best_s,
+    ratio, is_regression) tuples.
+    """
+    comparisons = []
+    for name, measurements in results.items():
+        baseline_by_duration = {m['duration_s']: m for m in baseline.get('results', {}).get(name, [])
+                                if 'best_s' in m}
+        for m in measurements:
+            base = baseline_by_duration.get(m['duration_s'])
+            if base is None or 'best_s' not in m:
+                continue
+            ratio = m['best_s'] / base['best_s']
+            comparisons.append((name, m['duration_s'], base['best_s'], m['best_s'],
+                                ratio, ratio > 1 + tolerance))
+    return comparisons
+
+
+def print_report(results, comparisons):
+    print(f"\n{'benchmark':<38}{'duration_s':>11}{'size':>10}{'best_s':>11}{'scaling k':>11}")
+    for name, measurements in results.items():
+        ok = [m for m in measurements if 'best_s' in m]
+        k = fit_scaling_exponent([m['size'] for m in ok], [m['best_s'] for m in ok])
+        for i, m in enumerate(measurements):
+            k_str = '' if i > 0 or k is None else f'{k:.2f}'
+            if 'best_s' not in m:
+                print(f"{name:<38}{m['duration_s']:>11}{'':>10}{'error':>11}")
+                continue
+            print(f"{name:<38}{m['duration_s']:>11}{m['size']:>10}{m['best_s']:>11.4f}{k_str:>11}")
+    if comparisons:
+        print(f"\n{'benchmark':<38}{'duration_s':>11}{'baseline_s':>11}{'best_s':>11}{'ratio':>8}")
+        for name, duration_s, base_s, best_s, ratio, is_regression in comparisons:
+            flag = '  REGRESSION' if is_regression else ''
+            print(f"{name:<38}{duration_s:>11}{base_s:>11.4f}{best_s:>11.4f}{ratio:>8.2f}{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline hot paths on synthetic sessions.')
+    parser.add_argument('--benchmarks', nargs='+', default=list(BENCHMARKS),
+                        choices=list(BENCHMARKS), help='Benchmarks to run')
+    parser.add_argument('--durations', nargs='+', type=float, default=DEFAULT_DURATIONS_S,
+                        help='Synthetic session durations in seconds')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed repeats per benchmark and size')
+    parser.add_argument('--warmup', type=int, default=1, help='Untimed calls before the timed repeats')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare against the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Relative slowdown reported as a regression')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    results = run_benchmarks(args.benchmarks, args.durations, args.repeats, args.seed, args.warmup)
+    comparisons = []
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        comparisons = compare_with_baseline(results, baseline, args.tolerance)
+    print_report(results, comparisons)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'created': datetime.now().isoformat(), 'host': socket.gethostname(),
+                       'python': platform.python_version(), 'numpy': np.__version__,
+                       'seed': args.seed, 'results': results}, f, indent=2)
+        logging.info(f"Benchmark results saved to {args.output}")
+    return 1 if any(c[-1] for c in comparisons) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
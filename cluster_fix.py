@@ -10,16 +10,12 @@ Author: pg496
 from multiprocessing import cpu_count
 from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
-import scipy.signal as signal
-from scipy.interpolate import interp1d
-from sklearn.cluster import KMeans
 from tqdm import tqdm
 
-import pdb
+import instrumentation
 
-# Check number of available CPUs
-num_cpus = cpu_count()
-print(f"Number of available CPUs: {num_cpus}")
+# scipy and sklearn are imported where they are used, so that processes
+# which do not run this detector skip their import time
 
 
 class ClusterFixationDetector:
@@ -30,7 +26,8 @@ class ClusterFixationDetector:
         self.fltord = 60
         self.lowpasfrq = 30
         self.nyqfrq = 1000 / 2
-        self.flt = signal.firwin2(self.fltord, [0, self.lowpasfrq / self.nyqfrq, self.lowpasfrq / self.nyqfrq, 1], [1, 1, 0, 0])
+        from scipy.signal import firwin2
+        self.flt = firwin2(self.fltord, [0, self.lowpasfrq / self.nyqfrq, self.lowpasfrq / self.nyqfrq, 1], [1, 1, 0, 0])
         self.buffer = int(100 / (self.samprate * 1000))
         self.fixationstats = []
 
@@ -88,6 +85,7 @@ class ClusterFixationDetector:
             }
 
 
+    @instrumentation.timed_stage('cluster_fix.preprocess_data', count_items=lambda result, self, eyedat: len(eyedat[0]))
     def preprocess_data(self, eyedat):
         x = np.pad(eyedat[0], (self.buffer, self.buffer), 'reflect')
         y = np.pad(eyedat[1], (self.buffer, self.buffer), 'reflect')
@@ -107,12 +105,14 @@ class ClusterFixationDetector:
             print(f"Resample factor is too large: {resample_factor}")
             raise ValueError("Resample factor is too large, leading to excessive memory usage.")
         t_new = np.linspace(0, len(data) - 1, int(len(data) * resample_factor))
+        from scipy.interpolate import interp1d
         f = interp1d(t_old, data, kind='linear')
         return f(t_new)
 
 
     def apply_filter(self, data):
-        return signal.filtfilt(self.flt, 1, data)
+        from scipy.signal import filtfilt
+        return filtfilt(self.flt, 1, data)
 
 
     def extract_parameters(self, x, y):
@@ -142,10 +142,12 @@ class ClusterFixationDetector:
         return points
 
 
+    @instrumentation.timed_stage('cluster_fix.global_clustering', count_items=lambda result, self, points: len(points))
     def global_clustering(self, points):
+        from sklearn.cluster import KMeans
         print("Starting global_clustering...")
 
-        max_workers = min(num_cpus, 4)  # Limiting to 4 parallel jobs
+        max_workers = min(cpu_count(), 4)  # Limiting to 4 parallel jobs
         if self.use_parallel:
             print("Using parallel processing with ProcessPoolExecutor")
             with ProcessPoolExecutor(max_workers=max_workers) as executor:
@@ -185,6 +187,7 @@ class ClusterFixationDetector:
 
 
     def cluster_and_silhouette(self, points, numclusts):
+        from sklearn.cluster import KMeans
         print(f'Doing kMeans for {numclusts} clusters now')
         T = KMeans(n_clusters=numclusts, n_init=5).fit(points[::10, 1:4])
         silh = self.inter_vs_intra_dist(points[::10, 1:4], T.labels_)
@@ -230,9 +233,10 @@ class ClusterFixationDetector:
         return times[:, np.diff(times, axis=0)[0] >= threshold]
 
 
+    @instrumentation.timed_stage('cluster_fix.local_reclustering', count_items=lambda result, self, fixationtimes, points: fixationtimes.shape[-1])
     def local_reclustering(self, fixationtimes, points):
         notfixations = []
-        max_workers = min(num_cpus, len(fixationtimes.T))
+        max_workers = min(cpu_count(), len(fixationtimes.T))
         if self.use_parallel:
             print("Using parallel processing with ProcessPoolExecutor")
             with ProcessPoolExecutor(max_workers=max_workers) as executor:
@@ -254,6 +258,7 @@ class ClusterFixationDetector:
 
 
     def process_local_reclustering(self, fix, points):
+        from sklearn.cluster import KMeans
         altind = np.arange(fix[0] - 50, fix[1] + 50)
         altind = altind[(altind >= 0) & (altind < len(points))]
         POINTS = points[altind]
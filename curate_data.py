@@ -11,42 +11,31 @@ from tqdm import tqdm
 import os
 import pandas as pd
 import logging
-import h5py
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import util
 import load_data
+import session_meta_index
+import resource_estimator
 import eyelink
 import fix_and_saccades
 from raster import RasterManager
+from saccade_table import SACCADE_COLUMNS
 from hpc_cluster import HPCCluster
 
-import pdb
-
 
 ### Function to extract meta-information and update params
 def extract_and_update_meta_info(params):
     """
     Extracts meta-information from files in session paths and updates the params dictionary.
+    The meta info is read through the session meta index, so only sessions whose
+    source files changed since the last run are loaded again.
     Parameters:
     - params (dict): Dictionary containing session paths and other parameters.
     Returns:
     - params (dict): Updated dictionary with meta-information and dose arrays.
     """
-    meta_info_list = []
-    for session_path in params['session_paths']:
-        dose_info = load_data.get_monkey_and_dose_data(session_path)
-        if dose_info is not None:
-            meta_info = {
-                'session_name': os.path.basename(
-                    os.path.normpath(session_path))}
-            meta_info.update(dose_info)
-            runs_info = load_data.get_runs_data(session_path)
-            meta_info.update(runs_info)
-            meta_info['roi_bb_corners'] = \
-                load_data.load_farplane_cal_and_get_bl_and_tr_roi_coords_m1(
-                    session_path, params)
-            meta_info_list.append(meta_info)
+    meta_info_list = session_meta_index.build_or_load_session_meta_index(params)
     params['meta_info_list'] = meta_info_list
     otnal_doses = np.array(
         [[meta_info['OT_dose'], meta_info['NAL_dose']]
@@ -121,17 +110,18 @@ def extract_fixations_and_saccades_with_labels(labelled_gaze_positions, params):
     Returns:
     - labelled_fixations (pd.DataFrame): DataFrame of labels for fixations.
     - labelled_saccades (pd.DataFrame): DataFrame containing saccade information with labels.
+    Trajectories are referenced by start_idx/end_idx; wrap the table in a
+    saccade_table.SaccadeTable to access them.
     """
     print("\nStarting to extract fixations and saccades:")
-    use_parallel = params.get('use_parallel', True)
 
     # Extract fixations and saccades
     all_fix_timepos, fix_detection_results, saccade_detection_results = fix_and_saccades.extract_or_load_fixations_and_saccades(labelled_gaze_positions, params)
-    labelled_fixations = fix_and_saccades.generate_fixation_labels(fix_detection_results, params, use_parallel)
+    labelled_fixations = fix_and_saccades.generate_fixation_labels(fix_detection_results, params)
+    fix_and_saccades.save_fixation_labels(labelled_fixations, params)
 
     saccades = [s for session_saccades in saccade_detection_results for s in session_saccades]
-    columns = ["start_time", "end_time", "duration", "trajectory", "start_roi", "end_roi", "session_name", "category", "run", "block"]
-    labelled_saccades = pd.DataFrame(saccades, columns=columns)
+    labelled_saccades = pd.DataFrame(saccades, columns=SACCADE_COLUMNS)
     fix_and_saccades.save_saccade_labels(labelled_saccades, params)
 
     return labelled_fixations, labelled_saccades
@@ -184,6 +174,7 @@ def extract_spiketimes_for_all_sessions(params):
 
 
 def save_spiketimes_to_hdf5(labelled_spiketimes, file_path):
+    import h5py
     with h5py.File(file_path, 'w') as hf:
         spikeS_group = hf.create_group('spikeS')
         spikeMs_group = hf.create_group('spikeMs')
@@ -202,7 +193,7 @@ def save_spiketimes_to_hdf5(labelled_spiketimes, file_path):
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def extract_fixation_raster(session_paths, labelled_fixations, labelled_spiketimes, params):
+def extract_fixation_raster(session_paths, labelled_fixations, labelled_spiketimes, params, labelled_saccades=None):
     session_names = [os.path.basename(session_path) for session_path in session_paths]
     logging.debug(f"Session names extracted from paths: {session_names}")
     results = []
@@ -211,25 +202,23 @@ def extract_fixation_raster(session_paths, labelled_fixations, labelled_spiketim
     if params.get('remake_raster', False):
         if params.get('submit_separate_jobs_for_sessions', True):
             hpc_cluster = HPCCluster(params)
-            job_file_path = hpc_cluster.generate_job_file(session_paths)
-            hpc_cluster.submit_job_array(job_file_path)
-            session_files = [os.path.join(params['processed_data_dir'], f"{session}_raster.pkl") for session in session_names]
-            for session_file in session_files:
-                try:
-                    session_data = load_data.load_session_raster_data(session_file)
-                    results.append(session_data)
-                except FileNotFoundError as e:
-                    logging.error(e)
-                    continue
+            session_files = {i: os.path.join(params['processed_data_dir'], f"{session}_raster.pkl") for i, session in enumerate(session_names)}
+            # Sessions are loaded as their tasks finish; failed ones are resubmitted
+            session_sizes = resource_estimator.get_raster_session_sizes(
+                session_names, labelled_fixations, labelled_spiketimes)
+            session_results = hpc_cluster.run_sessions(
+                session_paths, session_files, load_data.load_session_raster_data,
+                session_sizes)
+            results = [session_results[i] for i in sorted(session_results)]
             if not results:
                 logging.error("No results to concatenate.")
                 raise ValueError("No objects to concatenate")
             labelled_fixation_rasters = pd.concat(results, ignore_index=True)
         else:
             if params.get('use_parallel', False):
-                results = raster_manager.make_session_rasters_parallel(session_paths, labelled_fixations, labelled_spiketimes)
+                results = raster_manager.make_session_rasters_parallel(session_paths, labelled_fixations, labelled_spiketimes, labelled_saccades)
             else:
-                results = raster_manager.make_session_rasters_serial(session_paths, labelled_fixations, labelled_spiketimes)
+                results = raster_manager.make_session_rasters_serial(session_paths, labelled_fixations, labelled_spiketimes, labelled_saccades)
             if not results:
                 logging.error("No results to concatenate.")
                 raise ValueError("No objects to concatenate")
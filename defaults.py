@@ -6,7 +6,6 @@ Created on Wed Apr 10 14:36:16 2024
 @author: prabaha
 """
 
-from scipy.signal.windows import gaussian
 from numpy import convolve
 
 def fetch_monitor_info():
@@ -16,6 +15,7 @@ def fetch_monitor_info():
             'horizontal_resolution': 1280}
 
 def fetch_default_saccade_pars():
+    from scipy.signal.windows import gaussian
     window = gaussian(21, 5, True)
     smooth_func = lambda x: convolve(x, window, mode='same')
     return {'vel_thresh': [50, 1000],
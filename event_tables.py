@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar storage of the fixation and saccade tables.
+"""
+
+import os
+import logging
+import importlib.util
+
+import pandas as pd
+
+import util
+
+
+# Label columns stored as categoricals in the columnar tables
+CATEGORICAL_COLUMNS = ['session_name', 'fix_roi', 'block', 'agent',
+                       'start_roi', 'end_roi']
+
+# Rows per parquet row group; the unit that session filters can skip
+ROW_GROUP_SIZE = 50000
+
+
+def is_parquet_available():
+    # Checks for pyarrow without importing it; pandas imports it on the
+    # first parquet read or write
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def get_event_table_path(processed_data_dir, table_name, params):
+    """
+    Returns the path of a columnar event table.
+    Parameters:
+    - processed_data_dir (str): Directory of processed data.
+    - table_name (str): Base name of the table, e.g. 'fix_timepos_m1'.
+    - params (dict): Dictionary of parameters.
+    Returns:
+    - file_path (str): Path to the parquet file.
+    """
+    flag_info = util.get_filename_flag_info(params)
+    return os.path.join(processed_data_dir, f'{table_name}{flag_info}.parquet')
+
+
+def to_categorical_columns(table):
+    """
+    Casts the label columns of a table to categorical dtype. Missing labels
+    stay missing rather than becoming 'nan' or 'None' categories.
+    Parameters:
+    - table (pd.DataFrame): Event table.
+    Returns:
+    - table (pd.DataFrame): Table with categorical label columns.
+    """
+    for column in CATEGORICAL_COLUMNS:
+        if column in table.columns and \
+                not isinstance(table[column].dtype, pd.CategoricalDtype):
+            table[column] = table[column].astype('category')
+    return table
+
+
+def save_event_table(table, file_path):
+    """
+    Saves an event table (fixations, fixation labels or saccades) as parquet
+    with categorical label columns.
+    Parameters:
+    - table (pd.DataFrame): Event table.
+    - file_path (str): Path to the parquet file.
+    """
+    if not is_parquet_available():
+        raise ImportError("pyarrow is required to save parquet event tables")
+    table = to_categorical_columns(table.copy())
+    if 'session_name' in table.columns:
+        # Keep each session contiguous so that the row group statistics let
+        # session filters skip the other sessions' row groups
+        table = table.sort_values('session_name', kind='stable')
+    table.to_parquet(file_path, engine='pyarrow', index=False,
+                     row_group_size=ROW_GROUP_SIZE)
+    logging.info(f"Event table saved to {file_path}")
+
+
+def load_event_table(file_path, columns=None, sessions=None):
+    """
+    Loads an event table, reading only the requested columns and the row
+    groups of the requested sessions.
+    Parameters:
+    - file_path (str): Path to the parquet file.
+    - columns (list): Columns to read; all columns if None.
+    - sessions (list): Session names to read; all sessions if None.
+    Returns:
+    - table (pd.DataFrame): The event table.
+    """
+    filters = None
+    if sessions is not None:
+        filters = [('session_name', 'in', list(sessions))]
+    return pd.read_parquet(file_path, engine='pyarrow',
+                           columns=columns, filters=filters)
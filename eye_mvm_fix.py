@@ -10,23 +10,40 @@ import numpy as np
 import pandas as pd
 from tqdm import tqdm
 import util
+import timebase
 
 class EyeMVMFixationDetector:
     def __init__(self, sampling_rate):
         self.sampling_rate = sampling_rate
 
-    def detect_fixations(self, positions, time_vec, session_name):
-        fix_timepos_df, fix_vec_entire_session = self.is_fixation(positions, time_vec, session_name)
+    def detect_fixations(self, positions, clock, session_name):
+        fix_timepos_df = self.detect_fixation_table(positions, clock, session_name)
         fixationtimes = fix_timepos_df[['start_time', 'end_time']].to_numpy().T
         fixations = fix_timepos_df[['fix_x', 'fix_y']].to_numpy().T
         return fixationtimes, fixations
 
+    def detect_fixation_table(self, positions, clock, session_name):
+        """
+        Detects the fixations of a session.
+        Parameters:
+        - positions (np.ndarray): (n_samples, 2) gaze positions.
+        - clock (timebase.SampleClock): Time base of the samples; an explicit
+        time vector is accepted too.
+        - session_name (str): Name of the session.
+        Returns:
+        - fix_timepos_df (pd.DataFrame): One row per fixation, with the start
+        and end times in seconds and the first and last sample as
+        'start_idx' and 'end_idx'.
+        """
+        fix_timepos_df, fix_vec_entire_session = self.is_fixation(positions, clock, session_name)
+        return fix_timepos_df
+
     def is_fixation(self, pos, time, session_name, t1=None, t2=None, minDur=None, maxDur=None):
         """
         Determine fixations based on position and time data.
         Args:
         pos: Position data (x, y).
-        time: Time data.
+        time: Time base of the samples (timebase.SampleClock).
         t1: Spatial parameter t1.
         t2: Spatial parameter t2.
         minDur: Minimum fixation duration.
@@ -34,7 +51,8 @@ class EyeMVMFixationDetector:
         Returns:
         Binary vector indicating fixations (1) and non-fixations (0).
         """
-        data = np.column_stack((pos, time))
+        clock = timebase.as_clock(time)
+        data = np.column_stack((pos, clock.times()))
         if minDur is None:
             minDur = 0.05
         if maxDur is None:
@@ -44,12 +62,12 @@ class EyeMVMFixationDetector:
         if t1 is None:
             t1 = 30
         fix_vector = np.zeros(data.shape[0])
-        fix_list_df, fix_t_inds = self.fixation_detection(data, t1, t2, minDur, maxDur, session_name)
+        fix_list_df, fix_t_inds = self.fixation_detection(data, t1, t2, minDur, maxDur, session_name, clock)
         for t_range in fix_t_inds:
             fix_vector[t_range[0]:t_range[1] + 1] = 1
         return fix_list_df, fix_vector
 
-    def fixation_detection(self, data, t1, t2, minDur, maxDur, session_name):
+    def fixation_detection(self, data, t1, t2, minDur, maxDur, session_name, clock=None):
         """
         Detect fixations based on position and time data.
         Args:
@@ -57,12 +75,14 @@ class EyeMVMFixationDetector:
         t1: Spatial parameter t1.
         t2: Spatial parameter t2.
         minDur: Minimum fixation duration.
+        clock: Time base of the samples; the time column of data if None.
         Returns:
-        List of fixation time ranges.
+        DataFrame of fixations and list of fixation sample ranges.
         """
+        col_names = ['fix_x', 'fix_y', 'threshold_1', 'threshold_2', 'start_time', 'end_time', 'duration']
         n = len(data)
         if n == 0:
-            return []  
+            return pd.DataFrame(columns=col_names + ['start_idx', 'end_idx']), []
         x = data[:, 0]
         y = data[:, 1]
         t = data[:, 2]
@@ -73,13 +93,14 @@ class EyeMVMFixationDetector:
             fixation_list.append(self.filter_fixations_t2(i, fixations, t2))
         fixation_list = self.min_duration(fixation_list, minDur)
         fixation_list = self.max_duration(fixation_list, maxDur)
-        fix_ranges = []
-        for fix in fixation_list:
-            s_ind = np.where(data[:, 2] == fix[4])[0][0]
-            e_ind = np.where(data[:, 2] == fix[5])[0][-1]
-            fix_ranges.append([s_ind, e_ind])
-        col_names = ['fix_x', 'fix_y', 'threshold_1', 'threshold_2', 'start_time', 'end_time', 'duration']
-        return pd.DataFrame(fixation_list, columns=col_names), fix_ranges
+        # Start and end times are sample times; look their samples up on the
+        # clock instead of scanning the time column for equal values
+        clock = timebase.as_clock(t) if clock is None else clock
+        fix_list_df = pd.DataFrame(fixation_list, columns=col_names)
+        fix_list_df['start_idx'] = clock.searchsorted(fix_list_df['start_time'].to_numpy(dtype=float), side='left')
+        fix_list_df['end_idx'] = clock.searchsorted(fix_list_df['end_time'].to_numpy(dtype=float), side='right') - 1
+        fix_ranges = fix_list_df[['start_idx', 'end_idx']].to_numpy().tolist()
+        return fix_list_df, fix_ranges
 
     def get_t1_filtered_fixations(self, n, x, y, t, t1, session_name):
         fixations = np.zeros((n, 4))
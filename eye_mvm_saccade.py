@@ -7,73 +7,124 @@ Created on Mon Jun 17 11:40:06 2024
 """
 
 import numpy as np
+import pandas as pd
+
 import util
+import timebase
+import saccade_metrics
+from saccade_table import SACCADE_COLUMNS
 
 class EyeMVMSaccadeDetector:
-    def __init__(self, vel_thresh, min_samples, smooth_func):
+    def __init__(self, vel_thresh, min_samples, smooth_func, monitor_info=None):
         self.vel_thresh = vel_thresh
         self.min_samples = min_samples
         self.smooth_func = smooth_func
+        # Pixel to degree conversion is linear; compute the factor once
+        self.deg_per_px = util.get_deg_per_px(monitor_info)
 
     def extract_saccades_for_session(self, session_data):
         positions, info = session_data
-        sampling_rate = info['sampling_rate']
-        n_samples = positions.shape[0]
-        time_vec = util.create_timevec(n_samples, sampling_rate)
-        session_saccades = self.extract_saccades(positions, time_vec, info)
+        clock = timebase.SampleClock(positions.shape[0], info['sampling_rate'])
+        session_saccades = self.extract_saccades(positions, clock, info)
         return session_saccades
 
-    def extract_saccades(self, positions, time_vec, info):
-        session_saccades = []
-        category = info['category']
-        session_name = info['session_name']
-        n_runs = info['num_runs']
-        for run in range(n_runs):
-            run_start = info['startS'][run]
-            run_stop = info['stopS'][run]
-            run_time = (time_vec > run_start) & (time_vec <= run_stop)
-            run_positions = positions[run_time, :]
-            run_x = util.px2deg(run_positions[:, 0].T)
-            run_y = util.px2deg(run_positions[:, 1].T)
-            saccade_start_stops = self.find_saccades(run_x, run_y, info['sampling_rate'])
-            for start, stop in saccade_start_stops:
-                saccade = run_positions[start:stop + 1, :]
-                start_time = time_vec[start]
-                end_time = time_vec[stop]
-                duration = end_time - start_time
-                start_roi = self.determine_roi_of_coord(run_positions[start, :2], info['roi_bb_corners'])
-                end_roi = self.determine_roi_of_coord(run_positions[stop, :2], info['roi_bb_corners'])
-                block = self.determine_block(start_time, end_time, info['startS'], info['stopS'])
-                session_saccades.append([start_time, end_time, duration, saccade, start_roi, end_roi, session_name, category, run, block])
-        return session_saccades
+    def extract_saccades(self, positions, clock, info):
+        """
+        Returns the saccades of a session as rows ordered as SACCADE_COLUMNS.
+        """
+        return self.extract_saccade_table(positions, clock, info) \
+            .to_numpy(dtype=object).tolist()
 
-    def find_saccades(self, x, y, sr):
+    def extract_saccade_table(self, positions, clock, info, include_metrics=False):
+        """
+        Detects the saccades of each run and labels all of them at once.
+        Runs are sliced out of the gaze positions by index, and the ROI,
+        block and time columns are computed for all saccades together.
+        Parameters:
+        - positions (np.ndarray): (n_samples, 2) gaze positions in pixels.
+        - clock (timebase.SampleClock): Time base of the samples; an
+        explicit time vector is accepted too.
+        - info (dict): Session meta info.
+        - include_metrics (bool): Whether to add the kinematic columns of
+        saccade_metrics.METRIC_COLUMNS, computed from the smoothed traces
+        the saccades were detected on.
+        Returns:
+        - saccades (pd.DataFrame): One row per saccade, SACCADE_COLUMNS and
+        optionally METRIC_COLUMNS.
+        """
+        clock = timebase.as_clock(clock)
+        # A run holds the samples with run_start < t <= run_stop
+        run_starts, run_stops = clock.run_sample_bounds(
+            np.asarray(info['startS'][:info['num_runs']], dtype=float),
+            np.asarray(info['stopS'][:info['num_runs']], dtype=float))
+        start_idx, end_idx, runs, metrics = [], [], [], []
+        for run, (run_start, run_stop) in enumerate(zip(run_starts, run_stops)):
+            if run_stop <= run_start:
+                continue
+            # Saccades are stored as sample indices offset by the first
+            # sample of the run
+            run_x = positions[run_start:run_stop, 0] * self.deg_per_px
+            run_y = positions[run_start:run_stop, 1] * self.deg_per_px
+            x0, y0, vel_norm = self.compute_velocity(run_x, run_y, info['sampling_rate'])
+            saccade_start_stops = self.find_saccade_islands(vel_norm)
+            if len(saccade_start_stops) == 0:
+                continue
+            if include_metrics:
+                metrics.append(saccade_metrics.compute_saccade_metrics(
+                    x0, y0, vel_norm, saccade_start_stops))
+            start_idx.append(saccade_start_stops[:, 0] + run_start)
+            end_idx.append(saccade_start_stops[:, 1] + run_start)
+            runs.append(np.full(len(saccade_start_stops), run))
+        columns = SACCADE_COLUMNS + (saccade_metrics.METRIC_COLUMNS if include_metrics else [])
+        if not start_idx:
+            return pd.DataFrame(columns=columns)
+        start_idx = np.concatenate(start_idx)
+        end_idx = np.concatenate(end_idx)
+        start_time = clock.times(start_idx)
+        end_time = clock.times(end_idx)
+        table = pd.DataFrame({
+            'start_time': start_time,
+            'end_time': end_time,
+            'duration': end_time - start_time,
+            'start_idx': start_idx,
+            'end_idx': end_idx,
+            'start_roi': util.determine_rois(positions[start_idx, :2], info['roi_bb_corners']),
+            'end_roi': util.determine_rois(positions[end_idx, :2], info['roi_bb_corners']),
+            'session_name': info['session_name'],
+            'category': info['category'],
+            'run': np.concatenate(runs),
+            'block': util.determine_blocks(start_time, end_time, info['startS'], info['stopS'])},
+            columns=SACCADE_COLUMNS)
+        if include_metrics:
+            for column in saccade_metrics.METRIC_COLUMNS:
+                table[column] = np.concatenate([run_metrics[column] for run_metrics in metrics])
+        return table
+
+    def compute_velocity(self, x, y, sr):
+        """
+        Smooths a trace and computes its speed.
+        Returns:
+        - x0, y0 (np.ndarray): Smoothed positions.
+        - vel_norm (np.ndarray): Speed per second.
+        """
         assert x.shape == y.shape
-        start_stops = []
         x0 = self.smooth_func(x)
         y0 = self.smooth_func(y)
         vx = np.gradient(x0) / sr
         vy = np.gradient(y0) / sr
         vel_norm = np.sqrt(vx ** 2 + vy ** 2)
+        return x0, y0, vel_norm
+
+    def find_saccade_islands(self, vel_norm):
         above_thresh = (vel_norm >= self.vel_thresh[0]) & (vel_norm <= self.vel_thresh[1])
-        start_stops = util.find_islands(above_thresh, self.min_samples)
-        return start_stops
+        return util.find_islands(above_thresh, self.min_samples)
+
+    def find_saccades(self, x, y, sr):
+        _, _, vel_norm = self.compute_velocity(x, y, sr)
+        return self.find_saccade_islands(vel_norm)
 
     def determine_roi_of_coord(self, position, bbox_corners):
-        bounding_boxes = ['eye_bbox', 'face_bbox', 'left_obj_bbox', 'right_obj_bbox']
-        inside_roi = [util.is_inside_roi(position, bbox_corners[key]) for key in bounding_boxes]
-        if any(inside_roi):
-            if inside_roi[0] and inside_roi[1]:
-                return bounding_boxes[0]
-            return bounding_boxes[inside_roi.index(True)]
-        return 'out_of_roi'
+        return util.determine_rois(position, bbox_corners)[0]
 
     def determine_block(self, start_time, end_time, startS, stopS):
-        if start_time < startS[0] or end_time > stopS[-1]:
-            return 'discard'
-        for i, (run_start, run_stop) in enumerate(zip(startS, stopS), start=1):
-            if start_time >= run_start and end_time <= run_stop:
-                return 'mon_down'
-            elif i < len(startS) and end_time <= startS[i]:
-                return 'mon_up'
-        return 'discard'
+        return util.determine_blocks([start_time], [end_time], startS, stopS)[0]
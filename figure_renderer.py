@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Deferred figure rendering in a process pool, skipping figures whose
+inputs did not change.
+"""
+
+import os
+import json
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from tqdm import tqdm
+
+from artifact_cache import compute_input_hash
+
+
+# Per-directory record of the input hash each figure was rendered from
+MANIFEST_FILE_NAME = '.render_manifest.json'
+
+
+def load_render_manifest(output_dir):
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def save_render_manifest(output_dir, manifest):
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE_NAME)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def _init_render_worker():
+    # Render off-screen; workers forked from an interactive session would
+    # otherwise inherit its GUI backend
+    import matplotlib
+    matplotlib.use('Agg', force=True)
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+
+
+def _render(plot_func, args, kwargs):
+    plot_func(*args, **kwargs)
+
+
+class FigureRenderQueue:
+    """
+    Collects figure jobs while the analysis runs and renders them afterwards
+    in a process pool with the Agg backend. A job is skipped when its output
+    file exists and was rendered from the same inputs, as recorded in a
+    manifest in the output directory.
+    """
+    def __init__(self, n_workers=None, force=False):
+        self.n_workers = n_workers
+        self.force = force
+        self.jobs = []
+
+    def add(self, plot_func, output_path, *args, **kwargs):
+        """
+        Queues a figure.
+        Parameters:
+        - plot_func (callable): Module-level plotting function.
+        - output_path (str): File the function writes.
+        - args, kwargs: Arguments of the function; they are hashed to detect
+        unchanged figures.
+        """
+        input_hash = compute_input_hash(plot_func, args, kwargs)
+        self.jobs.append((plot_func, output_path, args, kwargs, input_hash))
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def get_stale_jobs(self):
+        manifests = {}
+        stale_jobs = []
+        for job in self.jobs:
+            output_path, input_hash = job[1], job[4]
+            output_dir = os.path.dirname(output_path)
+            if output_dir not in manifests:
+                manifests[output_dir] = load_render_manifest(output_dir)
+            is_current = os.path.exists(output_path) and \
+                manifests[output_dir].get(os.path.basename(output_path)) == input_hash
+            if self.force or not is_current:
+                stale_jobs.append(job)
+        return stale_jobs
+
+    def render(self, desc="Rendering figures"):
+        """
+        Renders the queued figures whose inputs changed and clears the queue.
+        Returns:
+        - n_rendered (int): Number of figures rendered.
+        """
+        stale_jobs = self.get_stale_jobs()
+        logging.info(f"{desc}: {len(stale_jobs)} of {len(self.jobs)} figures changed")
+        rendered = []
+        if stale_jobs:
+            n_workers = self.n_workers or min(multiprocessing.cpu_count(), len(stale_jobs))
+            if n_workers <= 1:
+                # Inline in the caller, whose matplotlib backend is kept
+                for job in tqdm(stale_jobs, desc=desc):
+                    try:
+                        _render(job[0], job[2], job[3])
+                        rendered.append(job)
+                    except Exception as e:
+                        logging.error(f"Error rendering {job[1]}: {e}")
+            else:
+                with ProcessPoolExecutor(max_workers=n_workers,
+                                         initializer=_init_render_worker) as executor:
+                    futures = {executor.submit(_render, job[0], job[2], job[3]): job
+                               for job in stale_jobs}
+                    for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+                        job = futures[future]
+                        try:
+                            future.result()
+                            rendered.append(job)
+                        except Exception as e:
+                            logging.error(f"Error rendering {job[1]}: {e}")
+        # Record the inputs of the rendered figures, per output directory
+        by_dir = {}
+        for job in rendered:
+            by_dir.setdefault(os.path.dirname(job[1]), []).append(job)
+        for output_dir, jobs in by_dir.items():
+            manifest = load_render_manifest(output_dir)
+            for job in jobs:
+                manifest[os.path.basename(job[1])] = job[4]
+            save_render_manifest(output_dir, manifest)
+        self.jobs = []
+        return len(rendered)
@@ -17,12 +17,19 @@ import multiprocessing
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import load_data
-from cluster_fix import ClusterFixationDetector  # Import the new ClusterFixationDetector class
-from eye_mvm_fix import EyeMVMFixationDetector  # Import the new EyeMVMFixationDetector class
-from eye_mvm_saccade import EyeMVMSaccadeDetector  # Import the new EyeMVMSaccadeDetector class
-from hpc_fixation_detection import HPCFixationDetection  # Import the new HPCFixationDetection class
+import event_tables
+import instrumentation
+import timebase
+import fixation_counts
+import saccade_metrics
+from saccade_table import SACCADE_COLUMNS
+# Columns of the labelled fixation table, in order
+LABELLED_FIXATION_COLUMNS = ['start_time', 'end_time', 'fix_duration', 'mean_x_pos',
+                             'mean_y_pos', 'fix_roi', 'session_name', 'category',
+                             'run', 'block', 'agent']
 
-import pdb
+# The detectors and the HPC job classes are imported where they are used,
+# so that each per-session task only loads the backend it runs
 
 
 def extract_or_load_fixations_and_saccades(labelled_gaze_positions, params):
@@ -81,23 +88,18 @@ def extract_all_fixations_and_saccades_from_labelled_gaze_positions(labelled_gaz
     submit_separate_jobs = params.get('submit_separate_jobs_for_sessions', True)
 
     if submit_separate_jobs:
+        from hpc_fixation_detection import HPCFixationDetection
         hpc_fixation_detection = HPCFixationDetection(params)
-        job_file_path = hpc_fixation_detection.generate_fixation_job_file(labelled_gaze_positions)
-        hpc_fixation_detection.submit_job_array(job_file_path)
-        session_files = [os.path.join(processed_data_dir, f"{i}_fixations.pkl") for i in range(len(labelled_gaze_positions))]
-        results = []
-        for session_file in session_files:
-            try:
-                with open(session_file, 'rb') as f:
-                    session_data = pickle.load(f)
-                results.append(session_data)
-            except FileNotFoundError as e:
-                logging.error(e)
-                continue
+        session_files = {i: os.path.join(processed_data_dir, f"{i}_fixations.pkl") for i in range(len(labelled_gaze_positions))}
+        # Sessions are loaded as their tasks finish; failed ones are resubmitted
+        results = hpc_fixation_detection.run_sessions(
+            labelled_gaze_positions, session_files, load_data.load_session_fixation_results)
+        results = [results[i] for i in sorted(results)]
         if not results:
             logging.error("No results to concatenate.")
             raise ValueError("No objects to concatenate")
-        all_fix_timepos, fix_detection_results, saccade_detection_results = zip(*results)
+        fix_detection_results, saccade_detection_results = split_session_results(results)
+        all_fix_timepos = process_fixation_results(fix_detection_results)
     else:
         sessions_data = [(session_data[0], session_data[1], params) for session_data in labelled_gaze_positions]
         fix_detection_results, saccade_detection_results = extract_fixations_and_saccades(sessions_data, use_parallel)
@@ -137,7 +139,20 @@ def extract_fixations_and_saccades(sessions_data, use_parallel):
         print("\nExtracting fixations and saccades serially")
         results = [get_session_fixations_and_saccades(session_data) for session_data in sessions_data]
 
-    fix_detection_results, saccade_detection_results = zip(*results)
+    return split_session_results(results)
+
+
+def split_session_results(results):
+    """
+    Splits per-session (fix_timepos_df, info, saccades) results.
+    Parameters:
+    - results (list): Results of get_session_fixations_and_saccades.
+    Returns:
+    - fix_detection_results (list): List of (fix_timepos_df, info) tuples.
+    - saccade_detection_results (list): List of per-session saccade lists.
+    """
+    fix_detection_results = [(fix_timepos_df, info) for fix_timepos_df, info, _ in results]
+    saccade_detection_results = [saccades for _, _, saccades in results]
     return fix_detection_results, saccade_detection_results
 
 
@@ -156,32 +171,50 @@ def get_session_fixations_and_saccades(session_data):
     session_name = info['session_name']
     sampling_rate = info['sampling_rate']
     n_samples = positions.shape[0]
-    time_vec = util.create_timevec(n_samples, sampling_rate)
+    # Samples are addressed by index; times are derived from the clock
+    clock = timebase.SampleClock(n_samples, sampling_rate)
     use_parallel = params.get('use_parallel', False)
 
-    if params.get('fixation_detection_method', 'default') == 'cluster_fix':
-        detector = ClusterFixationDetector(samprate=sampling_rate, use_parallel=use_parallel)
-        x_coords = positions[:, 0]
-        y_coords = positions[:, 1]
-        # Transform into the expected format
-        eyedat = (x_coords, y_coords)
-        fix_stats = detector.detect_fixations(eyedat)
-        fixationtimes = fix_stats[0]['fixationtimes']
-        fixations = fix_stats[0]['fixations']
-        saccadetimes = fix_stats[0]['saccadetimes']
-        saccades = format_saccades(saccadetimes, positions, info)
-    else:
-        fix_detector = EyeMVMFixationDetector(sampling_rate=sampling_rate)
-        fixationtimes, fixations = fix_detector.detect_fixations(positions, time_vec, session_name)
-        saccade_detector = EyeMVMSaccadeDetector(params['vel_thresh'], params['min_samples'], params['smooth_func'])
-        saccades = saccade_detector.extract_saccades_for_session((positions, info))
-
-    fix_timepos_df = pd.DataFrame({
-        'start_time': fixationtimes[0],
-        'end_time': fixationtimes[1],
-        'fix_x': fixations[0],
-        'fix_y': fixations[1]
-    })
+    # Record the detection time and memory of the session in the run log
+    with instrumentation.session_scope(session_name), \
+            instrumentation.stage_timer('fixation_and_saccade_detection', n_items=n_samples):
+        if params.get('fixation_detection_method', 'default') == 'cluster_fix':
+            from cluster_fix import ClusterFixationDetector
+            detector = ClusterFixationDetector(samprate=sampling_rate, use_parallel=use_parallel)
+            x_coords = positions[:, 0]
+            y_coords = positions[:, 1]
+            # Transform into the expected format
+            eyedat = (x_coords, y_coords)
+            fix_stats = detector.detect_fixations(eyedat)
+            # cluster_fix reports fixations and saccades as sample indices
+            fix_idx = np.asarray(fix_stats[0]['fixationtimes'], dtype=np.int64).reshape(2, -1)
+            fixations = np.asarray(fix_stats[0]['fixations']).reshape(2, -1)
+            fix_timepos_df = pd.DataFrame({
+                'start_time': clock.times(fix_idx[0]),
+                'end_time': clock.times(fix_idx[1]),
+                'fix_x': fixations[0],
+                'fix_y': fixations[1],
+                'start_idx': fix_idx[0],
+                'end_idx': fix_idx[1]
+            })
+            saccadetimes = fix_stats[0]['saccadetimes']
+            saccades = format_saccades(saccadetimes, positions, info, clock)
+        else:
+            from eye_mvm_fix import EyeMVMFixationDetector
+            from eye_mvm_saccade import EyeMVMSaccadeDetector
+            fix_detector = EyeMVMFixationDetector(sampling_rate=sampling_rate)
+            fix_timepos_df = fix_detector.detect_fixation_table(positions, clock, session_name)[
+                ['start_time', 'end_time', 'fix_x', 'fix_y', 'start_idx', 'end_idx']].reset_index(drop=True)
+            saccade_detector = EyeMVMSaccadeDetector(params['vel_thresh'], params['min_samples'], params['smooth_func'])
+            if params.get('compute_saccade_metrics', True):
+                # Kinematics come from the traces the saccades are detected
+                # on, and are saved per session by the job of the session
+                saccade_table = saccade_detector.extract_saccade_table(
+                    positions, clock, info, include_metrics=True)
+                saccade_metrics.save_session_saccade_metrics(saccade_table, params, session_name)
+                saccades = saccade_table[SACCADE_COLUMNS].to_numpy(dtype=object).tolist()
+            else:
+                saccades = saccade_detector.extract_saccades(positions, clock, info)
     return fix_timepos_df, info, saccades
 
 
@@ -193,10 +226,91 @@ def process_fixation_results(fix_detection_results):
     Returns:
     - all_fix_timepos (pd.DataFrame): DataFrame of fixation time positions.
     """
-    all_fix_timepos = pd.DataFrame()
-    for session_timepos_df, _ in fix_detection_results:
-        all_fix_timepos = pd.concat([all_fix_timepos, session_timepos_df], ignore_index=True)
-    return all_fix_timepos
+    session_timepos_dfs = []
+    for session_timepos_df, info in fix_detection_results:
+        session_timepos_df = session_timepos_df.copy()
+        session_timepos_df['session_name'] = info['session_name']
+        session_timepos_dfs.append(session_timepos_df)
+    if not session_timepos_dfs:
+        return pd.DataFrame()
+    return pd.concat(session_timepos_dfs, ignore_index=True)
+
+
+def generate_fixation_labels(fix_detection_results, params):
+    """
+    Labels the fixations of all sessions in one pass. The detections are
+    concatenated into arrays, and ROI, block, run, dose category and agent
+    are joined from the session meta info by session code, so the cost does
+    not grow with per-fixation Python calls.
+    Parameters:
+    - fix_detection_results (list): List of (fix_timepos_df, info) tuples.
+    - params (dict): Dictionary of parameters.
+    Returns:
+    - labelled_fixations (pd.DataFrame): One row per fixation with
+    LABELLED_FIXATION_COLUMNS, label columns as categoricals.
+    """
+    fix_detection_results = [(fix_timepos_df, info) for fix_timepos_df, info
+                             in fix_detection_results if info is not None]
+    session_infos = [info for _, info in fix_detection_results]
+    tables = [fix_timepos_df for fix_timepos_df, _ in fix_detection_results]
+    n_fixations = np.array([len(table) for table in tables], dtype=np.int64)
+    session_codes = np.repeat(np.arange(len(tables)), n_fixations)
+    if n_fixations.sum() == 0:
+        return event_tables.to_categorical_columns(
+            pd.DataFrame(columns=LABELLED_FIXATION_COLUMNS))
+    fixations = pd.concat(tables, ignore_index=True)
+    start_time = fixations['start_time'].to_numpy(dtype=float)
+    end_time = fixations['end_time'].to_numpy(dtype=float)
+    x = fixations['fix_x'].to_numpy(dtype=float)
+    y = fixations['fix_y'].to_numpy(dtype=float)
+    # Runs of each session padded to a common length, gathered per fixation
+    startS, stopS = get_padded_run_times(session_infos)
+    fixation_startS = startS[session_codes]
+    fixation_stopS = stopS[session_codes]
+    session_names = np.array([info['session_name'] for info in session_infos], dtype=object)
+    # Inferred dtype: float dose category codes stay floats
+    categories = pd.Series([info.get('category') for info in session_infos]).to_numpy()
+    agents = np.array([info.get(params.get('fixation_agent_key', 'monkey_1'))
+                       for info in session_infos], dtype=object)
+    labelled_fixations = pd.DataFrame({
+        'start_time': start_time,
+        'end_time': end_time,
+        'fix_duration': end_time - start_time,
+        'mean_x_pos': x,
+        'mean_y_pos': y,
+        'fix_roi': util.determine_rois_by_session(
+            np.column_stack((x, y)), session_codes,
+            [info.get('roi_bb_corners') for info in session_infos]),
+        'session_name': session_names[session_codes],
+        'category': categories[session_codes],
+        'run': util.determine_runs(start_time, fixation_startS),
+        'block': util.determine_blocks(start_time, end_time, fixation_startS, fixation_stopS),
+        'agent': agents[session_codes]},
+        columns=LABELLED_FIXATION_COLUMNS)
+    for column in ['start_idx', 'end_idx']:
+        if column in fixations.columns:
+            labelled_fixations[column] = fixations[column].to_numpy(dtype=np.int64)
+    return event_tables.to_categorical_columns(labelled_fixations)
+
+
+def get_padded_run_times(session_infos):
+    """
+    Stacks the run start and stop times of sessions into NaN padded arrays.
+    Parameters:
+    - session_infos (list): Session meta info dicts.
+    Returns:
+    - startS, stopS (np.ndarray): (n_sessions, max_runs) arrays.
+    """
+    run_times = [(np.asarray(info.get('startS', []), dtype=float).ravel(),
+                  np.asarray(info.get('stopS', []), dtype=float).ravel())
+                 for info in session_infos]
+    max_runs = max([len(starts) for starts, _ in run_times], default=0)
+    startS = np.full((len(run_times), max_runs), np.nan)
+    stopS = np.full((len(run_times), max_runs), np.nan)
+    for i, (starts, stops) in enumerate(run_times):
+        startS[i, :len(starts)] = starts
+        stopS[i, :len(stops)] = stops
+    return startS, stopS
 
 
 def save_fixation_and_saccade_results(processed_data_dir, all_fix_timepos, fix_detection_results, saccade_detection_results, params):
@@ -209,53 +323,97 @@ def save_fixation_and_saccade_results(processed_data_dir, all_fix_timepos, fix_d
     - saccade_detection_results (list): List of saccade detection results.
     - params (dict): Dictionary of parameters.
     """
-    flag_info = util.get_filename_flag_info(params)
-    timepos_file_name = f'fix_timepos_m1{flag_info}.csv'
-    all_fix_timepos.to_csv(os.path.join(processed_data_dir, timepos_file_name), index=False)
+    save_event_table(all_fix_timepos, 'fix_timepos_m1', params)
     # Save the fixation and saccade detection results using pickle or similar method
 
 
-def format_saccades(saccadetimes, positions, info):
+def save_event_table(table, table_name, params):
     """
-    Formats the saccade times into a list of saccade details.
+    Saves an event table in the format set by params['event_table_format']:
+    'parquet' (default, falls back to CSV without pyarrow) or 'csv'.
     Parameters:
-    - saccadetimes (array): Array of saccade times.
+    - table (pd.DataFrame): Event table.
+    - table_name (str): Base name of the file, e.g. 'fix_timepos_m1'.
+    - params (dict): Dictionary of parameters.
+    """
+    processed_data_dir = params['processed_data_dir']
+    table_format = params.get('event_table_format', 'parquet')
+    if table_format == 'parquet' and event_tables.is_parquet_available():
+        file_path = event_tables.get_event_table_path(
+            processed_data_dir, table_name, params)
+        event_tables.save_event_table(table, file_path)
+    else:
+        flag_info = util.get_filename_flag_info(params)
+        file_path = os.path.join(processed_data_dir, f'{table_name}{flag_info}.csv')
+        table.to_csv(file_path, index=False)
+    print(f"{table_name} saved to {file_path}")
+
+
+def save_fixation_labels(labelled_fixations, params):
+    """
+    Saves the labelled fixations table, and the fixation counts table the
+    proportion and dwell plots are drawn from.
+    Parameters:
+    - labelled_fixations (pd.DataFrame): DataFrame of labelled fixations.
+    - params (dict): Dictionary of parameters.
+    """
+    save_event_table(labelled_fixations, 'fixation_labels_m1', params)
+    save_event_table(fixation_counts.compute_fixation_counts(labelled_fixations),
+                     'fixation_counts_m1', params)
+
+
+def save_saccade_labels(labelled_saccades, params):
+    """
+    Saves the labelled saccades table. The trajectories are not stored; they
+    are sliced out of the session gaze by start_idx and end_idx, see
+    SaccadeTable.
+    Parameters:
+    - labelled_saccades (pd.DataFrame): DataFrame of labelled saccades.
+    - params (dict): Dictionary of parameters.
+    """
+    save_event_table(labelled_saccades, 'labelled_saccades', params)
+
+
+def format_saccades(saccadetimes, positions, info, clock=None):
+    """
+    Formats the saccade sample ranges into a list of saccade details.
+    Parameters:
+    - saccadetimes (array): (2, n_saccades) array of saccade start and end
+    samples.
     - positions (array): Array of gaze positions.
     - info (dict): Dictionary of session information.
+    - clock (timebase.SampleClock): Time base of the samples; built from the
+    session sampling rate if None.
     Returns:
-    - saccades (list): List of saccade details.
+    - saccades (list): List of saccade rows ordered as
+    saccade_table.SACCADE_COLUMNS.
     """
-    saccades = []
-    for t_range in saccadetimes.T:
-        start_time = t_range[0]
-        end_time = t_range[1]
-        duration = end_time - start_time
-        trajectory = positions[start_time:end_time + 1, :]
-        start_roi = determine_roi_of_coord(trajectory[0, :2], info['roi_bb_corners'])
-        end_roi = determine_roi_of_coord(trajectory[-1, :2], info['roi_bb_corners'])
-        block = determine_block(start_time, end_time, info['startS'], info['stopS'])
-        saccades.append([start_time, end_time, duration, trajectory, start_roi, end_roi, info['session_name'], info['category'], None, block])
-    return saccades
+    if clock is None:
+        clock = timebase.SampleClock(len(positions), info['sampling_rate'])
+    sample_ranges = np.asarray(saccadetimes, dtype=np.int64).reshape(2, -1)
+    start_idx, end_idx = sample_ranges[0], sample_ranges[1]
+    start_time = clock.times(start_idx)
+    end_time = clock.times(end_idx)
+    # The trajectory is referenced by sample indices, see SaccadeTable
+    saccades = pd.DataFrame({
+        'start_time': start_time,
+        'end_time': end_time,
+        'duration': end_time - start_time,
+        'start_idx': start_idx,
+        'end_idx': end_idx,
+        'start_roi': util.determine_rois(positions[start_idx, :2], info['roi_bb_corners']),
+        'end_roi': util.determine_rois(positions[end_idx, :2], info['roi_bb_corners']),
+        'session_name': info['session_name'],
+        'category': info['category'],
+        'run': None,
+        'block': util.determine_blocks(start_time, end_time, info['startS'], info['stopS'])},
+        columns=SACCADE_COLUMNS)
+    return saccades.to_numpy(dtype=object).tolist()
 
 
 def determine_roi_of_coord(position, bbox_corners):
-    bounding_boxes = ['eye_bbox', 'face_bbox', 'left_obj_bbox', 'right_obj_bbox']
-    inside_roi = [util.is_inside_roi(position, bbox_corners[key]) for key in bounding_boxes]
-    if any(inside_roi):
-        if inside_roi[0] and inside_roi[1]:
-            return bounding_boxes[0]
-        return bounding_boxes[inside_roi.index(True)]
-    return 'out_of_roi'
+    return util.determine_rois(position, bbox_corners)[0]
 
 
 def determine_block(start_time, end_time, startS, stopS):
-    if start_time < startS[0] or end_time > stopS[-1]:
-        return 'discard'
-    for i, (run_start, run_stop) in enumerate(zip(startS, stopS), start=1):
-        if start_time >= run_start and end_time <= run_stop:
-            return 'mon_down'
-        elif i < len(startS) and end_time <= startS[i]:
-            return 'mon_up'
-    return 'discard'
-
-
+    return util.determine_blocks([start_time], [end_time], startS, stopS)[0]
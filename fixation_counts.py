@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fixation counts and durations per session, condition and ROI.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+# Columns the fixation counts are grouped by, where present in the labels
+COUNT_KEYS = ['session_name', 'category', 'agent', 'block', 'run', 'fix_roi']
+
+
+def compute_fixation_counts(labelled_fixations):
+    """
+    Aggregates labelled fixations into the number and total duration of
+    fixations per session, category, agent, block, run and ROI, in one
+    groupby pass.
+    Parameters:
+    - labelled_fixations (pd.DataFrame): DataFrame of labelled fixations.
+    Returns:
+    - fixation_counts (pd.DataFrame): One row per group with 'n_fixations'
+    and 'total_duration' columns.
+    """
+    keys = [key for key in COUNT_KEYS if key in labelled_fixations.columns]
+    durations = labelled_fixations['fix_duration'] if 'fix_duration' in labelled_fixations.columns \
+        else labelled_fixations['end_time'] - labelled_fixations['start_time']
+    grouped = durations.astype(float).groupby(
+        [labelled_fixations[key] for key in keys], observed=True, dropna=False, sort=True)
+    fixation_counts = pd.DataFrame({'n_fixations': grouped.size(),
+                                    'total_duration': grouped.sum()}).reset_index()
+    fixation_counts['n_fixations'] = fixation_counts['n_fixations'].astype(np.int64)
+    return fixation_counts
+
+
+def compute_roi_fractions(fixation_counts, by, rois, value='n_fixations'):
+    """
+    Computes the fraction of fixations, or of fixation time, on each ROI
+    within groups of the counts table.
+    Parameters:
+    - fixation_counts (pd.DataFrame): Output of compute_fixation_counts.
+    - by (list): Columns defining the groups, e.g. ['agent', 'block'].
+    - rois (list): ROIs to report; fixations on other ROIs count towards the
+    group total.
+    - value (str): 'n_fixations' for proportions of fixations,
+    'total_duration' for proportions of dwell time.
+    Returns:
+    - fractions (pd.DataFrame): Groups as index, ROIs as columns.
+    """
+    totals = fixation_counts.pivot_table(
+        index=by, columns='fix_roi', values=value, aggfunc='sum',
+        fill_value=0, observed=True)
+    fractions = totals.div(totals.sum(axis=1), axis=0)
+    return fractions.reindex(columns=rois, fill_value=0.0)
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-session gaze heatmaps binned by run window, cached on disk.
+"""
+
+import os
+import logging
+from collections import defaultdict
+
+import numpy as np
+from tqdm import tqdm
+
+import defaults
+import artifact_cache
+import session_manifest
+
+
+# Default edge length of a heatmap bin in pixels
+GRID_BIN_PX = 20
+
+# Blocks of the cube windows: a run, and the interval before the next run
+WINDOW_BLOCKS = ['mon_down', 'mon_up']
+
+# Session files and params the binned gaze and run windows are derived from
+CUBE_SOURCE_KINDS = ['M1_gaze', 'runs']
+GAZE_PARAM_KEYS = ['remap_source_coord_from_inverted_to_standard_y_axis',
+                   'map_gaze_pos_coord_to_eyelink_space']
+
+
+def get_screen_grid(monitor_info=None, bin_px=GRID_BIN_PX):
+    """
+    Returns the fixed screen-space bin edges shared by all sessions, so that
+    their counts can be summed.
+    Parameters:
+    - monitor_info (dict): Monitor info; defaults.fetch_monitor_info() if None.
+    - bin_px (float): Edge length of a bin in pixels.
+    Returns:
+    - xedges, yedges (np.ndarray): Bin edges.
+    """
+    if monitor_info is None:
+        monitor_info = defaults.fetch_monitor_info()
+    n_x = int(np.ceil(monitor_info['horizontal_resolution'] / bin_px))
+    n_y = int(np.ceil(monitor_info['vertical_resolution'] / bin_px))
+    return np.arange(n_x + 1) * float(bin_px), np.arange(n_y + 1) * float(bin_px)
+
+
+def get_session_windows(session_info, n_samples):
+    """
+    Splits a session into run windows (mon_down) and the windows between
+    consecutive runs (mon_up), as sample index ranges. Samples before the
+    first and after the last run are discarded, like in the fixation labels.
+    Parameters:
+    - session_info (dict): Session meta info with startS, stopS and
+    sampling_rate (seconds per sample).
+    - n_samples (int): Number of gaze samples of the session.
+    Returns:
+    - windows (dict): 'start_idx', 'stop_idx', 'run' and 'block' arrays, one
+    entry per window in time order.
+    """
+    sampling_rate = session_info['sampling_rate']
+    starts = np.round(np.asarray(session_info['startS'], dtype=float) / sampling_rate).astype(np.int64)
+    stops = np.round(np.asarray(session_info['stopS'], dtype=float) / sampling_rate).astype(np.int64)
+    n_runs = len(starts)
+    # Interleave run starts and stops; window w spans boundaries w and w + 1
+    boundaries = np.empty(2 * n_runs, dtype=np.int64)
+    boundaries[0::2] = starts
+    boundaries[1::2] = stops
+    boundaries = np.clip(np.maximum.accumulate(boundaries), 0, n_samples)
+    window = np.arange(max(2 * n_runs - 1, 0))
+    return {'start_idx': boundaries[:-1], 'stop_idx': boundaries[1:],
+            'run': window // 2,
+            'block': np.array(WINDOW_BLOCKS, dtype=object)[window % 2]}
+
+
+def compute_session_cube(gaze_positions, session_info, xedges, yedges):
+    """
+    Bins the gaze of a session on a fixed grid, separately for each run and
+    inter-run window. Samples are binned in one pass over the run span,
+    without copying the windows out of the gaze array.
+    Parameters:
+    - gaze_positions (np.ndarray): (n_samples, 2) gaze positions.
+    - session_info (dict): Session meta info.
+    - xedges, yedges (np.ndarray): Bin edges, see get_screen_grid.
+    Returns:
+    - cube (dict): 'counts' (n_windows, n_x, n_y) array, the window arrays of
+    get_session_windows, per-window sample totals and the bin edges.
+    """
+    gaze_positions = np.asarray(gaze_positions)
+    windows = get_session_windows(session_info, len(gaze_positions))
+    n_x, n_y = len(xedges) - 1, len(yedges) - 1
+    n_windows = len(windows['run'])
+    counts = np.zeros((n_windows, n_x, n_y), dtype=np.int32)
+    n_out_of_grid = np.zeros(n_windows, dtype=np.int64)
+    if n_windows > 0:
+        span = slice(windows['start_idx'][0], windows['stop_idx'][-1])
+        x = gaze_positions[span, 0]
+        y = gaze_positions[span, 1]
+        # Uniform grids let the bin be computed instead of searched
+        ix = np.floor((x - xedges[0]) / (xedges[1] - xedges[0]))
+        iy = np.floor((y - yedges[0]) / (yedges[1] - yedges[0]))
+        # The last edge is inclusive, as in np.histogram2d
+        ix[x == xedges[-1]] = n_x - 1
+        iy[y == yedges[-1]] = n_y - 1
+        in_grid = (ix >= 0) & (ix < n_x) & (iy >= 0) & (iy < n_y)
+        window_of_sample = np.repeat(np.arange(n_windows),
+                                     windows['stop_idx'] - windows['start_idx'])
+        flat = (window_of_sample[in_grid] * n_x + ix[in_grid].astype(np.int64)) * n_y \
+            + iy[in_grid].astype(np.int64)
+        counts = np.bincount(flat, minlength=n_windows * n_x * n_y) \
+            .reshape(n_windows, n_x, n_y).astype(np.int32)
+        n_out_of_grid = np.bincount(window_of_sample[~in_grid], minlength=n_windows)
+    return {'counts': counts, 'xedges': np.asarray(xedges, dtype=float),
+            'yedges': np.asarray(yedges, dtype=float),
+            'start_idx': windows['start_idx'], 'stop_idx': windows['stop_idx'],
+            'run': windows['run'], 'block': windows['block'].astype(str),
+            'n_out_of_grid': n_out_of_grid}
+
+
+def get_cube_dir(params):
+    return params.get('gaze_heatmap_cube_dir') or os.path.join(
+        params['processed_data_dir'], 'gaze_heatmap_cubes')
+
+
+def get_cube_path(params, session_name):
+    return os.path.join(get_cube_dir(params), f'{session_name}.npz')
+
+
+def save_session_cube(cube, file_path, input_hash=None):
+    tmp_path = file_path + '.tmp.npz'
+    np.savez_compressed(tmp_path, input_hash=np.array(input_hash or ''), **cube)
+    os.replace(tmp_path, file_path)
+
+
+def load_session_cube(file_path):
+    """
+    Loads a session cube saved by save_session_cube.
+    Returns:
+    - cube (dict): See compute_session_cube; 'input_hash' holds the hash of
+    the inputs the cube was computed from.
+    """
+    with np.load(file_path, allow_pickle=False) as data:
+        cube = {key: data[key] for key in data.files}
+    cube['input_hash'] = str(cube['input_hash'])
+    return cube
+
+
+def get_cube_input_hash(session_name, params, xedges, yedges,
+                        gaze_positions=None, session_info=None):
+    """
+    Hashes what the cube of a session is computed from. For sessions in
+    params['session_paths'] these are the sizes and mtimes of the session's
+    gaze and runs files and the gaze params, so the check does not need the
+    gaze; other sessions are hashed by their gaze and runs, if given.
+    Returns:
+    - input_hash (str or None): None if the inputs cannot be hashed.
+    """
+    session_paths = {os.path.basename(os.path.normpath(path)): path
+                     for path in params.get('session_paths') or []}
+    if session_name in session_paths:
+        return artifact_cache.compute_input_hash(
+            session_manifest.get_session_file_mtimes(session_paths[session_name], CUBE_SOURCE_KINDS),
+            [params.get(key) for key in GAZE_PARAM_KEYS], xedges, yedges)
+    if gaze_positions is None:
+        return None
+    return artifact_cache.compute_input_hash(
+        np.asarray(gaze_positions), np.asarray(session_info['startS'], dtype=float),
+        np.asarray(session_info['stopS'], dtype=float),
+        float(session_info['sampling_rate']), xedges, yedges)
+
+
+def is_cube_fresh(file_path, input_hash, params):
+    # Reads only the stored hash, not the counts
+    if input_hash is None or not os.path.exists(file_path) \
+            or params.get('remake_gaze_heatmap_cubes', False):
+        return False
+    try:
+        with np.load(file_path, allow_pickle=False) as data:
+            return str(data['input_hash']) == input_hash
+    except Exception as e:
+        logging.warning(f"Could not read heatmap cube {file_path}: {e}")
+        return False
+
+
+def get_or_build_session_cube(gaze_positions, session_info, params):
+    """
+    Loads the cube of a session, or computes and saves it if the gaze, runs
+    or grid changed since it was saved.
+    Parameters:
+    - gaze_positions (np.ndarray): (n_samples, 2) gaze positions.
+    - session_info (dict): Session meta info.
+    - params (dict): Dictionary containing the processed data directory and
+    optionally 'session_paths', 'heatmap_bin_px' and 'monitor_info'.
+    Returns:
+    - cube (dict): See compute_session_cube.
+    """
+    xedges, yedges = get_screen_grid(
+        params.get('monitor_info'), params.get('heatmap_bin_px', GRID_BIN_PX))
+    session_name = session_info['session_name']
+    input_hash = get_cube_input_hash(
+        session_name, params, xedges, yedges, gaze_positions, session_info)
+    file_path = get_cube_path(params, session_name)
+    if is_cube_fresh(file_path, input_hash, params):
+        try:
+            return load_session_cube(file_path)
+        except Exception as e:
+            logging.warning(f"Could not load heatmap cube {file_path}: {e}")
+    cube = compute_session_cube(gaze_positions, session_info, xedges, yedges)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    save_session_cube(cube, file_path, input_hash)
+    cube['input_hash'] = input_hash
+    return cube
+
+
+def build_session_cubes(labelled_gaze_positions, params):
+    """
+    Computes the heatmap cubes of the sessions whose cube is missing or
+    stale; up-to-date cubes are only checked, not loaded.
+    Parameters:
+    - labelled_gaze_positions (list): List of (gaze_positions, session_info)
+    tuples.
+    - params (dict): Dictionary of parameters.
+    Returns:
+    - built_sessions (list): Names of the sessions whose cube was computed.
+    """
+    xedges, yedges = get_screen_grid(
+        params.get('monitor_info'), params.get('heatmap_bin_px', GRID_BIN_PX))
+    built_sessions = []
+    for gaze_positions, session_info in labelled_gaze_positions:
+        session_name = session_info['session_name']
+        input_hash = get_cube_input_hash(
+            session_name, params, xedges, yedges, gaze_positions, session_info)
+        if is_cube_fresh(get_cube_path(params, session_name), input_hash, params):
+            continue
+        get_or_build_session_cube(gaze_positions, session_info, params)
+        built_sessions.append(session_name)
+    if built_sessions:
+        logging.info(f"Built heatmap cubes of {len(built_sessions)} of {len(labelled_gaze_positions)} sessions")
+    return built_sessions
+
+
+def load_session_cubes(session_names, params, load_gaze_positions=None):
+    """
+    Loads the cached cubes of sessions by name. Gaze is only loaded, with
+    load_gaze_positions, if some cube is missing or stale.
+    Parameters:
+    - session_names (list): Names of the sessions.
+    - params (dict): Dictionary of parameters.
+    - load_gaze_positions (callable): Optional; takes params and returns the
+    list of (gaze_positions, session_info) tuples, e.g.
+    load_data.load_labelled_gaze_positions.
+    Returns:
+    - cubes (dict): Session name -> cube, for the sessions a cube was found
+    or built for.
+    """
+    xedges, yedges = get_screen_grid(
+        params.get('monitor_info'), params.get('heatmap_bin_px', GRID_BIN_PX))
+    cubes = {}
+    missing = set()
+    for session_name in session_names:
+        file_path = get_cube_path(params, session_name)
+        if is_cube_fresh(file_path, get_cube_input_hash(session_name, params, xedges, yedges), params):
+            cubes[session_name] = load_session_cube(file_path)
+        else:
+            missing.add(session_name)
+    if missing and load_gaze_positions is not None:
+        logging.info(f"Building {len(missing)} missing or stale heatmap cubes")
+        for gaze_positions, session_info in tqdm(
+                load_gaze_positions(params), desc="Binning gaze heatmap cubes"):
+            if session_info['session_name'] in missing:
+                cubes[session_info['session_name']] = get_or_build_session_cube(
+                    gaze_positions, session_info, params)
+    elif missing:
+        logging.warning(f"No heatmap cubes for {len(missing)} sessions: {sorted(missing)}")
+    return cubes
+
+
+def sum_cube(cube, blocks=None, runs=None):
+    """
+    Sums the windows of a cube into one heatmap.
+    Parameters:
+    - cube (dict): Session cube.
+    - blocks (list): Blocks to include; all if None.
+    - runs (list): Runs to include; all if None.
+    Returns:
+    - heatmap (np.ndarray): (n_x, n_y) counts.
+    """
+    keep = np.ones(len(cube['run']), dtype=bool)
+    if blocks is not None:
+        keep &= np.isin(cube['block'], blocks)
+    if runs is not None:
+        keep &= np.isin(cube['run'], runs)
+    return cube['counts'][keep].sum(axis=0, dtype=np.int64)
+
+
+def aggregate_cubes(cubes, session_infos, group_by=('category',), blocks=None):
+    """
+    Sums session heatmaps into condition-level heatmaps, e.g. per category,
+    dose or monkey, and optionally per block.
+    Parameters:
+    - cubes (dict): Session name -> cube, all on the same grid.
+    - session_infos (dict): Session name -> session meta info.
+    - group_by (tuple): Meta info keys to group sessions by; 'block' splits
+    each group by block.
+    - blocks (list): Blocks to include; all if None.
+    Returns:
+    - heatmaps (dict): Group key tuple -> (n_x, n_y) counts.
+    """
+    heatmaps = defaultdict(lambda: 0)
+    split_blocks = 'block' in group_by
+    for session_name, cube in cubes.items():
+        session_info = session_infos[session_name]
+        for block in (blocks or WINDOW_BLOCKS) if split_blocks else [None]:
+            key = tuple(block if field == 'block' else session_info.get(field)
+                        for field in group_by)
+            heatmaps[key] = heatmaps[key] + sum_cube(
+                cube, blocks=[block] if split_blocks else blocks)
+    return dict(heatmaps)
@@ -7,70 +7,86 @@ Created on Thu Jun 13 10:57:11 2024
 """
 
 import os
-import subprocess
-import logging
-import time
+import json
 
-import pdb
+import job_executor
+from resource_estimator import ResourceEstimator
 
 class HPCCluster:
     def __init__(self, params):
         self.params = params
-        self.output_dir = '/gpfs/milgram/pi/chang/pg496/repositories/social_gaze_mech_otnal/job_scripts/'
+        self.output_dir = params.get('job_script_out_dir', './job_scripts/')
+        self.executor = job_executor.get_job_executor(
+            params, 'joblist_raster', 'raster_session',
+            partition='psych_day', cpus_per_task=8, mem_per_cpu='6g',
+            time_limit='02:00:00')
 
-    def generate_job_file(self, session_paths):
-        job_file_path = os.path.join(self.output_dir, 'raster_joblist.txt')
+    def serialize_params(self, filepath):
+        # Arrays and callables in params (e.g. meta info) are not JSON
+        # serializable; the raster jobs only need the scalar settings
+        def to_json(value):
+            if hasattr(value, 'tolist'):
+                return value.tolist()
+            return repr(value)
+        with open(filepath, 'w') as f:
+            json.dump(self.params, f, default=to_json)
+
+    def generate_job_file(self, session_paths, tag=''):
+        """
+        Writes one job per entry of session_paths, which is a session path or
+        a list of session paths processed in order by one task. The params of
+        the driver are passed to the jobs in a JSON file.
+        """
+        job_file_path = os.path.join(self.output_dir, f'raster_joblist{tag}.txt')
         os.makedirs(self.output_dir, exist_ok=True)
+        params_file_path = os.path.join(self.params['processed_data_dir'], 'raster_params.json')
+        self.serialize_params(params_file_path)
         with open(job_file_path, 'w') as file:
-            for session_path in session_paths:
-                command = f"module load miniconda; conda init bash; conda activate nn_gpu; python process_session_raster.py --session {session_path}"
+            for task_paths in session_paths:
+                if isinstance(task_paths, str):
+                    task_paths = [task_paths]
+                command = self.executor.format_command(
+                    f"python process_session_raster.py --session {' '.join(task_paths)} "
+                    f"--params_file {params_file_path}")
                 file.write(command + "\n")
         return job_file_path
 
-    def submit_job_array(self, job_file_path):
-        try:
-            job_script_path = os.path.join(self.output_dir, 'dsq-joblist_raster.sh')
-            subprocess.run(
-                f'module load dSQ; dsq --job-file {job_file_path} --batch-file {job_script_path} -o {self.output_dir} --status-dir {self.output_dir} --partition psych_day --cpus-per-task 8 --mem-per-cpu 6g -t 02:00:00 --mail-type FAIL',
-                shell=True, check=True, executable='/bin/bash'
-            )
-            logging.info("Successfully generated the dSQ job script")
-            if not os.path.isfile(job_script_path):
-                logging.error(f"No job script found at {job_script_path}.")
-                return
-            logging.info(f"Using dSQ job script: {job_script_path}")
-            result = subprocess.run(
-                f'sbatch --output={self.output_dir}/raster_session_%a.out --error={self.output_dir}/raster_session_%a.err {job_script_path}',
-                shell=True, check=True, capture_output=True, text=True, executable='/bin/bash'
-            )
-            logging.info(f"Successfully submitted jobs using sbatch for script {job_script_path}")
-            job_id = result.stdout.strip().split()[-1]
-            logging.info(f"Submitted job array with ID: {job_id}")
-            self.track_job_progress(job_id)
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Error during job submission process: {e}")
-            raise
+    def submit_job_array(self, job_file_path, wait=True):
+        if wait:
+            return self.executor.run_job_array(job_file_path)
+        return self.executor.submit_job_array(job_file_path)
+
+    def iter_completed_tasks(self, job_id, expected_outputs=None):
+        return self.executor.iter_completed_tasks(job_id, expected_outputs)
 
     def track_job_progress(self, job_id):
-        logging.info(f"Tracking progress of job array with ID: {job_id}")
-        while True:
-            result = subprocess.run(
-                f'squeue --job {job_id} -h -o %T',
-                shell=True, capture_output=True, text=True, executable='/bin/bash'
-            )
-            if result.returncode != 0:
-                logging.error(f"Error checking job status for job ID {job_id}: {result.stderr.strip()}")
-                break
-            job_statuses = result.stdout.strip().split()
-            if not job_statuses:
-                logging.info(f"Job array {job_id} has completed.")
-                break
-            running_jobs = [status for status in job_statuses if status in ('PENDING', 'RUNNING', 'CONFIGURING')]
-            if not running_jobs:
-                logging.info(f"Job array {job_id} has completed.")
-                break
-            else:
-                logging.info(f"Job array {job_id} is still running. Checking again in 30 seconds...")
-                time.sleep(30)
+        self.executor.wait(job_id)
+
+    def run_sessions(self, session_paths, session_files, load_output, session_sizes=None):
+        """
+        Makes the rasters of all sessions, resubmitting failed ones. With
+        session sizes and params['size_job_resources'] the tasks are sized
+        and packed by session.
+        Parameters:
+        - session_paths (list): List of session paths.
+        - session_files (dict): Session index -> expected output file.
+        - load_output (callable): Loads one output file.
+        - session_sizes (list): Optional raster size (fixations x units) of
+        each session.
+        Returns:
+        - results (dict): Session index -> loaded output.
+        """
+        plan_tasks = None
+        if session_sizes is not None and self.params.get('size_job_resources', True):
+            estimator = ResourceEstimator(
+                self.params, self.executor.job_name, self.executor.cpus_per_task,
+                self.executor.mem_per_cpu, self.executor.time_limit)
+            plan_tasks = lambda keys: estimator.plan_tasks(
+                {i: session_sizes[i] for i in keys})
+        return job_executor.run_job_array_with_retries(
+            self.executor,
+            lambda tasks, tag: self.generate_job_file(
+                [[session_paths[i] for i in task] for task in tasks], tag),
+            session_files, load_output, self.params, plan_tasks)
 
 
@@ -7,24 +7,40 @@ Author: pg496
 """
 
 import os
-import subprocess
 import logging
-import time
-import pickle
 import json
 
+import job_executor
+from resource_estimator import ResourceEstimator
+
 
 class HPCFixationDetection:
     def __init__(self, params):
         self.params = params
-        self.job_script_out_dir = './job_scripts/'
+        self.job_script_out_dir = params.get('job_script_out_dir', './job_scripts/')
+        self.executor = job_executor.get_job_executor(
+            params, 'joblist_fixations', 'fixation_session',
+            partition='psych_day', cpus_per_task=4, mem_per_cpu='1g',
+            time_limit='06:00:00')
 
     def serialize_params(self, filepath):
+        # Arrays and callables in params (e.g. meta info, smooth_func) are not
+        # JSON serializable; the session jobs only need the scalar settings
+        def to_json(value):
+            if hasattr(value, 'tolist'):
+                return value.tolist()
+            return repr(value)
         with open(filepath, 'w') as f:
-            json.dump(self.params, f)
+            json.dump(self.params, f, default=to_json)
 
-    def generate_fixation_job_file(self, labelled_gaze_positions):
-        job_file_path = os.path.join(self.job_script_out_dir, 'fixation_joblist.txt')
+    def generate_fixation_job_file(self, labelled_gaze_positions, tasks=None, tag=''):
+        """
+        Writes one job per task, each a list of session indices processed in
+        order; one session per task for all sessions if tasks is None.
+        """
+        if tasks is None:
+            tasks = [[idx] for idx in range(len(labelled_gaze_positions))]
+        job_file_path = os.path.join(self.job_script_out_dir, f'fixation_joblist{tag}.txt')
         os.makedirs(self.job_script_out_dir, exist_ok=True)
 
         # Use params['processed_data_dir'] for saving the parameters
@@ -32,12 +48,10 @@ class HPCFixationDetection:
         self.serialize_params(params_file_path)
         
         with open(job_file_path, 'w') as file:
-            for idx in range(len(labelled_gaze_positions)):
-                command = (
-                    "module load miniconda; "
-                    "conda init bash; "
-                    "conda activate nn_gpu; "
-                    f"python process_session_fixations.py --session_index {idx} --params_file {params_file_path}"
+            for task in tasks:
+                session_indices = ' '.join(str(idx) for idx in task)
+                command = self.executor.format_command(
+                    f"python process_session_fixations.py --session_index {session_indices} --params_file {params_file_path}"
                 )
                 file.write(command + "\n")
                 
@@ -50,50 +64,39 @@ class HPCFixationDetection:
                 
         return job_file_path
 
-    def submit_job_array(self, job_file_path):
-        try:
-            job_script_path = os.path.join(self.job_script_out_dir, 'dsq-joblist_fixations.sh')
-            subprocess.run(
-                f'module load dSQ; dsq --job-file {job_file_path} --batch-file {job_script_path} -o {self.job_script_out_dir} --status-dir {self.job_script_out_dir} --partition psych_day --cpus-per-task 4 --mem-per-cpu 1g -t 06:00:00 --mail-type FAIL',
-                shell=True, check=True, executable='/bin/bash'
-            )
-            logging.info("Successfully generated the dSQ job script")
-            if not os.path.isfile(job_script_path):
-                logging.error(f"No job script found at {job_script_path}.")
-                return
-            logging.info(f"Using dSQ job script: {job_script_path}")
-            
-            result = subprocess.run(
-                f'sbatch --job-name=fixation_jobs_dsq --output={self.job_script_out_dir}/fixation_session_%a.out --error={self.job_script_out_dir}/fixation_session_%a.err {job_script_path}',
-                shell=True, check=True, capture_output=True, text=True, executable='/bin/bash'
-            )
-            logging.info(f"Successfully submitted jobs using sbatch for script {job_script_path}")
-            job_id = result.stdout.strip().split()[-1]
-            logging.info(f"Submitted job array with ID: {job_id}")
-            self.track_job_progress(job_id)
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Error during job submission process: {e}")
-            raise
+    def submit_job_array(self, job_file_path, wait=True):
+        if wait:
+            return self.executor.run_job_array(job_file_path)
+        return self.executor.submit_job_array(job_file_path)
+
+    def iter_completed_tasks(self, job_id, expected_outputs=None):
+        return self.executor.iter_completed_tasks(job_id, expected_outputs)
 
     def track_job_progress(self, job_id):
-        logging.info(f"Tracking progress of job array with ID: {job_id}")
-        while True:
-            result = subprocess.run(
-                f'squeue --job {job_id} -h -o %T',
-                shell=True, capture_output=True, text=True, executable='/bin/bash'
-            )
-            if result.returncode != 0:
-                logging.error(f"Error checking job status for job ID {job_id}: {result.stderr.strip()}")
-                break
-            job_statuses = result.stdout.strip().split()
-            if not job_statuses:
-                logging.info(f"Job array {job_id} has completed.")
-                break
-            running_jobs = [status for status in ('PENDING', 'RUNNING', 'CONFIGURING') if status in job_statuses]
-            if not running_jobs:
-                logging.info(f"Job array {job_id} has completed.")
-                break
-            else:
-                logging.info(f"Job array {job_id} is still running. Checking again in 30 seconds...")
-                time.sleep(30)
+        self.executor.wait(job_id)
+
+    def run_sessions(self, labelled_gaze_positions, session_files, load_output):
+        """
+        Runs fixation detection for all sessions, resubmitting failed ones.
+        With params['size_job_resources'] the tasks are sized and packed by
+        the number of gaze samples of each session.
+        Parameters:
+        - labelled_gaze_positions (list): List of (positions, info) tuples.
+        - session_files (dict): Session index -> expected output file.
+        - load_output (callable): Loads one output file.
+        Returns:
+        - results (dict): Session index -> loaded output.
+        """
+        plan_tasks = None
+        if self.params.get('size_job_resources', True):
+            estimator = ResourceEstimator(
+                self.params, self.executor.job_name, self.executor.cpus_per_task,
+                self.executor.mem_per_cpu, self.executor.time_limit)
+            plan_tasks = lambda keys: estimator.plan_tasks(
+                {idx: len(labelled_gaze_positions[idx][0]) for idx in keys})
+        return job_executor.run_job_array_with_retries(
+            self.executor,
+            lambda tasks, tag: self.generate_fixation_job_file(
+                labelled_gaze_positions, tasks, tag),
+            session_files, load_output, self.params, plan_tasks)
 
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-stage timing and memory records of pipeline runs.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import atexit
+import argparse
+import resource
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+
+
+# Environment variables carrying the run log to worker processes and jobs
+RUN_LOG_PATH_ENV = 'NN_GAZE_RUN_LOG'
+RUN_ID_ENV = 'NN_GAZE_RUN_ID'
+
+# Records not written yet, and whether the calling thread is inside a stage
+_current_session = contextvars.ContextVar('current_session', default=None)
+_write_lock = threading.Lock()
+_pending_records = []
+_stage_depth = threading.local()
+
+
+def configure_run_log(params):
+    """
+    Sets the run log that stage records are appended to, for this process and
+    the processes it starts. Defaults to run_log.jsonl in the processed data
+    directory; set params['run_log_path'] to override and
+    params['instrument_stages'] to False to disable recording.
+    Parameters:
+    - params (dict): Dictionary of parameters.
+    Returns:
+    - run_log_path (str or None): Path of the run log.
+    """
+    if not params.get('instrument_stages', True):
+        os.environ.pop(RUN_LOG_PATH_ENV, None)
+        return None
+    run_log_path = params.get('run_log_path') or os.path.join(
+        params['processed_data_dir'], 'run_log.jsonl')
+    os.environ[RUN_LOG_PATH_ENV] = run_log_path
+    # Jobs submitted by this run inherit its id through the environment
+    os.environ.setdefault(RUN_ID_ENV, datetime.now().strftime('%Y%m%d_%H%M%S'))
+    return run_log_path
+
+
+def get_run_log_path():
+    return os.environ.get(RUN_LOG_PATH_ENV)
+
+
+@contextmanager
+def session_scope(session_name):
+    """
+    Attributes the stages run inside the block to a session.
+    """
+    token = _current_session.set(session_name)
+    try:
+        yield
+    finally:
+        _current_session.reset(token)
+
+
+def _get_cpu_s():
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def _get_peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def write_record(record):
+    """
+    Buffers a record for the run log; records are written together when the
+    outermost stage of a thread ends, see flush_run_log.
+    """
+    if get_run_log_path() is None:
+        return
+    with _write_lock:
+        _pending_records.append(record)
+
+
+def flush_run_log():
+    """
+    Appends the buffered records to the run log in a single write.
+    """
+    run_log_path = get_run_log_path()
+    with _write_lock:
+        records = list(_pending_records)
+        _pending_records.clear()
+        if run_log_path is None or not records:
+            return
+        lines = ''.join(json.dumps(record, default=str) + '\n' for record in records)
+        with open(run_log_path, 'a') as f:
+            f.write(lines)
+
+
+atexit.register(flush_run_log)
+
+
+@contextmanager
+def stage_timer(stage, session=None, n_items=None):
+    """
+    Records the wall time, CPU time, peak RSS and item count of a block of
+    code as one line of the run log. Meant for session- or stage-level
+    blocks; records are flushed to the log when the outermost stage of the
+    thread ends, so nested stages do not touch the file. CPU time includes finished child
+    processes and, for stages run in threads, the other threads of the
+    process. Peak RSS is the process high-water mark at the end of the stage;
+    rss_growth_mb is how much the stage raised it.
+    Parameters:
+    - stage (str): Name of the stage.
+    - session (str): Session the stage belongs to; defaults to the enclosing
+    session_scope.
+    - n_items (int): Number of items processed; can also be set on the
+    yielded record as record['n_items'].
+    Yields:
+    - record (dict): The record that is written when the block exits.
+    """
+    record = {'stage': stage,
+              'session': session if session is not None else _current_session.get(),
+              'n_items': n_items}
+    if get_run_log_path() is None:
+        yield record
+        return
+    start_rss = _get_peak_rss_mb()
+    start_cpu = _get_cpu_s()
+    start = time.perf_counter()
+    start_time = time.time()
+    status = 'ok'
+    _stage_depth.value = getattr(_stage_depth, 'value', 0) + 1
+    try:
+        yield record
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        _stage_depth.value -= 1
+        peak_rss = _get_peak_rss_mb()
+        record.update({
+            'run_id': os.environ.get(RUN_ID_ENV),
+            'status': status,
+            'start_time': start_time,
+            'wall_s': time.perf_counter() - start,
+            'cpu_s': _get_cpu_s() - start_cpu,
+            'peak_rss_mb': peak_rss,
+            'rss_growth_mb': peak_rss - start_rss,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'job_id': os.environ.get('SLURM_ARRAY_JOB_ID'),
+            'task_id': os.environ.get('SLURM_ARRAY_TASK_ID')})
+        write_record(record)
+        if _stage_depth.value == 0:
+            flush_run_log()
+
+
+# Libraries whose import dominates task startup when loaded eagerly
+HEAVY_MODULES = ['scipy', 'sklearn', 'matplotlib', 'seaborn', 'matplotlib_venn',
+                 'mat73', 'h5py', 'pyarrow']
+
+
+def get_process_age_s():
+    """
+    Returns the seconds since this process was started, read from /proc, or
+    None where /proc is not available.
+    """
+    try:
+        with open('/proc/self/stat', 'r') as f:
+            # Fields after the command name, which may contain spaces; the
+            # start time is field 22 of the full line
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime', 'r') as f:
+            uptime_s = float(f.read().split()[0])
+        return uptime_s - int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def report_startup(entry_point, import_s):
+    """
+    Logs and records how long an entry point took to start: the time spent
+    importing its modules and the process age when it is ready to work,
+    which includes interpreter startup and loading the params. Call after
+    configure_run_log so that the record reaches the run log.
+    Parameters:
+    - entry_point (str): Name of the script.
+    - import_s (float): Seconds spent in the script's imports.
+    Returns:
+    - record (dict): The startup record.
+    """
+    process_age_s = get_process_age_s()
+    loaded_heavy_modules = [name for name in HEAVY_MODULES if name in sys.modules]
+    record = {'stage': f'startup.{entry_point}', 'session': None,
+              'n_items': len(sys.modules), 'run_id': os.environ.get(RUN_ID_ENV),
+              'status': 'ok', 'start_time': time.time(),
+              'wall_s': process_age_s if process_age_s is not None else import_s,
+              'import_s': import_s, 'cpu_s': time.process_time(),
+              'peak_rss_mb': _get_peak_rss_mb(), 'rss_growth_mb': None,
+              'heavy_modules': loaded_heavy_modules,
+              'host': socket.gethostname(), 'pid': os.getpid(),
+              'job_id': os.environ.get('SLURM_ARRAY_JOB_ID'),
+              'task_id': os.environ.get('SLURM_ARRAY_TASK_ID')}
+    age_str = f"{process_age_s:.2f} s" if process_age_s is not None else "unknown"
+    logging.info(f"{entry_point} started in {age_str}, {import_s:.2f} s of it importing "
+                 f"{len(sys.modules)} modules; heavy modules loaded: "
+                 f"{', '.join(loaded_heavy_modules) or 'none'}")
+    write_record(record)
+    flush_run_log()
+    return record
+
+
+def timed_stage(stage, get_session=None, count_items=None):
+    """
+    Decorator recording each call of a function as a stage, see stage_timer.
+    Parameters:
+    - stage (str): Name of the stage.
+    - get_session (callable): Optional; takes the call's arguments and
+    returns the session name.
+    - count_items (callable): Optional; takes the result followed by the
+    call's arguments and returns the number of items processed.
+    Returns:
+    - decorator (callable): The decorator.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            session = get_session(*args, **kwargs) if get_session is not None else None
+            with stage_timer(stage, session=session) as record:
+                result = func(*args, **kwargs)
+                if count_items is not None and get_run_log_path() is not None:
+                    try:
+                        record['n_items'] = count_items(result, *args, **kwargs)
+                    except Exception as e:
+                        logging.debug(f"Could not count items of stage {stage}: {e}")
+            return result
+        return wrapper
+    return decorator
+
+
+def load_run_log(run_log_path, run_id=None, stages=None):
+    """
+    Loads the stage records of a run log.
+    Parameters:
+    - run_log_path (str): Path of the run log.
+    - run_id (str): Keep only the records of this run; 'latest' for the last
+    run in the log; all runs if None.
+    - stages (list): Keep only these stages; all stages if None.
+    Returns:
+    - run_log (pd.DataFrame): One row per stage record.
+    """
+    records = []
+    with open(run_log_path, 'r') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    run_log = pd.DataFrame(records)
+    if run_log.empty:
+        return run_log
+    if run_id == 'latest':
+        run_id = run_log['run_id'].dropna().iloc[-1]
+    if run_id is not None:
+        run_log = run_log[run_log['run_id'] == run_id]
+    if stages is not None:
+        run_log = run_log[run_log['stage'].isin(stages)]
+    return run_log.reset_index(drop=True)
+
+
+def summarize_run_log(run_log, by=('stage',)):
+    """
+    Aggregates stage records, e.g. per stage or per stage and session.
+    Parameters:
+    - run_log (pd.DataFrame): Records from load_run_log.
+    - by (tuple): Columns to group by.
+    Returns:
+    - summary (pd.DataFrame): Calls, total and maximum wall time, total CPU
+    time, maximum peak RSS and total items per group, slowest first.
+    """
+    summary = run_log.groupby(list(by), dropna=False).agg(
+        calls=('wall_s', 'size'),
+        wall_s_total=('wall_s', 'sum'),
+        wall_s_max=('wall_s', 'max'),
+        cpu_s_total=('cpu_s', 'sum'),
+        peak_rss_mb_max=('peak_rss_mb', 'max'),
+        n_items_total=('n_items', 'sum'),
+        errors=('status', lambda status: int((status == 'error').sum())))
+    return summary.sort_values('wall_s_total', ascending=False).reset_index()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize the stage records of a run log.')
+    parser.add_argument('run_log_path', help='Path to the run log')
+    parser.add_argument('--run_id', default='latest', help="Run to summarize, 'latest' or 'all'")
+    parser.add_argument('--by', nargs='+', default=['stage'], help='Columns to group by, e.g. stage session')
+    args = parser.parse_args()
+    run_id = None if args.run_id == 'all' else args.run_id
+    run_log = load_run_log(args.run_log_path, run_id=run_id)
+    if run_log.empty:
+        print("No stage records found.")
+        return
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(summarize_run_log(run_log, by=args.by).to_string(index=False))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
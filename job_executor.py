@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Submission of per-session jobs to SLURM or to local processes.
+"""
+
+import os
+import sys
+import socket
+import logging
+import signal
+import subprocess
+import threading
+import time
+import queue
+from datetime import datetime
+from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+# Environment setup prepended to every command run on the cluster
+CLUSTER_ENV_SETUP = "module load miniconda; conda init bash; conda activate nn_gpu; "
+
+# Directory the per-session scripts are run from
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Started in place of a local task: pins itself to the task's cores, limits
+# its data segment and execs the task's shell command, so that nothing runs
+# between fork and exec in the submitting thread
+LOCAL_TASK_WRAPPER = """import os, sys, resource
+cpus, mem_limit, command = sys.argv[1:]
+if hasattr(os, 'sched_setaffinity'):
+    os.sched_setaffinity(0, [int(cpu) for cpu in cpus.split(',')])
+resource.setrlimit(resource.RLIMIT_DATA, (int(mem_limit), int(mem_limit)))
+os.execv('/bin/bash', ['/bin/bash', '-c', command])
+"""
+
+
+def parse_memory(mem):
+    """
+    Converts a SLURM style memory string to bytes.
+    Parameters:
+    - mem (str): Memory such as '512m', '1g' or '6G'.
+    Returns:
+    - n_bytes (int): Number of bytes.
+    """
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+    mem = str(mem).strip().lower()
+    if mem[-1] in units:
+        return int(float(mem[:-1]) * units[mem[-1]])
+    # SLURM defaults to megabytes
+    return int(float(mem) * units['m'])
+
+
+def format_memory(n_bytes):
+    """
+    Converts a number of bytes to a SLURM style memory string in megabytes.
+    """
+    return f'{int(-(-n_bytes // 1024 ** 2))}m'
+
+
+def parse_time_limit(time_limit):
+    """
+    Converts a SLURM time limit ('MM', 'HH:MM:SS' or 'D-HH:MM:SS') to seconds.
+    """
+    days = 0
+    if '-' in time_limit:
+        day_str, time_limit = time_limit.split('-', 1)
+        days = int(day_str)
+    parts = [int(p) for p in time_limit.split(':')]
+    if len(parts) == 1:
+        seconds = parts[0] * 60
+    elif len(parts) == 2:
+        seconds = parts[0] * 60 + parts[1]
+    else:
+        seconds = parts[0] * 3600 + parts[1] * 60 + parts[2]
+    return days * 24 * 3600 + seconds
+
+
+def format_time_limit(seconds):
+    """
+    Converts seconds to a SLURM 'D-HH:MM:SS' time limit.
+    """
+    seconds = int(round(seconds))
+    days, seconds = divmod(seconds, 24 * 3600)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return f'{days}-{hours:02d}:{minutes:02d}:{seconds:02d}'
+
+
+class JobExecutor:
+    """
+    Runs a dSQ style job list, one shell command per line and one array task
+    per line, with fixed per-task resources.
+    """
+    def __init__(self, job_script_out_dir, job_name, output_prefix,
+                 partition='psych_day', cpus_per_task=4, mem_per_cpu='1g',
+                 time_limit='06:00:00', poll_interval=2.0):
+        self.job_script_out_dir = job_script_out_dir
+        self.job_name = job_name
+        self.output_prefix = output_prefix
+        self.partition = partition
+        self.cpus_per_task = int(cpus_per_task)
+        self.mem_per_cpu = mem_per_cpu
+        self.time_limit = time_limit
+        self.poll_interval = poll_interval
+        self.n_tasks = {}
+        os.makedirs(self.job_script_out_dir, exist_ok=True)
+
+    def format_command(self, python_command):
+        """
+        Turns a python command into a job list line for this backend.
+        """
+        return python_command
+
+    def get_status_file_path(self, job_id):
+        return os.path.join(self.job_script_out_dir, f'job_{job_id}_status.tsv')
+
+    def get_task_output_paths(self, job_id, task_index):
+        out_path = os.path.join(
+            self.job_script_out_dir, f'{self.output_prefix}_{job_id}_{task_index}.out')
+        err_path = os.path.join(
+            self.job_script_out_dir, f'{self.output_prefix}_{job_id}_{task_index}.err')
+        return out_path, err_path
+
+    def submit_job_array(self, job_file_path):
+        """
+        Submits one task per line of the job file.
+        Returns:
+        - job_id (str): Identifier of the submitted job array.
+        """
+        raise NotImplementedError
+
+    def iter_completed_tasks(self, job_id, expected_outputs=None):
+        """
+        Yields the tasks of a job array as they finish.
+        Parameters:
+        - job_id (str): Identifier of the job array.
+        - expected_outputs (dict): Optional task index -> output file path;
+        a task also counts as finished once its output file exists.
+        Yields:
+        - (task_index, exit_code): Exit code is None if only the output file
+        was seen.
+        """
+        raise NotImplementedError
+
+    def wait(self, job_id):
+        """
+        Blocks until all tasks of the job array finished.
+        """
+        for _ in self.iter_completed_tasks(job_id):
+            pass
+
+    def run_job_array(self, job_file_path):
+        job_id = self.submit_job_array(job_file_path)
+        if job_id is not None:
+            self.wait(job_id)
+        return job_id
+
+    def set_resources(self, mem_per_cpu, time_limit):
+        """
+        Sets the per-task memory and time limit of later submissions.
+        """
+        self.mem_per_cpu = mem_per_cpu
+        self.time_limit = time_limit
+
+
+class SlurmDSQExecutor(JobExecutor):
+    """
+    Submits the job list as a dSQ job array through sbatch.
+    """
+    squeue_interval = 60
+
+    def format_command(self, python_command):
+        return CLUSTER_ENV_SETUP + python_command
+
+    def submit_job_array(self, job_file_path):
+        try:
+            job_script_path = os.path.join(self.job_script_out_dir, f'dsq-{self.job_name}.sh')
+            subprocess.run(
+                f'module load dSQ; dsq --job-file {job_file_path} --batch-file {job_script_path} -o {self.job_script_out_dir} --status-dir {self.job_script_out_dir} --partition {self.partition} --cpus-per-task {self.cpus_per_task} --mem-per-cpu {self.mem_per_cpu} -t {self.time_limit} --mail-type FAIL',
+                shell=True, check=True, executable='/bin/bash'
+            )
+            logging.info("Successfully generated the dSQ job script")
+            if not os.path.isfile(job_script_path):
+                logging.error(f"No job script found at {job_script_path}.")
+                return None
+            logging.info(f"Using dSQ job script: {job_script_path}")
+            out_path, err_path = self.get_task_output_paths('%A', '%a')
+            result = subprocess.run(
+                f'sbatch --job-name={self.job_name} --output={out_path} --error={err_path} {job_script_path}',
+                shell=True, check=True, capture_output=True, text=True, executable='/bin/bash'
+            )
+            logging.info(f"Successfully submitted jobs using sbatch for script {job_script_path}")
+            job_id = result.stdout.strip().split()[-1]
+            logging.info(f"Submitted job array with ID: {job_id}")
+            with open(job_file_path, 'r') as f:
+                self.n_tasks[job_id] = sum(1 for line in f if line.strip())
+            return job_id
+        except subprocess.CalledProcessError as e:
+            logging.error(f"Error during job submission process: {e}")
+            raise
+
+    def is_job_running(self, job_id):
+        result = subprocess.run(
+            f'squeue --job {job_id} -h -o %T',
+            shell=True, capture_output=True, text=True, executable='/bin/bash'
+        )
+        if result.returncode != 0:
+            logging.error(f"Error checking job status for job ID {job_id}: {result.stderr.strip()}")
+            return False
+        job_statuses = result.stdout.strip().split()
+        return any(status in ('PENDING', 'RUNNING', 'CONFIGURING')
+                   for status in job_statuses)
+
+    def iter_completed_tasks(self, job_id, expected_outputs=None):
+        """
+        Follows the dSQ status file, which gets one line per finished task,
+        and the expected per-task output files, yielding each task as soon as
+        it shows up in either. squeue is only asked every squeue_interval
+        seconds, to notice tasks that were killed without reporting.
+        """
+        logging.info(f"Tracking progress of job array with ID: {job_id}")
+        expected_outputs = dict(expected_outputs or {})
+        n_tasks = self.n_tasks.get(job_id)
+        status_file_path = self.get_status_file_path(job_id)
+        status_offset = 0
+        completed = set()
+        last_squeue = time.time()
+        while n_tasks is None or len(completed) < n_tasks:
+            finished = []
+            if os.path.exists(status_file_path) and \
+                    os.path.getsize(status_file_path) > status_offset:
+                with open(status_file_path, 'r') as f:
+                    f.seek(status_offset)
+                    lines = f.readlines()
+                # Leave a partially written last line for the next poll
+                if lines and not lines[-1].endswith('\n'):
+                    lines = lines[:-1]
+                status_offset += sum(len(line.encode('utf-8')) for line in lines)
+                for line in lines:
+                    fields = line.split('\t')
+                    finished.append((int(fields[0]), int(fields[1])))
+            for task_index, output_path in list(expected_outputs.items()):
+                if task_index not in completed and os.path.exists(output_path):
+                    finished.append((task_index, None))
+            for task_index, exit_code in finished:
+                if task_index in completed:
+                    continue
+                completed.add(task_index)
+                yield task_index, exit_code
+            if n_tasks is not None and len(completed) >= n_tasks:
+                break
+            if time.time() - last_squeue >= self.squeue_interval:
+                last_squeue = time.time()
+                if not self.is_job_running(job_id):
+                    break
+            time.sleep(self.poll_interval)
+        logging.info(f"Job array {job_id} has completed.")
+
+
+class LocalProcessExecutor(JobExecutor):
+    """
+    Runs the job list on the local machine. Tasks run concurrently in as many
+    slots as fit the per-task CPU count; the slots are shared by all job
+    arrays of the executor, so arrays submitted together do not oversubscribe
+    the machine. Each task is pinned to its slot's cores, has its BLAS/OpenMP
+    threads, data segment and run time limited like a SLURM allocation, and
+    writes the same per-task output and dSQ status files.
+    """
+    def __init__(self, *args, max_workers=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        available_cpus = sorted(os.sched_getaffinity(0)) \
+            if hasattr(os, 'sched_getaffinity') else list(range(cpu_count()))
+        n_slots = max(1, len(available_cpus) // self.cpus_per_task)
+        if max_workers is not None:
+            n_slots = max(1, min(n_slots, max_workers))
+        self.cpu_slots = [
+            available_cpus[i * self.cpus_per_task:(i + 1) * self.cpus_per_task]
+            or available_cpus for i in range(n_slots)]
+        self.free_slots = queue.Queue()
+        for cpus in self.cpu_slots:
+            self.free_slots.put(cpus)
+        self.mem_limit = parse_memory(self.mem_per_cpu) * self.cpus_per_task
+        self.jobs = {}
+        self.status_lock = threading.Lock()
+
+    def set_resources(self, mem_per_cpu, time_limit):
+        super().set_resources(mem_per_cpu, time_limit)
+        self.mem_limit = parse_memory(self.mem_per_cpu) * self.cpus_per_task
+
+    def build_task_env(self):
+        env = dict(os.environ)
+        for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS'):
+            env[var] = str(self.cpus_per_task)
+        env['SLURM_CPUS_PER_TASK'] = str(self.cpus_per_task)
+        return env
+
+    def run_task(self, job_id, task_index, command, mem_limit, time_limit_s):
+        cpus = self.free_slots.get()
+        task_command = [sys.executable, '-c', LOCAL_TASK_WRAPPER,
+                        ','.join(str(cpu) for cpu in cpus), str(int(mem_limit)), command]
+        out_path, err_path = self.get_task_output_paths(job_id, task_index)
+        env = self.build_task_env()
+        env['SLURM_ARRAY_TASK_ID'] = str(task_index)
+        start = datetime.now()
+        try:
+            with open(out_path, 'w') as out_file, open(err_path, 'w') as err_file:
+                # Own process group, so that a timeout also kills the python
+                # process started by the shell. The limits are applied by the
+                # wrapper, as preexec_fn is not safe to use from threads
+                process = subprocess.Popen(
+                    task_command, cwd=REPO_DIR, stdout=out_file, stderr=err_file,
+                    env=env, start_new_session=True)
+                try:
+                    returncode = process.wait(timeout=time_limit_s)
+                except subprocess.TimeoutExpired:
+                    os.killpg(process.pid, signal.SIGKILL)
+                    returncode = process.wait()
+                    logging.error(f"Task {task_index} of job {job_id} exceeded its time limit of {time_limit_s} s")
+        finally:
+            self.free_slots.put(cpus)
+        end = datetime.now()
+        status_line = '\t'.join([
+            str(task_index), str(returncode), socket.gethostname(),
+            start.strftime('%Y-%m-%d %H:%M:%S'), end.strftime('%Y-%m-%d %H:%M:%S'),
+            f'{(end - start).total_seconds():.2f}', command])
+        with self.status_lock:
+            with open(self.get_status_file_path(job_id), 'a') as f:
+                f.write(status_line + '\n')
+        if returncode != 0:
+            logging.error(f"Task {task_index} of job {job_id} exited with code {returncode}, see {err_path}")
+        return task_index, returncode
+
+    def submit_job_array(self, job_file_path):
+        with open(job_file_path, 'r') as f:
+            commands = [line.strip() for line in f if line.strip()]
+        job_id = f'local{int(time.time() * 1000)}_{len(self.jobs)}'
+        # Resources are fixed at submission, as for sbatch
+        time_limit_s = parse_time_limit(self.time_limit)
+        executor = ThreadPoolExecutor(max_workers=len(self.cpu_slots))
+        futures = [executor.submit(self.run_task, job_id, task_index, command,
+                                   self.mem_limit, time_limit_s)
+                   for task_index, command in enumerate(commands)]
+        executor.shutdown(wait=False)
+        self.jobs[job_id] = futures
+        self.n_tasks[job_id] = len(commands)
+        logging.info(f"Started local job array {job_id} with {len(commands)} tasks in {len(self.cpu_slots)} shared slots")
+        return job_id
+
+    def iter_completed_tasks(self, job_id, expected_outputs=None):
+        for future in as_completed(self.jobs.get(job_id, [])):
+            yield future.result()
+        logging.info(f"Local job array {job_id} has completed.")
+
+
+def get_job_executor(params, job_name, output_prefix, **resources):
+    """
+    Creates the job executor selected by params['job_executor'], 'slurm'
+    (default) or 'local'.
+    Parameters:
+    - params (dict): Dictionary of parameters.
+    - job_name (str): Name of the job array.
+    - output_prefix (str): Prefix of the per-task output files.
+    - resources: Per-task resources (partition, cpus_per_task, mem_per_cpu,
+    time_limit) and the completion poll_interval in seconds.
+    Returns:
+    - executor (JobExecutor): The job executor.
+    """
+    job_script_out_dir = params.get('job_script_out_dir', './job_scripts/')
+    backend = params.get('job_executor', 'slurm')
+    resources.setdefault('poll_interval', params.get('job_poll_interval', 2.0))
+    if backend == 'slurm':
+        return SlurmDSQExecutor(job_script_out_dir, job_name, output_prefix, **resources)
+    if backend == 'local':
+        return LocalProcessExecutor(
+            job_script_out_dir, job_name, output_prefix,
+            max_workers=params.get('local_max_workers'), **resources)
+    raise ValueError(f"Unknown job executor: {backend}")
+
+
+def scale_resources(resources, mem_scale=1.0, time_scale=1.0):
+    """
+    Scales a task allocation, e.g. for retrying tasks that ran out of memory
+    or time.
+    Parameters:
+    - resources (dict): Dictionary with mem_per_cpu and time_limit.
+    - mem_scale (float): Factor for the memory.
+    - time_scale (float): Factor for the time limit.
+    Returns:
+    - resources (dict): The scaled allocation.
+    """
+    return {'mem_per_cpu': format_memory(parse_memory(resources['mem_per_cpu']) * mem_scale),
+            'time_limit': format_time_limit(parse_time_limit(resources['time_limit']) * time_scale)}
+
+
+def run_job_array_with_retries(executor, generate_job_file, expected_outputs,
+                               load_output, params, plan_tasks=None):
+    """
+    Runs the sessions as job arrays and resubmits only the sessions whose
+    output is missing or unreadable, with scaled memory and time, until all
+    outputs are produced or params['max_job_retries'] resubmissions are used.
+    Parameters:
+    - executor (JobExecutor): Executor the job arrays are submitted to.
+    - generate_job_file (callable): Takes a list of tasks, each a list of
+    session keys, and a tag for the file name; writes a job list with one
+    line per task, in that order, and returns its path.
+    - expected_outputs (dict): Session key -> path of the output file.
+    - load_output (callable): Loads an output file.
+    - params (dict): Dictionary of parameters; uses max_job_retries,
+    retry_mem_scale, retry_time_scale and consume_results_as_completed.
+    - plan_tasks (callable): Optional; takes a list of session keys and
+    returns a list of (resources, tasks) per job array, e.g. from a
+    ResourceEstimator. By default every session is its own task with the
+    executor's allocation.
+    Returns:
+    - results (dict): Session key -> loaded output, for the sessions that
+    succeeded.
+    """
+    max_retries = params.get('max_job_retries', 2)
+    mem_scale = params.get('retry_mem_scale', 1.5)
+    time_scale = params.get('retry_time_scale', 1.5)
+    consume_as_completed = params.get('consume_results_as_completed', True)
+    default_resources = {'mem_per_cpu': executor.mem_per_cpu,
+                         'time_limit': executor.time_limit}
+    if plan_tasks is None:
+        plan_tasks = lambda keys: [(default_resources, [[key] for key in keys])]
+    results = {}
+    pending = list(expected_outputs)
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            logging.warning(f"Resubmitting {len(pending)} of {len(expected_outputs)} sessions (retry {attempt} of {max_retries})")
+        # Outputs left over from earlier runs would count as produced
+        for key in pending:
+            if os.path.exists(expected_outputs[key]):
+                os.remove(expected_outputs[key])
+        submitted = []
+        for group_index, (resources, tasks) in enumerate(plan_tasks(pending)):
+            resources = scale_resources(
+                resources, mem_scale ** attempt, time_scale ** attempt)
+            executor.set_resources(resources['mem_per_cpu'], resources['time_limit'])
+            # dSQ reads the job list when a task starts, so arrays that run
+            # at the same time need their own job list files
+            job_file_path = generate_job_file(tasks, f'_{attempt}_{group_index}')
+            job_id = executor.submit_job_array(job_file_path)
+            if job_id is not None:
+                submitted.append((job_id, tasks))
+        executor.set_resources(default_resources['mem_per_cpu'],
+                               default_resources['time_limit'])
+        for job_id, tasks in submitted:
+            # A task's sessions run in order, its last output marks it done
+            task_outputs = {task_index: expected_outputs[task[-1]]
+                            for task_index, task in enumerate(tasks)}
+            if consume_as_completed:
+                finished_tasks = (task_index for task_index, _ in
+                                  executor.iter_completed_tasks(job_id, task_outputs))
+            else:
+                executor.wait(job_id)
+                finished_tasks = iter(task_outputs)
+            for task_index in finished_tasks:
+                for key in tasks[task_index]:
+                    try:
+                        results[key] = load_output(expected_outputs[key])
+                    except (FileNotFoundError, EOFError) as e:
+                        logging.error(e)
+        pending = [key for key in pending if key not in results]
+        if not pending:
+            break
+    if pending:
+        logging.error(f"No output for {len(pending)} sessions after {max_retries} retries: {pending}")
+    return results
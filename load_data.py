@@ -7,19 +7,23 @@ Created on Fri May 10 12:00:42 2024
 """
 
 import os
-import glob
-import scipy.io
-import mat73
 import numpy as np
 import pandas as pd
 import pickle
-import h5py
 
 import logging
 
 import util
+import session_manifest
+import event_tables
+import instrumentation
+import fixation_counts
 
-import pdb
+
+def loadmat(file_path):
+    # scipy.io is imported on first use; most tasks never read a .mat file
+    import scipy.io
+    return scipy.io.loadmat(file_path)
 
 
 def get_monkey_and_dose_data(session_path):
@@ -30,12 +34,12 @@ def get_monkey_and_dose_data(session_path):
     Returns:
     - info_dict (dict): Dictionary containing information data.
     """
-    file_list_info = glob.glob(f"{session_path}/*metaInfo.mat")
+    file_list_info = session_manifest.find_session_files(session_path, 'metaInfo')
     if len(file_list_info) != 1:
         print(f"\nWarning: No metaInfo or more than one metaInfo found in folder: {session_path}.")
         return {'OT_dose': None, 'NAL_dose': None}
     try:
-        data_info = scipy.io.loadmat(file_list_info[0])
+        data_info = loadmat(file_list_info[0])
         info = data_info.get('info', [None])[0]
         if info is not None:
             return {
@@ -57,12 +61,12 @@ def get_runs_data(session_path):
     Returns:
     - runs_dict (dict): Dictionary containing runs data.
     """
-    file_list_runs = glob.glob(f"{session_path}/*runs.mat")
+    file_list_runs = session_manifest.find_session_files(session_path, 'runs')
     if len(file_list_runs) != 1:
         print(f"\nWarning: No runs found in folder: {session_path}.")
         return {}
     try:
-        data_runs = scipy.io.loadmat(file_list_runs[0])
+        data_runs = loadmat(file_list_runs[0])
         runs = data_runs.get('runs', [None])[0]
         if runs is not None:
             startS = [run['startS'][0][0] for run in runs]
@@ -85,7 +89,8 @@ def load_farplane_cal_and_get_bl_and_tr_roi_coords_m1(session_path, params):
     Returns:
     - bbox_dict (dict): Dictionary containing M1 ROI bounding boxes.
     """
-    file_list_m1_landmarks = glob.glob(f"{session_path}/*M1_farPlaneCal.mat")
+    file_list_m1_landmarks = session_manifest.find_session_files(
+        session_path, 'M1_farPlaneCal')
     if len(file_list_m1_landmarks) != 1:
         print(f"\nWarning: No m1_landmarks or more than one landmarks found in folder: {session_path}.")
         return {'eye_bbox': None,
@@ -93,7 +98,7 @@ def load_farplane_cal_and_get_bl_and_tr_roi_coords_m1(session_path, params):
                 'left_obj_bbox': None,
                 'right_obj_bbox': None}
     try:
-        data_m1_landmarks = scipy.io.loadmat(file_list_m1_landmarks[0])
+        data_m1_landmarks = loadmat(file_list_m1_landmarks[0])
         m1_landmarks = data_m1_landmarks.get('farPlaneCal', None)
         if m1_landmarks is not None:
             return util.get_bl_and_tr_roi_coords_m1(m1_landmarks, params)
@@ -105,6 +110,10 @@ def load_farplane_cal_and_get_bl_and_tr_roi_coords_m1(session_path, params):
             'right_obj_bbox': None}
 
 
+@instrumentation.timed_stage(
+    'load_data.get_labelled_gaze_positions_dict_m1',
+    get_session=lambda idx, params: os.path.basename(os.path.normpath(params['session_paths'][idx])),
+    count_items=lambda result, idx, params: 0 if result is None else len(result[0]))
 def get_labelled_gaze_positions_dict_m1(idx, params):
     """
     Process gaze data from a session folder.
@@ -119,13 +128,13 @@ def get_labelled_gaze_positions_dict_m1(idx, params):
     session_categories = params['session_categories']
     map_gaze_pos_coord_to_eyelink_space = params.get('map_gaze_pos_coord_to_eyelink_space', False)
     folder_path = session_paths[idx]
-    mat_files = [f for f in os.listdir(folder_path) if 'M1_gaze.mat' in f]
+    mat_files = session_manifest.find_session_files(folder_path, 'M1_gaze')
     if len(mat_files) != 1:
         print(f"\nError: Multiple or no '*_M1_gaze.mat' files found in folder: {folder_path}")
         return None
-    mat_file_path = os.path.join(folder_path, mat_files[0])
+    mat_file_path = mat_files[0]
     try:
-        mat_data = scipy.io.loadmat(mat_file_path)
+        mat_data = loadmat(mat_file_path)
         sampling_rate = float(mat_data['M1FS'])
         M1Xpx = mat_data['M1Xpx'].squeeze()
         M1Ypx = mat_data['M1Ypx'].squeeze()
@@ -139,7 +148,7 @@ def get_labelled_gaze_positions_dict_m1(idx, params):
                           'category': session_categories[idx]})
         return gaze_positions, meta_info
     except Exception as e:
-        print(f"\nError loading file '{mat_files[0]}': {e}")
+        print(f"\nError loading file '{os.path.basename(mat_file_path)}': {e}")
         return None
 
 
@@ -159,21 +168,75 @@ def load_labelled_gaze_positions(params):
         return pickle.load(f)
     
 
-def load_m1_fixations(params):
+def get_event_table_file(params, table_name):
+    """
+    Finds the most recently written file of an event table among its
+    parquet file and the CSV or pickle files written by earlier runs or
+    with params['event_table_format'] = 'csv'.
+    Parameters:
+    - params (dict): Dictionary containing the processed data directory.
+    - table_name (str): Base name of the table, e.g. 'fix_timepos_m1'.
+    Returns:
+    - file_path (str): Path to the newest file; ties go to the parquet file.
+    """
+    processed_data_dir = params['processed_data_dir']
+    flag_info = util.get_filename_flag_info(params)
+    candidates = [os.path.join(processed_data_dir, f'{table_name}{flag_info}{ext}')
+                  for ext in ('.csv', '.pkl')]
+    if event_tables.is_parquet_available():
+        candidates.insert(0, event_tables.get_event_table_path(
+            processed_data_dir, table_name, params))
+    existing = [path for path in candidates if os.path.exists(path)]
+    if not existing:
+        raise FileNotFoundError(f"No file found for event table {table_name} in {processed_data_dir}")
+    return max(existing, key=lambda path: os.stat(path).st_mtime_ns)
+
+
+def load_event_table_or_csv(params, table_name, columns=None, sessions=None):
+    """
+    Loads an event table from its most recently written file, the parquet
+    file or the CSV or pickle file written by earlier runs.
+    Parameters:
+    - params (dict): Dictionary containing the processed data directory.
+    - table_name (str): Base name of the table, e.g. 'fix_timepos_m1'.
+    - columns (list): Columns to read; all columns if None.
+    - sessions (list): Session names to read; all sessions if None.
+    Returns:
+    - table (pd.DataFrame): The event table.
+    """
+    file_path = get_event_table_file(params, table_name)
+    if file_path.endswith('.parquet'):
+        return event_tables.load_event_table(
+            file_path, columns=columns, sessions=sessions)
+    # The session filter needs session_name even if columns leave it out
+    read_columns = columns
+    if columns is not None and sessions is not None and 'session_name' not in columns:
+        read_columns = list(columns) + ['session_name']
+    if file_path.endswith('.csv'):
+        table = pd.read_csv(file_path, usecols=read_columns)
+    else:
+        table = pd.read_pickle(file_path)
+        if read_columns is not None:
+            table = table[read_columns]
+    if sessions is not None:
+        table = table[table['session_name'].isin(sessions)]
+    if columns is not None:
+        table = table[list(columns)]
+    return table
+
+
+def load_m1_fixations(params, columns=None, sessions=None):
     """
     Load M1 fixations and related data.
     Parameters:
     - params (dict): Dictionary containing root data directory and other parameters.
+    - columns (list): Columns to read; all columns if None.
+    - sessions (list): Session names to read; all sessions if None.
     Returns:
     - fixations_df (pd.DataFrame): DataFrame containing M1 fixations and their time positions.
     """
-    processed_data_dir = params['processed_data_dir']
-    flag_info = util.get_filename_flag_info(params)
-    # Load fixations time positions
-    fix_timepos_file_name = f'fix_timepos_m1{flag_info}.csv'
-    fix_timepos_m1 = pd.read_csv(os.path.join(
-        processed_data_dir, fix_timepos_file_name))
-    return fix_timepos_m1
+    return load_event_table_or_csv(
+        params, 'fix_timepos_m1', columns=columns, sessions=sessions)
 
 
 def load_fix_detection_results(params):
@@ -193,10 +256,8 @@ def load_fix_detection_results(params):
         with np.load(file_path, allow_pickle=True) as data:
             fixations_list = data['fixations']
             info_list = data['info']
-        # Load fixations time positions from CSV
-        fix_timepos_file_name = f'fix_timepos_m1{flag_info}.csv'
-        timepos_df = pd.read_csv(os.path.join(
-            processed_data_dir, fix_timepos_file_name))
+        # Load fixations time positions
+        timepos_df = load_m1_fixations(params)
         timepos_list = [timepos_df] * len(fixations_list)  # Assuming timepos_list is a list of identical DataFrames
         # Reconstruct the fix_detection_results list
         fix_detection_results = [(fixations_list[i], timepos_list[i], info_list[i]) 
@@ -207,40 +268,60 @@ def load_fix_detection_results(params):
         return None
 
 
-def load_m1_fixation_labels(params):
-    processed_data_dir = params['processed_data_dir']
-    flag_info = util.get_filename_flag_info(params)
-    # Load fixation labels
-    fixation_labels_file_name = f'fixation_labels_m1{flag_info}.csv'
-    fixation_labels_m1 = pd.read_csv(os.path.join(
-        processed_data_dir, fixation_labels_file_name))
-    return fixation_labels_m1
+def load_m1_fixation_labels(params, columns=None, sessions=None):
+    """
+    Loads the labelled M1 fixations.
+    Parameters:
+    - params (dict): Dictionary containing the processed data directory.
+    - columns (list): Columns to read; all columns if None.
+    - sessions (list): Session names to read; all sessions if None.
+    Returns:
+    - fixation_labels_m1 (pd.DataFrame): DataFrame of labelled fixations.
+    """
+    return load_event_table_or_csv(
+        params, 'fixation_labels_m1', columns=columns, sessions=sessions)
 
 
-def load_saccade_labels(params):
+def load_fixation_counts(params):
     """
-    Loads the labelled saccades from a specified directory.
+    Loads the fixation counts table saved with the fixation labels. If it is
+    missing, e.g. for labels saved by earlier runs, it is computed from the
+    labels.
+    Parameters:
+    - params (dict): Dictionary containing the processed data directory.
+    Returns:
+    - fixation_counts (pd.DataFrame): Number and total duration of fixations
+    per session, category, agent, block, run and ROI.
+    """
+    try:
+        return load_event_table_or_csv(params, 'fixation_counts_m1')
+    except FileNotFoundError:
+        logging.info("No fixation counts table found, computing it from the fixation labels")
+    return fixation_counts.compute_fixation_counts(load_m1_fixation_labels(params))
+
+
+def load_saccade_labels(params, columns=None, sessions=None):
+    """
+    Loads the labelled saccades from a specified directory. The trajectories
+    are recovered from the session gaze by wrapping the table in a
+    saccade_table.SaccadeTable.
     Parameters:
     - params (dict): Dictionary containing parameters including the load directory.
+    - columns (list): Columns to read; all columns if None.
+    - sessions (list): Session names to read; all sessions if None.
     Returns:
     - labelled_saccades (DataFrame): DataFrame containing saccade information with labels.
     """
-    processed_data_dir = params['processed_data_dir']
-    flag_info = util.get_filename_flag_info(params)
-    file_path = os.path.join(
-        processed_data_dir, f'labelled_saccades{flag_info}.csv')
-    if os.path.exists(file_path):
-        labelled_saccades = pd.read_csv(file_path)
-        print(f"Saccade labels loaded from {file_path}")
-        return labelled_saccades
-    else:
-        print(f"No file found at {file_path}")
+    try:
+        labelled_saccades = load_event_table_or_csv(
+            params, 'labelled_saccades', columns=columns, sessions=sessions)
+    except FileNotFoundError as e:
+        print(f"No saccade labels found: {e}")
         return None
+    print("Saccade labels loaded")
+    return labelled_saccades
 
 
-
-from scipy.io import loadmat
-
 def get_spiketimes_and_labels_for_one_session(session_path, processed_data_dir):
     """
     Extracts spike times and labels from a session.
@@ -252,7 +333,7 @@ def get_spiketimes_and_labels_for_one_session(session_path, processed_data_dir):
     label_cols = ['spikeS', 'spikeMs', 'session_name', 'channel', 'channel_label',
                   'unit_no_within_channel', 'unit_label', 'uuid', 'n_spikes', 'region']
     session_name = os.path.basename(os.path.normpath(session_path))
-    file_list_spikeTs = glob.glob(f"{session_path}/*spikeTs.mat")
+    file_list_spikeTs = session_manifest.find_session_files(session_path, 'spikeTs')
     if len(file_list_spikeTs) != 1:
         print(f"\nWarning: No spikeTs or more than one spikeTs found in folder: {session_path}.")
         return pd.DataFrame(columns=label_cols)
@@ -261,6 +342,7 @@ def get_spiketimes_and_labels_for_one_session(session_path, processed_data_dir):
     
     try:
         # Try loading with mat73 first
+        import mat73
         data_spikeTs = mat73.loadmat(file_path)
         spikeTs_struct = data_spikeTs['spikeTs']
         spikeS = [np.squeeze(spikeS).tolist() for spikeS in spikeTs_struct['spikeS']]
@@ -313,12 +395,8 @@ def load_processed_spiketimes(params):
         raise FileNotFoundError(f"No such file: {labels_path}")
 '''
 
-
-import os
-import h5py
-import pandas as pd
-
 def load_processed_spiketimes(params):
+    import h5py
     processed_data_dir = params.get('processed_data_dir')
     flag_info = util.get_filename_flag_info(params)
     h5_file_path = os.path.join(processed_data_dir, f'labelled_spiketimes{flag_info}.h5')
@@ -363,6 +441,21 @@ def load_session_raster_data(session_file_path):
     return dataframe
 
 
+def load_session_fixation_results(session_file_path):
+    """
+    Function to load the fixation and saccade results of one session job.
+    Parameters:
+    session_file_path (str): Path to the session's fixations pickle file.
+    Returns:
+    tuple: (fix_timepos_df, info, saccades) of the session.
+    """
+    if not os.path.exists(session_file_path):
+        raise FileNotFoundError(f"File {session_file_path} not found.")
+    with open(session_file_path, 'rb') as f:
+        session_results = pickle.load(f)
+    return session_results
+
+
 def load_labelled_fixation_rasters(params):
     """
     Function to load the labelled fixation rasters DataFrame from the specified directory.
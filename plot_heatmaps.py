@@ -34,8 +34,8 @@ processed_data_dir, params = util.fetch_processed_data_dir(params)
 
 
 plotter.plot_fixation_proportions_for_diff_conditions(params)
-plotter.plot_gaze_heatmaps_for_conditions(params)
-plotter.plot_fixation_heatmaps_for_conditions(params)
+plotter.plot_gaze_heatmaps(params)
+plotter.plot_fixation_heatmaps(params)
 
 
 
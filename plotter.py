@@ -20,12 +20,21 @@ from tqdm import tqdm
 
 import util
 import load_data
-
-import pdb
+import figure_renderer
+import fixation_counts
+import gaze_heatmap_cube
+import session_manifest
+from artifact_cache import ArtifactCache, compute_input_hash
+from raster_index import RasterIndex
 
 logger = logging.getLogger(__name__)
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
 
+# Params the per-session gaze heatmap counts are derived from, besides the
+# session's gaze and runs files
+GAZE_HEATMAP_PARAM_KEYS = gaze_heatmap_cube.GAZE_PARAM_KEYS + [
+    'use_gaze_heatmap_cubes', 'heatmap_bin_px', 'monitor_info']
+
 def plot_fixation_proportions_for_diff_conditions(params):
     """
     Plots the proportion of fixations on different ROIs for different conditions.
@@ -33,6 +42,33 @@ def plot_fixation_proportions_for_diff_conditions(params):
     Parameters:
     - params (dict): Dictionary containing parameters.
     """
+    plot_roi_fractions_for_diff_conditions(
+        params, 'n_fixations', 'Proportion of Fixations', 'fixation_proportions')
+
+
+def plot_fixation_dwell_for_diff_conditions(params):
+    """
+    Plots the proportion of fixation time spent on different ROIs for
+    different conditions.
+
+    Parameters:
+    - params (dict): Dictionary containing parameters.
+    """
+    plot_roi_fractions_for_diff_conditions(
+        params, 'total_duration', 'Proportion of Fixation Time', 'fixation_dwell_proportions')
+
+
+def plot_roi_fractions_for_diff_conditions(params, value, ylabel, file_prefix):
+    """
+    Plots ROI fractions per agent and block from the fixation counts table,
+    without loading the fixation labels.
+
+    Parameters:
+    - params (dict): Dictionary containing parameters.
+    - value (str): Column of the counts table, 'n_fixations' or 'total_duration'.
+    - ylabel (str): Label of the y axis.
+    - file_prefix (str): Start of the plot file name.
+    """
     root_data_dir = params['root_data_dir']
     if params.get('export_plots_to_local_folder', True):
         plots_dir = 'plots'
@@ -40,166 +76,370 @@ def plot_fixation_proportions_for_diff_conditions(params):
         plots_dir = os.path.join(root_data_dir, 'plots')
     os.makedirs(plots_dir, exist_ok=True)
     remap_flag = util.get_filename_flag_info(params)
-    fixation_labels_m1 = load_data.load_m1_fixation_labels(params)
+    fixation_counts_m1 = load_data.load_fixation_counts(params)
     # Filtering out discarded runs
-    valid_runs = fixation_labels_m1[fixation_labels_m1['block']
-                                    != 'discard']
-    conditions = {
-        'mon_up': valid_runs['block'] == 'mon_up',
-        'mon_down': valid_runs['block'] == 'mon_down'}
-    agents = {
-        'Lynch': valid_runs['agent'] == 'Lynch',
-        'Tarantino': valid_runs['agent'] == 'Tarantino'}
+    valid_runs = fixation_counts_m1[fixation_counts_m1['block'] != 'discard']
+    agents = ['Lynch', 'Tarantino']
+    blocks = ['mon_up', 'mon_down']
     rois = ['face_bbox', 'eye_bbox', 'left_obj_bbox', 'right_obj_bbox']
+    fractions = fixation_counts.compute_roi_fractions(
+        valid_runs, ['agent', 'block'], rois, value=value)
     fig, axes = plt.subplots(2, 2, figsize=(14, 10), sharey=True)
     fig.suptitle(
-        f'Proportion of Fixations on Different ROIs {remap_flag}',
+        f'{ylabel} on Different ROIs {remap_flag}',
         fontsize=16)
-    for i, (agent_name, agent_cond) in enumerate(agents.items()):
-        for j, (block_name, block_cond) in enumerate(conditions.items()):
+    for i, agent_name in enumerate(agents):
+        for j, block_name in enumerate(blocks):
             ax = axes[i, j]
-            data = valid_runs[agent_cond & block_cond]
-            proportions = [np.mean(data['fix_roi'] == roi)
-                           for roi in rois]
+            if (agent_name, block_name) in fractions.index:
+                proportions = fractions.loc[(agent_name, block_name)].to_numpy()
+            else:
+                proportions = np.full(len(rois), np.nan)
             ax.bar(rois, proportions, color=[
                 'blue', 'orange', 'green', 'red'])
             ax.set_title(f'{agent_name} - {block_name}')
             ax.set_ylim(0, 1)
-            ax.set_ylabel('Proportion of Fixations')
+            ax.set_ylabel(ylabel)
             ax.set_xlabel('ROI')
     plt.tight_layout(rect=[0, 0, 1, 0.96])
-    plot_filename = f'fixation_proportions{remap_flag}.png'
+    plot_filename = f'{file_prefix}{remap_flag}.png'
     plot_path = os.path.join(plots_dir, plot_filename)
     plt.savefig(plot_path)
     plt.close()
 
 
-def plot_gaze_heatmaps(params):
+def get_heatmap_plots_dir(params, sub_dir):
     """
-    Generates and saves gaze heatmaps for different conditions.
+    Returns the directory heatmaps are saved to. With
+    params['use_dated_plot_dirs'] False the directory is the same every day,
+    so that heatmaps of unchanged sessions are found and skipped.
     Parameters:
     - params (dict): Dictionary containing parameters.
+    - sub_dir (str): Name of the heatmap folder, e.g. 'gaze_heatmaps'.
+    Returns:
+    - plots_dir (str): Path of the heatmap folder.
     """
-    root_data_dir = params['root_data_dir']
     if params.get('export_plots_to_local_folder', True):
-        plots_dir = util.add_date_dir_to_path('plots/gaze_heatmaps')
+        plots_dir = os.path.join('plots', sub_dir)
     else:
-        plots_dir = util.add_date_dir_to_path(
-            os.path.join(root_data_dir, 'plots', 'gaze_heatmaps'))
+        plots_dir = os.path.join(params['root_data_dir'], 'plots', sub_dir)
+    if params.get('use_dated_plot_dirs', True):
+        plots_dir = util.add_date_dir_to_path(plots_dir)
     os.makedirs(plots_dir, exist_ok=True)
-    labelled_gaze_positions_m1 = load_data.load_labelled_gaze_positions(
-        params)
-    plot_gaze_heatmaps_for_all_sessions(
-        labelled_gaze_positions_m1, params, plots_dir)
+    return plots_dir
 
 
-def plot_gaze_heatmaps_for_all_sessions(labelled_gaze_positions_m1,
-                                        params, plots_dir):
-    for session_idx, (gaze_positions, session_info) \
-        in enumerate(tqdm(labelled_gaze_positions_m1,
-                          desc="Processing Sessions")):
-        plot_gaze_heatmap_for_one_session(
-            gaze_positions, session_info, session_idx, plots_dir)
+def get_heatmap_counts_cache(params):
+    """
+    Returns the cache of per-session binned heatmap counts. Its size and the
+    age of unused entries are bounded by 'heatmap_counts_cache_max_size_gb'
+    and 'heatmap_counts_cache_max_age_days'.
+    """
+    cache_dir = os.path.join(params['processed_data_dir'], 'heatmap_counts')
+    return ArtifactCache(
+        cache_dir,
+        max_size_gb=params.get('heatmap_counts_cache_max_size_gb', 5),
+        max_age_days=params.get('heatmap_counts_cache_max_age_days', 30))
 
 
-def plot_gaze_heatmap_for_one_session(gaze_positions, session_info,
-                                      session_idx, plots_dir):
-    sampling_rate = session_info['sampling_rate']
-    start_times = session_info['startS']
-    stop_times = session_info['stopS']
-    roi_bb_corners = session_info['roi_bb_corners']
-    # Combine all runs into one for plotting
-    all_gaze_positions = np.vstack(
-        [gaze_positions[round(start / sampling_rate):
-                        round(stop / sampling_rate)]
-         for start, stop in zip(start_times, stop_times)])
-    # Generate the 2D histogram
-    heatmap, xedges, yedges = np.histogram2d(
-        all_gaze_positions[:, 0], all_gaze_positions[:, 1], bins=50)
+def compute_heatmap_counts(x, y, bins=50):
+    """
+    Bins positions into a 2D histogram.
+    Returns:
+    - counts (dict): 'heatmap', 'xedges' and 'yedges' arrays.
+    """
+    heatmap, xedges, yedges = np.histogram2d(x, y, bins=bins)
+    return {'heatmap': heatmap, 'xedges': xedges, 'yedges': yedges}
+
+
+def get_cached_heatmap_counts(cache, stage, session_name, key_params,
+                              compute_counts, used_keys=None):
+    """
+    Returns the binned counts of a session from the cache, computing and
+    storing them if the session inputs changed.
+    Parameters:
+    - cache (ArtifactCache or None): Cache of binned counts; None to always
+    compute.
+    - stage (str): Name of the heatmap type, part of the cache key.
+    - session_name (str): Name of the session.
+    - key_params (dict): What the counts are computed from, e.g. source file
+    mtimes and heatmap params.
+    - compute_counts (callable): Computes the counts without arguments.
+    - used_keys (list): Optional; the key is appended to it, to keep the
+    entry when the cache is evicted.
+    Returns:
+    - counts (dict): Output of compute_heatmap_counts.
+    """
+    if cache is None:
+        return compute_counts()
+    key = ArtifactCache.compute_key(
+        stage, [], dict(key_params, session_name=session_name))
+    if used_keys is not None:
+        used_keys.append(key)
+    if cache.contains(key):
+        try:
+            return cache.load(key)
+        except Exception as e:
+            logger.warning(f"Could not load cached {stage} of session {session_name}: {e}")
+    counts = compute_counts()
+    cache.store(key, counts, stage=stage)
+    return counts
+
+
+def get_session_infos(params):
+    """
+    Returns the session meta info by session name, with the session category
+    if 'session_categories' is set; the gaze is not loaded.
+    """
+    session_infos = {}
+    for idx, meta_info in enumerate(params['meta_info_list']):
+        session_info = dict(meta_info)
+        if params.get('session_categories') is not None:
+            session_info['category'] = params['session_categories'][idx]
+        session_infos[session_info['session_name']] = session_info
+    return session_infos
+
+
+def get_gaze_heatmap_key_params(session_name, params, get_session_gaze):
+    """
+    Returns what the gaze heatmap counts of a session are computed from: the
+    sizes and mtimes of the session's gaze and runs files and the heatmap
+    params, so a cache hit does not need the gaze. Sessions that are not in
+    params['session_paths'] are keyed on their gaze and runs instead.
+    """
+    key_params = {key: params.get(key) for key in GAZE_HEATMAP_PARAM_KEYS}
+    session_paths = {os.path.basename(os.path.normpath(path)): path
+                     for path in params.get('session_paths') or []}
+    if session_name in session_paths:
+        key_params['source_files'] = session_manifest.get_session_file_mtimes(
+            session_paths[session_name], gaze_heatmap_cube.CUBE_SOURCE_KINDS)
+    else:
+        gaze_positions, session_info = get_session_gaze(session_name)
+        key_params['input_hash'] = compute_input_hash(
+            gaze_positions, session_info['startS'], session_info['stopS'],
+            session_info['sampling_rate'])
+    return key_params
+
+
+def compute_session_gaze_heatmap_counts(session_name, params, get_session_gaze):
+    if params.get('use_gaze_heatmap_cubes', True):
+        # Runs only, as before, on the fixed grid shared by all sessions
+        cube = gaze_heatmap_cube.load_session_cubes(
+            [session_name], params,
+            lambda p: [get_session_gaze(session_name)])[session_name]
+        return {'heatmap': gaze_heatmap_cube.sum_cube(cube, blocks=['mon_down']),
+                'xedges': cube['xedges'], 'yedges': cube['yedges']}
+    return compute_gaze_heatmap_counts(*get_session_gaze(session_name))
+
+
+def plot_heatmap_from_counts(counts, roi_bb_corners, title, plot_path):
+    """
+    Draws binned counts with the ROI bounding boxes and saves the figure.
+    Parameters:
+    - counts (dict): Output of compute_heatmap_counts.
+    - roi_bb_corners (dict): ROI name -> 'bottomLeft'/'topRight' corners.
+    - title (str): Figure title.
+    - plot_path (str): File the figure is saved to.
+    """
+    xedges, yedges = counts['xedges'], counts['yedges']
     extent = [xedges[0], xedges[-1], yedges[0], yedges[-1]]
     plt.figure(figsize=(10, 8))
-    plt.imshow(heatmap.T, extent=extent,
+    plt.imshow(counts['heatmap'].T, extent=extent,
                origin='lower', cmap='hot', aspect='auto')
     # Plot ROI bounding boxes with diff colors
     colors = ['blue', 'green', 'red', 'cyan', 'magenta', 'yellow', 'gray']
     for i, (roi_name, corners) in enumerate(roi_bb_corners.items()):
-        bottomLeft = corners['bottomLeft']
-        topRight = corners['topRight']
-        width = abs(topRight[0] - bottomLeft[0])
-        height = abs(topRight[1] - bottomLeft[1])
-        rect = Rectangle((bottomLeft[0], bottomLeft[1]), width, height,
+        bottom_left = corners['bottomLeft']
+        top_right = corners['topRight']
+        width = abs(top_right[0] - bottom_left[0])
+        height = abs(top_right[1] - bottom_left[1])
+        rect = Rectangle((bottom_left[0], bottom_left[1]), width, height,
                          fill=False, edgecolor=colors[i % len(colors)],
                          linewidth=2, label=roi_name)
         plt.gca().add_patch(rect)
     plt.colorbar(label='Frequency')
-    plt.title(f'Session {session_info["session_name"]}, Number of Runs: {len(start_times)}')
+    plt.title(title)
     plt.xlabel('X coordinate')
     plt.ylabel('Y coordinate')
-    plt.legend(loc='upper right')
-    # Save the plot
-    plot_filename = f'session_{session_info["session_name"]}.png'
-    plt.savefig(os.path.join(plots_dir, plot_filename))
+    if roi_bb_corners:
+        plt.legend(loc='upper right')
+    plt.savefig(plot_path)
     plt.close()
 
 
-def plot_fixation_heatmaps(params):
-    root_data_dir = params['root_data_dir']
-    if params.get('export_plots_to_local_folder', True):
-        plots_dir = util.add_date_dir_to_path('plots/fix_heatmaps')
+def plot_gaze_heatmaps(params):
+    """
+    Generates and saves gaze heatmaps for different conditions.
+    Parameters:
+    - params (dict): Dictionary containing parameters.
+    """
+    plots_dir = get_heatmap_plots_dir(params, 'gaze_heatmaps')
+    plot_gaze_heatmaps_for_all_sessions(None, params, plots_dir)
+
+
+def plot_gaze_heatmaps_for_all_sessions(labelled_gaze_positions_m1,
+                                        params, plots_dir):
+    """
+    Renders the gaze heatmap of each session in a process pool, from binned
+    counts cached per session. Sessions whose heatmap in plots_dir was
+    rendered from the same counts are skipped.
+    Parameters:
+    - labelled_gaze_positions_m1 (list or None): List of (gaze_positions,
+    session_info) tuples; if None, the sessions are taken from
+    params['meta_info_list'] and the gaze is only loaded on a cache miss.
+    - params (dict): Dictionary containing parameters.
+    - plots_dir (str): Directory the heatmaps are saved to.
+    """
+    cache = get_heatmap_counts_cache(params) \
+        if params.get('cache_heatmap_counts', True) else None
+    if labelled_gaze_positions_m1 is None:
+        gaze_by_session = None
+        session_infos = list(get_session_infos(params).values())
     else:
-        plots_dir = util.add_date_dir_to_path(
-            os.path.join(root_data_dir, 'plots', 'fix_heatmaps'))
-    os.makedirs(plots_dir, exist_ok=True)
-    labelled_gaze_positions_m1 = load_data.load_labelled_gaze_positions(
-        params)
+        gaze_by_session = {session_info['session_name']: (gaze_positions, session_info)
+                           for gaze_positions, session_info in labelled_gaze_positions_m1}
+        session_infos = [session_info for _, session_info in labelled_gaze_positions_m1]
+
+    def get_session_gaze(session_name):
+        # Loads the gaze of all sessions once, on the first cache miss
+        nonlocal gaze_by_session
+        if gaze_by_session is None:
+            gaze_by_session = {
+                session_info['session_name']: (gaze_positions, session_info)
+                for gaze_positions, session_info
+                in load_data.load_labelled_gaze_positions(params)}
+        return gaze_by_session[session_name]
+
+    render_queue = figure_renderer.FigureRenderQueue(
+        n_workers=params.get('figure_render_workers'),
+        force=params.get('force_rerender_figures', False))
+    used_keys = []
+    for session_info in tqdm(session_infos, desc="Binning gaze of sessions"):
+        session_name = session_info['session_name']
+        counts = get_cached_heatmap_counts(
+            cache, 'gaze_heatmap_counts', session_name,
+            get_gaze_heatmap_key_params(session_name, params, get_session_gaze),
+            lambda: compute_session_gaze_heatmap_counts(
+                session_name, params, get_session_gaze),
+            used_keys)
+        plot_path = os.path.join(plots_dir, f'session_{session_name}.png')
+        title = f'Session {session_name}, Number of Runs: {len(session_info["startS"])}'
+        render_queue.add(plot_heatmap_from_counts, plot_path,
+                         counts, session_info['roi_bb_corners'], title, plot_path)
+    render_queue.render(desc="Rendering gaze heatmaps")
+    if cache is not None:
+        cache.evict(keep_keys=used_keys)
+
+
+def plot_aggregate_gaze_heatmaps(params, plots_dir, group_by=('category', 'block')):
+    """
+    Renders condition-level gaze heatmaps as sums of the cached session
+    heatmap cubes. The gaze is only loaded if some cube is missing or stale.
+    Parameters:
+    - params (dict): Dictionary containing parameters, with the session meta
+    info in 'meta_info_list' and 'session_categories'.
+    - plots_dir (str): Directory the heatmaps are saved to.
+    - group_by (tuple): Meta info keys, and 'block', to group sessions by.
+    """
+    session_infos = get_session_infos(params)
+    cubes = gaze_heatmap_cube.load_session_cubes(
+        list(session_infos), params, load_data.load_labelled_gaze_positions)
+    heatmaps = gaze_heatmap_cube.aggregate_cubes(cubes, session_infos, group_by)
+    if not cubes:
+        return
+    any_cube = next(iter(cubes.values()))
+    render_queue = figure_renderer.FigureRenderQueue(
+        n_workers=params.get('figure_render_workers'),
+        force=params.get('force_rerender_figures', False))
+    for key, heatmap in heatmaps.items():
+        label = '_'.join(f'{field}-{value}' for field, value in zip(group_by, key))
+        counts = {'heatmap': heatmap, 'xedges': any_cube['xedges'],
+                  'yedges': any_cube['yedges']}
+        plot_path = os.path.join(plots_dir, f'gaze_heatmap_{label}.png')
+        render_queue.add(plot_heatmap_from_counts, plot_path, counts, {},
+                         label.replace('_', ', '), plot_path)
+    render_queue.render(desc="Rendering aggregate gaze heatmaps")
+
+
+def compute_gaze_heatmap_counts(gaze_positions, session_info, bins=50):
+    sampling_rate = session_info['sampling_rate']
+    start_times = session_info['startS']
+    stop_times = session_info['stopS']
+    # Combine all runs into one for plotting
+    all_gaze_positions = np.vstack(
+        [gaze_positions[round(start / sampling_rate):
+                        round(stop / sampling_rate)]
+         for start, stop in zip(start_times, stop_times)])
+    return compute_heatmap_counts(
+        all_gaze_positions[:, 0], all_gaze_positions[:, 1], bins=bins)
+
+
+def plot_gaze_heatmap_for_one_session(gaze_positions, session_info,
+                                      session_idx, plots_dir):
+    counts = compute_gaze_heatmap_counts(gaze_positions, session_info)
+    plot_filename = f'session_{session_info["session_name"]}.png'
+    plot_heatmap_from_counts(
+        counts, session_info['roi_bb_corners'],
+        f'Session {session_info["session_name"]}, Number of Runs: {len(session_info["startS"])}',
+        os.path.join(plots_dir, plot_filename))
+
+
+def plot_fixation_heatmaps(params):
+    plots_dir = get_heatmap_plots_dir(params, 'fix_heatmaps')
     all_fixation_labels = load_data.load_m1_fixation_labels(params)
     plot_fixation_heatmaps_for_all_sessions(
-            all_fixation_labels, labelled_gaze_positions_m1, params, plots_dir)
+            all_fixation_labels, None, params, plots_dir)
 
 
 def plot_fixation_heatmaps_for_all_sessions(
         all_fixation_labels, labelled_gaze_positions_m1, params, plots_dir):
-    for session_idx, (gaze_positions, session_info) in enumerate(
-            tqdm(labelled_gaze_positions_m1, desc="Processing Sessions")):
+    """
+    Renders the fixation heatmap of each session in a process pool, from
+    binned counts cached per session; unchanged sessions are skipped. If
+    labelled_gaze_positions_m1 is None, the sessions are taken from
+    params['meta_info_list'] without loading the gaze.
+    """
+    cache = get_heatmap_counts_cache(params) \
+        if params.get('cache_heatmap_counts', True) else None
+    if labelled_gaze_positions_m1 is None:
+        session_infos = list(get_session_infos(params).values())
+    else:
+        session_infos = [session_info for _, session_info in labelled_gaze_positions_m1]
+    render_queue = figure_renderer.FigureRenderQueue(
+        n_workers=params.get('figure_render_workers'),
+        force=params.get('force_rerender_figures', False))
+    # Split the fixations by session once instead of masking per session
+    fixations_by_session = dict(tuple(
+        all_fixation_labels.groupby('session_name', sort=False)))
+    used_keys = []
+    for session_info in tqdm(session_infos, desc="Binning fixations of sessions"):
         session_name = session_info['session_name']
-        roi_bb_corners = session_info['roi_bb_corners']
-        session_fixations = all_fixation_labels[
-            all_fixation_labels['session_name'] == session_name]
-        plot_fixation_heatmap_for_one_session(
-            session_fixations, roi_bb_corners, session_name, plots_dir)
+        session_fixations = fixations_by_session.get(
+            session_name, all_fixation_labels.iloc[:0])
+        x = session_fixations['mean_x_pos'].to_numpy(dtype=float)
+        y = session_fixations['mean_y_pos'].to_numpy(dtype=float)
+        counts = get_cached_heatmap_counts(
+            cache, 'fixation_heatmap_counts', session_name,
+            {'input_hash': compute_input_hash(x, y)},
+            lambda: compute_heatmap_counts(x, y), used_keys)
+        plot_path = os.path.join(plots_dir, f'session_{session_name}_fixations.png')
+        title = f'Session {session_name}, Number of Fixations: {len(session_fixations)}'
+        render_queue.add(plot_heatmap_from_counts, plot_path,
+                         counts, session_info['roi_bb_corners'], title, plot_path)
+    render_queue.render(desc="Rendering fixation heatmaps")
+    if cache is not None:
+        cache.evict(keep_keys=used_keys)
 
 
 def plot_fixation_heatmap_for_one_session(session_fixations, roi_bb_corners,
                                           session_name, plots_dir):
-    # Generate the 2D histogram
-    heatmap, xedges, yedges = np.histogram2d(
-        session_fixations['mean_x_pos'],
-        session_fixations['mean_y_pos'],
-        bins=50)
-    extent = [xedges[0], xedges[-1], yedges[0], yedges[-1]]
-    plt.figure(figsize=(10, 8))
-    plt.imshow(heatmap.T, extent=extent, origin='lower',
-               cmap='hot', aspect='auto')
-    # Plot ROI bounding boxes with different colors
-    colors = ['blue', 'green', 'red', 'cyan', 'magenta', 'yellow', 'gray']
-    for i, (roi_name, corners) in enumerate(roi_bb_corners.items()):
-        bottom_left = corners['bottomLeft']
-        top_right = corners['topRight']
-        width = abs(top_right[0] - bottom_left[0])
-        height = abs(top_right[1] - bottom_left[1])
-        rect = Rectangle((bottom_left[0], bottom_left[1]), width, height,
-                         fill=False, edgecolor=colors[i % len(colors)],
-                         linewidth=2, label=roi_name)
-        plt.gca().add_patch(rect)
-    plt.colorbar(label='Frequency')
-    plt.title(f'Session {session_name}, Number of Fixations: {len(session_fixations)}')
-    plt.xlabel('X coordinate')
-    plt.ylabel('Y coordinate')
-    plt.legend(loc='upper right')
-    # Save the plot
+    counts = compute_heatmap_counts(
+        session_fixations['mean_x_pos'], session_fixations['mean_y_pos'])
     plot_filename = f'session_{session_name}_fixations.png'
-    plt.savefig(os.path.join(plots_dir, plot_filename))
-    plt.close()
+    plot_heatmap_from_counts(
+        counts, roi_bb_corners,
+        f'Session {session_name}, Number of Fixations: {len(session_fixations)}',
+        os.path.join(plots_dir, plot_filename))
 
 
 def plot_roi_response_of_each_unit(labelled_fixation_rasters, params):
@@ -221,20 +461,22 @@ def plot_roi_response_of_each_unit(labelled_fixation_rasters, params):
     bins_pre = int(pre_event_time / raster_bin_size)
     bins_post = int(post_event_time / raster_bin_size)
     
-    # Filter for start_time aligned rasters
-    start_time_rasters = labelled_fixation_rasters[labelled_fixation_rasters['aligned_to'] == 'start_time']
+    # Index the fixation rasters once; each unit's rows are then a
+    # contiguous slice
+    labelled_fixation_rasters = labelled_fixation_rasters[labelled_fixation_rasters['behavior'] == 'fixation']
+    raster_index = RasterIndex(labelled_fixation_rasters)
     
-    # List of ROIs
+    # Units with start_time aligned rasters, and their ROIs
+    unit_keys = [(region, unit) for (region, unit, aligned_to), _ in raster_index.iter_groups(3)
+                 if aligned_to == 'start_time']
+    start_time_rasters = labelled_fixation_rasters[labelled_fixation_rasters['aligned_to'] == 'start_time']
     rois = start_time_rasters['fix_roi'].unique()
     
-    # List of units
-    units = start_time_rasters['uuid'].unique()
-    
     # Track differentiating neurons for ACC and BLA regions
     acc_diff_neurons = {roi: 0 for roi in rois}
     bla_diff_neurons = {roi: 0 for roi in rois}
-    acc_total_neurons = len(start_time_rasters[start_time_rasters['region'] == 'ACC']['uuid'].unique())
-    bla_total_neurons = len(start_time_rasters[start_time_rasters['region'] == 'BLA']['uuid'].unique())
+    acc_total_neurons = sum(region == 'ACC' for region, _ in unit_keys)
+    bla_total_neurons = sum(region == 'BLA' for region, _ in unit_keys)
     
     # Create directory for plots
     root_data_dir = params['root_data_dir']
@@ -243,21 +485,19 @@ def plot_roi_response_of_each_unit(labelled_fixation_rasters, params):
     os.makedirs(plot_dir, exist_ok=True)
     
     # Plotting
-    for unit in units:
+    for region, unit in unit_keys:
+        session_name = None
         try:
-            unit_data = start_time_rasters[start_time_rasters['uuid'] == unit]
-            session_name = unit_data.iloc[0]['session_name']
-            region = unit_data.iloc[0]['region']
+            session_name = raster_index.query(region, unit, 'start_time').iloc[0]['session_name']
             fig, axes = plt.subplots(len(rois), 1, figsize=(10, len(rois) * 5))
             fig.suptitle(f'Unit {unit} (Session: {session_name}, Region: {region}) ROI Response')
             for i, roi in enumerate(rois):
-                roi_data = unit_data[unit_data['fix_roi'] == roi]
-                mon_up = roi_data[roi_data['block'] == 'mon_up']
-                mon_down = roi_data[roi_data['block'] == 'mon_down']
-                pre_up = np.array([raster[:bins_pre] for raster in mon_up['raster']])
-                post_up = np.array([raster[bins_pre:bins_pre + bins_post] for raster in mon_up['raster']])
-                pre_down = np.array([raster[:bins_pre] for raster in mon_down['raster']])
-                post_down = np.array([raster[bins_pre:bins_pre + bins_post] for raster in mon_down['raster']])
+                mon_up = raster_index.get_rasters(region, unit, 'start_time', 'mon_up', roi)
+                mon_down = raster_index.get_rasters(region, unit, 'start_time', 'mon_down', roi)
+                pre_up = mon_up[:, :bins_pre]
+                post_up = mon_up[:, bins_pre:bins_pre + bins_post]
+                pre_down = mon_down[:, :bins_pre]
+                post_down = mon_down[:, bins_pre:bins_pre + bins_post]
                 mean_pre_up = np.mean(pre_up, axis=1)
                 mean_post_up = np.mean(post_up, axis=1)
                 mean_pre_down = np.mean(pre_down, axis=1)
@@ -6,6 +6,9 @@ Created on Mon Jun 24 12:37:42 2024
 Author: pg496
 """
 
+import time
+_import_start = time.perf_counter()
+
 import os
 import argparse
 import logging
@@ -14,8 +17,12 @@ import pickle
 
 from fix_and_saccades import get_session_fixations_and_saccades
 import load_data
+import resource_estimator
+import instrumentation
+
+IMPORT_S = time.perf_counter() - _import_start
 
-def main(session_index, params_file):
+def main(session_indices, params_file):
     logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
     # Load parameters from the JSON file
@@ -28,10 +35,23 @@ def main(session_index, params_file):
     #     ...
     # })
 
-    logging.info(f"Starting fixation detection for session index: {session_index}")
+    instrumentation.configure_run_log(params)
+    instrumentation.report_startup('process_session_fixations', IMPORT_S)
 
-    # Load labelled gaze positions
+    # Load labelled gaze positions once for all sessions packed into this task
     labelled_gaze_positions = load_data.load_labelled_gaze_positions(params)
+    for session_index in session_indices:
+        # Only the memory a session adds on top of the preloaded gaze is
+        # attributed to it
+        with resource_estimator.SessionUsageMonitor() as usage:
+            process_session(session_index, labelled_gaze_positions, params)
+        resource_estimator.record_session_usage(
+            params, 'joblist_fixations', session_index,
+            len(labelled_gaze_positions[session_index][0]), usage)
+
+
+def process_session(session_index, labelled_gaze_positions, params):
+    logging.info(f"Starting fixation detection for session index: {session_index}")
 
     # Prepare session data for the specific index
     session_data = labelled_gaze_positions[session_index]
@@ -44,15 +64,19 @@ def main(session_index, params_file):
     output_dir = params['processed_data_dir']
     fixations_file = os.path.join(output_dir, f"{session_index}_fixations.pkl")
 
-    with open(fixations_file, 'wb') as f:
+    # Write to a temporary file first so that the driver, which loads the
+    # file as soon as it appears, never sees a partial pickle
+    tmp_file = fixations_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
         pickle.dump((fix_timepos_df, info, saccades), f)
+    os.replace(tmp_file, fixations_file)
 
     logging.info(f"Fixation detection completed for session index: {session_index}")
     logging.info(f"Results saved to: {fixations_file}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process session fixation detection")
-    parser.add_argument('--session_index', type=int, required=True, help='Index of the session in labelled gaze positions list')
+    parser.add_argument('--session_index', type=int, nargs='+', required=True, help='Indices of the sessions in labelled gaze positions list, processed in order')
     parser.add_argument('--params_file', type=str, required=True, help='Path to the JSON file with parameters')
 
     args = parser.parse_args()
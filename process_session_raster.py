@@ -6,31 +6,63 @@ Created on Thu Jun 13 11:22:45 2024
 @author: pg496
 """
 
+import time
+_import_start = time.perf_counter()
+
 import os
+import json
 import argparse
 import util
 import load_data
+import session_manifest
+import session_meta_index
+import instrumentation
+import resource_estimator
 from raster import RasterManager
 
+IMPORT_S = time.perf_counter() - _import_start
+
 def main():
     parser = argparse.ArgumentParser(description='Process a single session to generate raster data.')
-    parser.add_argument('--session', required=True, help='Path to the session to process')
+    parser.add_argument('--session', nargs='+', required=True, help='Paths to the sessions to process, in order')
+    parser.add_argument('--params_file', help='JSON file with the params of the driver')
     args = parser.parse_args()
-    session_path = args.session
     
     params = util.get_params()
+    if args.params_file:
+        with open(args.params_file, 'r') as f:
+            params.update(json.load(f))
     root_data_dir, params = util.fetch_root_data_dir(params)
     data_source_dir, params = util.fetch_data_source_dir(params)
     session_paths, params = util.fetch_session_subfolder_paths_from_source(params)
     processed_data_dir, params = util.fetch_processed_data_dir(params)
+    instrumentation.configure_run_log(params)
+    instrumentation.report_startup('process_session_raster', IMPORT_S)
+    session_manifest.load_or_build_session_manifest(params)
 
-    # Load fixation and spiketimes data
+    # Load fixation and spiketimes data, and the saccades and run times if
+    # rasters are also aligned to those
     labelled_fixations = load_data.load_m1_fixation_labels(params)
     labelled_spiketimes = load_data.load_processed_spiketimes(params)
+    session_names = [os.path.basename(path) for path in args.session]
+    event_types = params.get('raster_event_types', ['fixation'])
+    labelled_saccades = None
+    if 'saccade' in event_types:
+        labelled_saccades = load_data.load_saccade_labels(params, sessions=session_names)
+    if 'run' in event_types:
+        params['meta_info_list'] = session_meta_index.build_or_load_session_meta_index(params)
 
-    # Instantiate RasterManager and generate the session raster
+    # Instantiate RasterManager and generate the rasters of the sessions
+    # packed into this task
     raster_manager = RasterManager(params)
-    raster_manager.generate_session_raster(session_path, labelled_fixations, labelled_spiketimes)
+    for session_path, size in zip(args.session, resource_estimator.get_raster_session_sizes(
+            session_names, labelled_fixations, labelled_spiketimes)):
+        # Only the memory a session adds on top of the preloaded tables is
+        # attributed to it
+        with resource_estimator.SessionUsageMonitor() as usage:
+            raster_manager.generate_session_raster(session_path, labelled_fixations, labelled_spiketimes, labelled_saccades)
+        resource_estimator.record_session_usage(
+            params, 'joblist_raster', os.path.basename(session_path), size, usage)
 
 if __name__ == '__main__':
     main()
@@ -17,8 +17,23 @@ import ast
 import pickle
 
 import util
+import timebase
+import instrumentation
+
+
+# Event types rasters can be aligned to, see RasterManager.get_session_events
+EVENT_TYPES = ['fixation', 'saccade', 'run', 'roi_entry']
+
+# Label columns carried from the source tables into the raster rows
+FIXATION_LABEL_COLUMNS = ['category', 'session_name', 'run', 'block', 'fix_duration',
+                          'mean_x_pos', 'mean_y_pos', 'fix_roi', 'agent']
+SACCADE_LABEL_COLUMNS = ['category', 'session_name', 'run', 'block', 'duration',
+                         'start_roi', 'end_roi']
+
+# Unit columns of the spiketimes table copied into every raster row
+UNIT_COLUMNS = ['channel', 'channel_label', 'unit_no_within_channel', 'unit_label',
+                'uuid', 'n_spikes', 'region']
 
-import pdb
 
 class RasterManager:
     def __init__(self, params):
@@ -33,18 +48,18 @@ class RasterManager:
         handler.setFormatter(formatter)
         self.logger.addHandler(handler)
 
-    def make_session_rasters_serial(self, session_paths, labelled_fixations, labelled_spiketimes):
+    def make_session_rasters_serial(self, session_paths, labelled_fixations, labelled_spiketimes, labelled_saccades=None):
         results = []
         for session_path in session_paths:
-            session_raster = self.generate_session_raster(session_path, labelled_fixations, labelled_spiketimes)
+            session_raster = self.generate_session_raster(session_path, labelled_fixations, labelled_spiketimes, labelled_saccades)
             if session_raster is not None:
                 results.append(session_raster)
         return results
 
-    def make_session_rasters_parallel(self, session_paths, labelled_fixations, labelled_spiketimes):
+    def make_session_rasters_parallel(self, session_paths, labelled_fixations, labelled_spiketimes, labelled_saccades=None):
         results = []
         with ProcessPoolExecutor() as executor:
-            future_to_session = {executor.submit(self.generate_session_raster, path, labelled_fixations, labelled_spiketimes): path for path in session_paths}
+            future_to_session = {executor.submit(self.generate_session_raster, path, labelled_fixations, labelled_spiketimes, labelled_saccades): path for path in session_paths}
             for future in as_completed(future_to_session):
                 try:
                     result = future.result()
@@ -55,36 +70,63 @@ class RasterManager:
                     self.logger.error(f"Session {session_path} generated an exception: {exc}")
         return results
 
-    def generate_session_raster(self, session, labelled_fixations, labelled_spiketimes):
+    def generate_session_raster(self, session, labelled_fixations, labelled_spiketimes, labelled_saccades=None):
+        """
+        Computes the rasters of all units of a session around the events of
+        params['raster_event_types'] (default ['fixation']), see
+        get_session_events, and saves them to <session>_raster.pkl.
+        Parameters:
+        - session (str): Session path.
+        - labelled_fixations (pd.DataFrame): Labelled fixations.
+        - labelled_spiketimes (pd.DataFrame): Spike times of all units.
+        - labelled_saccades (pd.DataFrame): Labelled saccades, needed for
+        'saccade' events.
+        Returns:
+        - session_data (pd.DataFrame): One row per unit and event.
+        """
         self.logger.debug(f"Processing session: {session}")
         params = self.params
         raster_bin_size = float(params['raster_bin_size'])
         raster_pre_event_time = float(params['raster_pre_event_time'])
         raster_post_event_time = float(params['raster_post_event_time'])
-        num_bins = int((raster_pre_event_time + raster_post_event_time) / raster_bin_size)
         session_name = os.path.basename(session) 
         session_fixations = labelled_fixations[labelled_fixations['session_name'] == session_name]
         session_neurons = labelled_spiketimes[labelled_spiketimes['session_name'] == session_name]
+        session_saccades = None
+        if labelled_saccades is not None:
+            session_saccades = labelled_saccades[labelled_saccades['session_name'] == session_name]
+        session_events = self.get_session_events(
+            session_name, session_fixations, session_saccades,
+            params.get('raster_event_types', ['fixation']))
 
-        self.logger.debug(f"Session fixations shape: {session_fixations.shape}")
+        self.logger.debug(f"Session events shape: {session_events.shape}")
         self.logger.debug(f"Session neurons shape: {session_neurons.shape}")
 
-        if session_fixations.empty or session_neurons.empty:
+        if session_events.empty or session_neurons.empty:
             self.logger.warning(f"No data found for session {session}.")
             return None
 
         results = []
-        with ThreadPoolExecutor() as executor:
-            futures = {executor.submit(
-                self.process_unit, uuid, session_fixations, session_neurons,
-                num_bins, raster_bin_size, raster_pre_event_time, raster_post_event_time): uuid for uuid in session_neurons['uuid'].unique()}
-            for future in as_completed(futures):
-                try:
-                    result = future.result()
-                    if result is not None:
-                        results.append(result)
-                except Exception as e:
-                    self.logger.error(f"Error processing unit {futures[future]}: {e}")
+        if params.get('use_spike_matrix', False):
+            results = self.process_session_events_from_spike_matrix(
+                session_name, session_events, session_neurons,
+                raster_bin_size, raster_pre_event_time, raster_post_event_time)
+        else:
+            uuids = session_neurons['uuid'].unique()
+            # Timed per session; a record per unit would cost more than the unit
+            with instrumentation.stage_timer('raster.process_session_units', session=session_name,
+                                             n_items=len(session_events) * len(uuids)), \
+                    ThreadPoolExecutor() as executor:
+                futures = {executor.submit(
+                    self.process_unit_events, uuid, session_events, session_neurons,
+                    raster_bin_size, raster_pre_event_time, raster_post_event_time): uuid for uuid in uuids}
+                for future in as_completed(futures):
+                    try:
+                        result = future.result()
+                        if result is not None:
+                            results.append(result)
+                    except Exception as e:
+                        self.logger.error(f"Error processing unit {futures[future]}: {e}")
 
         if not results:
             self.logger.warning(f"No results for session {session}.")
@@ -96,53 +138,209 @@ class RasterManager:
         self.logger.info(f"Saved session data for {session} to {session_file_path}")
         return session_data
 
+    def get_session_events(self, session_name, session_fixations, session_saccades=None, event_types=('fixation',)):
+        """
+        Collects the events of a session to align rasters to into one table.
+        Parameters:
+        - session_name (str): Name of the session.
+        - session_fixations (pd.DataFrame): Labelled fixations of the session.
+        - session_saccades (pd.DataFrame): Labelled saccades of the session.
+        - event_types (list): Any of EVENT_TYPES. 'fixation' and 'saccade'
+        align to onsets and offsets, 'run' to the run starts and stops of
+        the session meta info in params['meta_info_list'], and 'roi_entry'
+        to the onsets of fixations on a different ROI than the previous one.
+        Returns:
+        - events (pd.DataFrame): One row per event with 'event_time',
+        'aligned_to', 'behavior' and the label columns of its source.
+        """
+        event_tables = []
+        for event_type in event_types:
+            if event_type == 'fixation':
+                event_tables.append(self.get_onset_offset_events(
+                    session_fixations, FIXATION_LABEL_COLUMNS, 'fixation'))
+            elif event_type == 'saccade':
+                if session_saccades is None:
+                    self.logger.warning(f"No saccades given for session {session_name}, skipping saccade events.")
+                    continue
+                event_tables.append(self.get_onset_offset_events(
+                    session_saccades, SACCADE_LABEL_COLUMNS, 'saccade'))
+            elif event_type == 'run':
+                event_tables.append(self.get_run_events(session_name))
+            elif event_type == 'roi_entry':
+                event_tables.append(self.get_roi_entry_events(session_fixations))
+            else:
+                raise ValueError(f"Unknown event type '{event_type}', expected one of {EVENT_TYPES}")
+        event_tables = [events for events in event_tables if not events.empty]
+        if not event_tables:
+            return pd.DataFrame(columns=['event_time', 'aligned_to', 'behavior'])
+        return pd.concat(event_tables, ignore_index=True)
+
+    def get_onset_offset_events(self, table, label_columns, behavior):
+        # Two events per row, its start_time then its end_time
+        aligned_tos = ['start_time', 'end_time']
+        label_columns = [column for column in label_columns if column in table.columns]
+        events = table[label_columns].iloc[np.repeat(np.arange(len(table)), len(aligned_tos))] \
+            .reset_index(drop=True)
+        events.insert(0, 'event_time', table[aligned_tos].to_numpy(dtype=float).ravel())
+        events['aligned_to'] = np.tile(aligned_tos, len(table))
+        events['behavior'] = behavior
+        return events
+
+    def get_run_events(self, session_name):
+        session_info = next((info for info in self.params.get('meta_info_list') or []
+                             if info.get('session_name') == session_name), None)
+        if session_info is None:
+            self.logger.warning(f"No meta info for session {session_name}, skipping run events.")
+            return pd.DataFrame()
+        startS = np.asarray(session_info.get('startS', []), dtype=float).ravel()
+        stopS = np.asarray(session_info.get('stopS', []), dtype=float).ravel()
+        n_runs = min(len(startS), len(stopS))
+        return pd.DataFrame({
+            'event_time': np.column_stack((startS[:n_runs], stopS[:n_runs])).ravel(),
+            'category': session_info.get('category'),
+            'session_name': session_name,
+            'run': np.repeat(np.arange(n_runs), 2),
+            'aligned_to': np.tile(['run_start', 'run_stop'], n_runs),
+            'behavior': 'run'})
+
+    def get_roi_entry_events(self, session_fixations):
+        fixations = session_fixations.sort_values('start_time', kind='stable')
+        fix_roi = fixations['fix_roi'].astype(str).to_numpy()
+        entered = np.ones(len(fix_roi), dtype=bool)
+        entered[1:] = fix_roi[1:] != fix_roi[:-1]
+        entered &= fix_roi != 'out_of_roi'
+        fixations = fixations[entered]
+        label_columns = [column for column in FIXATION_LABEL_COLUMNS if column in fixations.columns]
+        events = fixations[label_columns].reset_index(drop=True)
+        events.insert(0, 'event_time', fixations['start_time'].to_numpy(dtype=float))
+        events['aligned_to'] = 'roi_entry'
+        events['behavior'] = 'roi_entry'
+        return events
+
     def process_unit(self, uuid, session_fixations, session_neurons, num_bins, raster_bin_size, raster_pre_event_time, raster_post_event_time):
+        """
+        Computes the fixation onset and offset rasters of a unit.
+        """
+        events = self.get_onset_offset_events(session_fixations, FIXATION_LABEL_COLUMNS, 'fixation')
+        return self.process_unit_events(uuid, events, session_neurons, raster_bin_size,
+                                        raster_pre_event_time, raster_post_event_time)
+
+    def process_unit_events(self, uuid, events, session_neurons, raster_bin_size, raster_pre_event_time, raster_post_event_time):
+        """
+        Computes the rasters of a unit around all events of a session in one
+        pass: the spike train is converted to sorted integer ticks once, and
+        the windows of every event type are found by binary search in it.
+        Parameters:
+        - uuid (str): Unit id.
+        - events (pd.DataFrame): Output of get_session_events.
+        - session_neurons (pd.DataFrame): Spike times of the session's units.
+        - raster_bin_size, raster_pre_event_time, raster_post_event_time
+        (float): Binning in seconds.
+        Returns:
+        - unit_rasters (pd.DataFrame): One row per event with the 'raster',
+        the event's label columns, UNIT_COLUMNS, 'aligned_to' and 'behavior'.
+        """
         self.logger.debug(f"Processing unit: {uuid}")
-        neuron_spikes_str = session_neurons[session_neurons['uuid'] == uuid]['spikeS'].values[0]
-        neuron_spikes = np.array(neuron_spikes_str)
-        bins = np.arange(-raster_pre_event_time, raster_post_event_time, raster_bin_size)
-        results = []
-        for _, fixation in session_fixations.iterrows():
-            for aligned_to in ['start_time', 'end_time']:
-                event_time = float(fixation[aligned_to])
-                relevant_spikes = neuron_spikes[(neuron_spikes >= event_time - raster_pre_event_time) & (neuron_spikes < event_time + raster_post_event_time)]
-                spike_times = relevant_spikes - event_time
-                raster = np.histogram(spike_times, bins=bins)[0]
-                raster = raster.astype(int)
-                session_data = self.update_session_data(raster, fixation, session_neurons, uuid, aligned_to)
-                results.append(session_data)
-        if not results:
+        if events.empty:
             self.logger.warning(f"No results for unit {uuid}.")
             return None
-        return pd.DataFrame(results)
-
-    def update_session_data(self, raster, fixation, session_neurons, uuid, aligned_to):
-        session_data = {
-            'raster': raster,  # Keep raster as a numpy array
-            'category': fixation['category'],
-            'session_name': fixation['session_name'],
-            'run': fixation['run'],
-            'block': fixation['block'],
-            'fix_duration': fixation['fix_duration'],
-            'mean_x_pos': fixation['mean_x_pos'],
-            'mean_y_pos': fixation['mean_y_pos'],
-            'fix_roi': fixation['fix_roi'],
-            'agent': fixation['agent'],
-            'channel': session_neurons[session_neurons['uuid'] == uuid]['channel'].values[0],
-            'channel_label': session_neurons[session_neurons['uuid'] == uuid]['channel_label'].values[0],
-            'unit_no_within_channel': session_neurons[session_neurons['uuid'] == uuid]['unit_no_within_channel'].values[0],
-            'unit_label': session_neurons[session_neurons['uuid'] == uuid]['unit_label'].values[0],
-            'uuid': uuid,
-            'n_spikes': session_neurons[session_neurons['uuid'] == uuid]['n_spikes'].values[0],
-            'region': session_neurons[session_neurons['uuid'] == uuid]['region'].values[0],
-            'aligned_to': aligned_to,
-            'behavior': 'fixation'
-        }
-        return session_data
+        unit = session_neurons[session_neurons['uuid'] == uuid].iloc[0]
+        bins = np.arange(-raster_pre_event_time, raster_post_event_time, raster_bin_size)
+        # Spikes, events and bin edges are compared as integer ticks; the
+        # windows of all events are cut out of the sorted spike ticks by
+        # binary search and binned in one bincount
+        spike_ticks = np.sort(timebase.seconds_to_ticks(np.asarray(unit['spikeS'], dtype=float).ravel()))
+        edge_ticks = timebase.seconds_to_ticks(bins)
+        event_ticks = timebase.seconds_to_ticks(events['event_time'].to_numpy(dtype=float))
+        rasters = self.bin_event_windows(spike_ticks, event_ticks, edge_ticks)
+        return self.assemble_unit_rasters(uuid, unit, events, rasters)
+
+    @instrumentation.timed_stage(
+        'raster.process_session_events_from_spike_matrix',
+        get_session=lambda self, session_name, *args: session_name,
+        count_items=lambda result, self, session_name, events, session_neurons, *args: len(events) * len(session_neurons))
+    def process_session_events_from_spike_matrix(self, session_name, events, session_neurons, raster_bin_size, raster_pre_event_time, raster_post_event_time):
+        """
+        Computes the rasters of all units of a session by cutting event
+        windows out of the session's spike matrix, see spike_matrix.py. The
+        matrix is binned once, at params['spike_matrix_bin_size'] (default
+        spike_matrix.BASE_BIN_SIZE), and cached, so other event sets or
+        subsets are indexing operations on it. The windows are cut in matrix
+        bins and summed into raster bins, so the raster bin size has to be a
+        multiple of the matrix bin size. Window starts are rounded down to
+        the matrix grid, which is exact for events at gaze sample times when
+        the matrix bin size is a multiple of the sample period.
+        Returns:
+        - results (list): One DataFrame per unit, as process_unit_events.
+        """
+        import spike_matrix
+        if events.empty:
+            return []
+        session_matrix = spike_matrix.get_or_build_spike_matrix(session_name, session_neurons, self.params)
+        raster_bin_ticks = int(timebase.seconds_to_ticks(raster_bin_size))
+        if raster_bin_ticks % session_matrix.bin_ticks:
+            raise ValueError(
+                f"Raster bin size {raster_bin_size} is not a multiple of the "
+                f"spike matrix bin size {session_matrix.bin_size}")
+        factor = raster_bin_ticks // session_matrix.bin_ticks
+        # Same number of bins as the edges of the per-unit path give
+        n_bins = len(np.arange(-raster_pre_event_time, raster_post_event_time, raster_bin_size)) - 1
+        windows = session_matrix.event_windows(
+            events['event_time'].to_numpy(dtype=float), raster_pre_event_time, n_bins * factor)
+        if factor > 1:
+            windows = spike_matrix.rebin(windows, factor)
+        results = []
+        for (_, unit), unit_windows in zip(session_neurons.iterrows(), windows):
+            results.append(self.assemble_unit_rasters(unit['uuid'], unit, events, unit_windows.astype(int)))
+        return results
+
+    def assemble_unit_rasters(self, uuid, unit, events, rasters):
+        """
+        Builds the raster rows of a unit from its (n_events, n_bins) counts.
+        """
+        label_columns = [column for column in events.columns
+                         if column not in ('event_time', 'aligned_to', 'behavior')]
+        unit_rasters = pd.DataFrame({'raster': list(rasters)})
+        for column in label_columns:
+            unit_rasters[column] = events[column].to_numpy()
+        for column in UNIT_COLUMNS:
+            unit_rasters[column] = uuid if column == 'uuid' else unit.get(column)
+        unit_rasters['aligned_to'] = events['aligned_to'].to_numpy()
+        unit_rasters['behavior'] = events['behavior'].to_numpy()
+        return unit_rasters
+
+    def bin_event_windows(self, spike_ticks, event_ticks, edge_ticks):
+        """
+        Counts the spikes around each event in the bins given by edge_ticks,
+        with the bins half-open except for the last, as in np.histogram.
+        Parameters:
+        - spike_ticks (np.ndarray): Sorted spike times in ticks.
+        - event_ticks (np.ndarray): Event times in ticks.
+        - edge_ticks (np.ndarray): Bin edges in ticks relative to the event.
+        Returns:
+        - rasters (np.ndarray): (n_events, len(edge_ticks) - 1) int counts.
+        """
+        n_bins = len(edge_ticks) - 1
+        n_events = len(event_ticks)
+        if n_bins < 1:
+            return np.zeros((n_events, 0), dtype=int)
+        lo = np.searchsorted(spike_ticks, event_ticks + edge_ticks[0], side='left')
+        hi = np.searchsorted(spike_ticks, event_ticks + edge_ticks[-1], side='right')
+        n_in_window = hi - lo
+        event_of_spike = np.repeat(np.arange(n_events), n_in_window)
+        offsets = np.cumsum(n_in_window) - n_in_window
+        spike_index = np.repeat(lo - offsets, n_in_window) + np.arange(n_in_window.sum())
+        relative_ticks = spike_ticks[spike_index] - event_ticks[event_of_spike]
+        spike_bin = np.minimum(np.searchsorted(edge_ticks, relative_ticks, side='right') - 1, n_bins - 1)
+        counts = np.bincount(event_of_spike * n_bins + spike_bin, minlength=n_events * n_bins)
+        return counts.reshape(n_events, n_bins).astype(int)
 
     def save_to_pickle(self, dataframe, filename):
-        with open(filename, 'wb') as f:
+        # Atomic write, the driver picks up session files as soon as they exist
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
             pickle.dump(dataframe, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, filename)
         self.logger.info(f"Data saved to {filename}")
 
     def save_labelled_fixation_rasters(self, labelled_fixation_rasters):
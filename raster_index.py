@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sorted index over the labelled fixation rasters for grouped lookups.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+# Sort order of the raster rows; lookups take a prefix of these keys
+INDEX_KEYS = ['region', 'uuid', 'aligned_to', 'block', 'fix_roi']
+
+
+class RasterIndex:
+    """
+    Labelled fixation rasters sorted by INDEX_KEYS, with a table of group
+    offsets for every key prefix. The rows of any prefix, e.g. one unit, or
+    one unit's mon_down fixations on the eyes, are a contiguous slice found
+    by binary search, so per-unit analyses do not rescan the whole table.
+    Rows keep their original order within a group.
+    """
+    def __init__(self, labelled_fixation_rasters, keys=INDEX_KEYS):
+        self.keys = list(keys)
+        codes, self.values, self.code_of = [], [], []
+        for key in self.keys:
+            key_codes, uniques = pd.factorize(
+                labelled_fixation_rasters[key], sort=True, use_na_sentinel=False)
+            codes.append(key_codes.astype(np.int64))
+            uniques = list(uniques)
+            self.values.append(uniques)
+            self.code_of.append({value: code for code, value in enumerate(uniques)})
+        n_rows = len(labelled_fixation_rasters)
+        order = np.lexsort(codes[::-1]) if codes else np.arange(n_rows)
+        self.table = labelled_fixation_rasters.iloc[order].reset_index(drop=True)
+        codes = [key_codes[order] for key_codes in codes]
+        # Composite integer key of the first k columns, in mixed radix
+        self.radix = [max(len(uniques), 1) for uniques in self.values]
+        if np.prod(np.array(self.radix, dtype=float)) >= 2 ** 62:
+            raise ValueError("Too many distinct key values to index")
+        self.group_keys, self.group_starts, self.group_stops = [], [], []
+        prefix_key = np.zeros(n_rows, dtype=np.int64)
+        for level, key_codes in enumerate(codes):
+            prefix_key = prefix_key * self.radix[level] + key_codes
+            keys, starts = np.unique(prefix_key, return_index=True)
+            self.group_keys.append(keys)
+            self.group_starts.append(starts)
+            self.group_stops.append(np.append(starts[1:], n_rows))
+        self.raster_matrix = self.stack_rasters()
+
+    def __len__(self):
+        return len(self.table)
+
+    def stack_rasters(self):
+        # One (n_rows, n_bins) array when all rasters have the same length,
+        # so that slices of it are views
+        if 'raster' not in self.table.columns or len(self.table) == 0:
+            return None
+        try:
+            return np.stack(self.table['raster'].to_numpy())
+        except ValueError:
+            return None
+
+    def locate(self, *values):
+        """
+        Finds the rows matching a prefix of the index keys.
+        Parameters:
+        - values: Values of the first len(values) keys, e.g. region, uuid.
+        Returns:
+        - rows (slice): Rows of self.table; empty if no row matches.
+        """
+        if len(values) > len(self.keys):
+            raise ValueError(f"At most {len(self.keys)} key values, got {len(values)}")
+        if not values:
+            return slice(0, len(self.table))
+        prefix_key = 0
+        for level, value in enumerate(values):
+            code = self.code_of[level].get(value)
+            if code is None:
+                return slice(0, 0)
+            prefix_key = prefix_key * self.radix[level] + code
+        level = len(values) - 1
+        group = np.searchsorted(self.group_keys[level], prefix_key)
+        if group == len(self.group_keys[level]) or self.group_keys[level][group] != prefix_key:
+            return slice(0, 0)
+        return slice(int(self.group_starts[level][group]), int(self.group_stops[level][group]))
+
+    def count(self, *values):
+        rows = self.locate(*values)
+        return rows.stop - rows.start
+
+    def query(self, *values):
+        """
+        Returns the rows matching a prefix of the index keys as a DataFrame.
+        """
+        return self.table.iloc[self.locate(*values)]
+
+    def get_rasters(self, *values):
+        """
+        Returns the rasters matching a prefix of the index keys.
+        Returns:
+        - rasters (np.ndarray): (n_rows, n_bins) array, a view of the stacked
+        rasters where they have equal lengths.
+        """
+        rows = self.locate(*values)
+        if self.raster_matrix is not None:
+            return self.raster_matrix[rows]
+        rasters = self.table['raster'].iloc[rows].to_numpy()
+        return np.stack(rasters) if len(rasters) else np.empty((0, 0))
+
+    def iter_groups(self, n_levels):
+        """
+        Iterates over the groups of the first n_levels keys in index order.
+        Yields:
+        - values (tuple): Key values of the group.
+        - rows (slice): Rows of the group in self.table.
+        """
+        level = n_levels - 1
+        for prefix_key, start, stop in zip(self.group_keys[level], self.group_starts[level],
+                                           self.group_stops[level]):
+            codes = []
+            for radix in self.radix[level::-1]:
+                prefix_key, code = divmod(int(prefix_key), radix)
+                codes.append(code)
+            values = tuple(self.values[i][code] for i, code in enumerate(codes[::-1]))
+            yield values, slice(int(start), int(stop))
+
+    def unique(self, key, *values):
+        """
+        Returns the distinct values of a key among the rows of a prefix.
+        For the key following the prefix, these are read off the group
+        offset table in index order.
+        """
+        level = self.keys.index(key)
+        rows = self.locate(*values)
+        if level == len(values):
+            first, last = np.searchsorted(self.group_starts[level], [rows.start, rows.stop])
+            codes = self.group_keys[level][first:last] % self.radix[level]
+            return [self.values[level][code] for code in codes]
+        return list(pd.unique(self.table[key].iloc[rows]))
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Time and memory estimates of cluster jobs from recorded runs.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+import tracemalloc
+
+import numpy as np
+
+import job_executor
+
+
+# Allocations a task can be sized to; each task gets the smallest tier that
+# covers its estimate and every tier is submitted as its own job array
+TIME_TIERS = ['00:30:00', '01:00:00', '02:00:00', '06:00:00', '12:00:00', '24:00:00']
+MEM_PER_CPU_TIERS = ['1g', '2g', '4g', '6g', '8g', '16g']
+
+# Run records needed before a job's estimates replace its fixed allocation
+MIN_HISTORY_RECORDS = 5
+
+
+def get_history_path(params):
+    return os.path.join(params['processed_data_dir'], 'job_resource_history.jsonl')
+
+
+def get_rss_mb():
+    """
+    Returns the current resident set size of this process in MB, or None
+    where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+
+
+class SessionUsageMonitor:
+    """
+    Measures the wall time and the memory one session adds on top of what
+    the process held when the session started, e.g. the gaze or rasters
+    preloaded for all sessions of a task. The resident set size is sampled
+    in a background thread; without /proc, allocations traced by tracemalloc
+    are used instead.
+    """
+    def __init__(self, interval_s=0.05):
+        self.interval_s = interval_s
+        self.elapsed_s = None
+        self.base_mem_mb = None
+        self.session_mem_mb = None
+
+    def __enter__(self):
+        self.start_time = time.time()
+        self.base_mem_mb = get_rss_mb()
+        if self.base_mem_mb is None:
+            self.started_tracing = not tracemalloc.is_tracing()
+            if self.started_tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            self.base_traced = tracemalloc.get_traced_memory()[0]
+        else:
+            self.peak_mem_mb = self.base_mem_mb
+            self.stop_event = threading.Event()
+            self.sampler = threading.Thread(target=self.sample_rss, daemon=True)
+            self.sampler.start()
+        return self
+
+    def sample_rss(self):
+        while not self.stop_event.wait(self.interval_s):
+            self.peak_mem_mb = max(self.peak_mem_mb, get_rss_mb() or 0.0)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed_s = time.time() - self.start_time
+        if self.base_mem_mb is None:
+            peak_traced = tracemalloc.get_traced_memory()[1]
+            if self.started_tracing:
+                tracemalloc.stop()
+            self.base_mem_mb = self.base_traced / 1024 ** 2
+            self.session_mem_mb = max(peak_traced - self.base_traced, 0) / 1024 ** 2
+        else:
+            self.stop_event.set()
+            self.sampler.join()
+            self.peak_mem_mb = max(self.peak_mem_mb, get_rss_mb() or 0.0)
+            self.session_mem_mb = self.peak_mem_mb - self.base_mem_mb
+        return False
+
+
+def record_session_usage(params, job_name, session_key, size, usage):
+    """
+    Appends the runtime and memory of one session to the run history.
+    Parameters:
+    - params (dict): Dictionary of parameters.
+    - job_name (str): Name of the job array, e.g. 'joblist_fixations'.
+    - session_key (str or int): Session the record belongs to.
+    - size (int): Size of the session's input, in the job's size unit.
+    - usage (SessionUsageMonitor): Monitor the session was run in.
+    """
+    record = {'job_name': job_name, 'session': session_key, 'size': int(size),
+              'elapsed_s': float(usage.elapsed_s),
+              'session_mem_mb': float(usage.session_mem_mb),
+              'base_mem_mb': float(usage.base_mem_mb), 'time': time.time()}
+    # Single short appends, so that concurrent tasks do not interleave records
+    with open(get_history_path(params), 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def load_history(params, job_name):
+    """
+    Loads the run records of one job from the run history.
+    Parameters:
+    - params (dict): Dictionary of parameters.
+    - job_name (str): Name of the job array.
+    Returns:
+    - records (list): List of record dictionaries.
+    """
+    history_path = get_history_path(params)
+    if not os.path.exists(history_path):
+        return []
+    records = []
+    with open(history_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get('job_name') == job_name:
+                records.append(record)
+    return records
+
+
+def get_raster_session_sizes(session_names, labelled_fixations, labelled_spiketimes):
+    """
+    Returns the raster size of each session, fixations times units.
+    Parameters:
+    - session_names (list): List of session names.
+    - labelled_fixations (pd.DataFrame): Labelled fixations.
+    - labelled_spiketimes (pd.DataFrame): Labelled spiketimes, one row per unit.
+    Returns:
+    - sizes (list): Size of each session, in the order of session_names.
+    """
+    n_fixations = labelled_fixations.groupby('session_name', observed=True).size()
+    n_units = labelled_spiketimes.groupby('session_name', observed=True).size()
+    return [int(n_fixations.get(session, 0)) * int(n_units.get(session, 0))
+            for session in session_names]
+
+
+def fit_linear_cost(sizes, costs):
+    """
+    Fits cost = intercept + slope * size, with both terms kept non-negative.
+    Returns:
+    - (intercept, slope): Coefficients of the fit.
+    """
+    sizes = np.asarray(sizes, dtype=float)
+    costs = np.asarray(costs, dtype=float)
+    if np.ptp(sizes) == 0:
+        return float(costs.max()), 0.0
+    slope, intercept = np.polyfit(sizes, costs, 1)
+    if slope < 0:
+        return float(costs.max()), 0.0
+    return max(float(intercept), 0.0), float(slope)
+
+
+def pick_tier(value, tiers, parse):
+    """
+    Returns the smallest tier that is at least value, or the largest tier.
+    """
+    for tier in tiers:
+        if parse(tier) >= value:
+            return tier
+    return tiers[-1]
+
+
+class ResourceEstimator:
+    """
+    Predicts the runtime and peak memory of a session job from its input size,
+    using the run history of earlier submissions, and plans job arrays with
+    per-tier allocations and small sessions packed into shared tasks.
+    """
+    def __init__(self, params, job_name, cpus_per_task, mem_per_cpu, time_limit):
+        self.params = params
+        self.job_name = job_name
+        self.cpus_per_task = cpus_per_task
+        self.default_mem_per_cpu = mem_per_cpu
+        self.default_time_limit = time_limit
+        self.safety_factor = params.get('resource_safety_factor', 1.5)
+        self.pack_target_s = params.get('job_pack_target_minutes', 30) * 60
+        self.time_model = None
+        self.mem_model = None
+        self.base_mem_mb = 0.0
+        # Records of earlier versions hold the process lifetime peak, which
+        # cannot be attributed to a session
+        records = [r for r in load_history(params, job_name) if 'session_mem_mb' in r]
+        if len(records) >= MIN_HISTORY_RECORDS:
+            sizes = [r['size'] for r in records]
+            self.time_model = fit_linear_cost(sizes, [r['elapsed_s'] for r in records])
+            self.mem_model = fit_linear_cost(sizes, [r['session_mem_mb'] for r in records])
+            # Memory held before any session runs, e.g. preloaded inputs
+            self.base_mem_mb = max(r['base_mem_mb'] for r in records)
+            logging.info(f"Fitted {job_name} resource model on {len(records)} run records")
+
+    def has_model(self):
+        return self.time_model is not None
+
+    def estimate(self, size):
+        """
+        Estimates the resources of one session, including the safety factor.
+        Parameters:
+        - size (int): Input size of the session.
+        Returns:
+        - (elapsed_s, mem_mb): Predicted wall time, and peak memory of a task
+        running the session, its own memory on top of the task's base.
+        """
+        elapsed_s = (self.time_model[0] + self.time_model[1] * size) * self.safety_factor
+        mem_mb = (self.base_mem_mb + self.mem_model[0] + self.mem_model[1] * size) * self.safety_factor
+        return elapsed_s, mem_mb
+
+    def pack_sessions(self, estimates):
+        """
+        Packs sessions shorter than the pack target into shared tasks, first
+        fit decreasing by predicted runtime; longer sessions get their own.
+        Parameters:
+        - estimates (dict): Session key -> (elapsed_s, mem_mb).
+        Returns:
+        - tasks (list): List of (session keys, elapsed_s, mem_mb) per task.
+        """
+        tasks = []
+        for key in sorted(estimates, key=lambda k: -estimates[k][0]):
+            elapsed_s, mem_mb = estimates[key]
+            if elapsed_s < self.pack_target_s:
+                for task in tasks:
+                    if task[1] + elapsed_s <= self.pack_target_s:
+                        task[0].append(key)
+                        task[1] += elapsed_s
+                        task[2] = max(task[2], mem_mb)
+                        break
+                else:
+                    tasks.append([[key], elapsed_s, mem_mb])
+            else:
+                tasks.append([[key], elapsed_s, mem_mb])
+        return [tuple(task) for task in tasks]
+
+    def plan_tasks(self, session_sizes):
+        """
+        Plans the job arrays for a set of sessions. Without enough run history
+        every session keeps the job's fixed allocation and its own task.
+        Parameters:
+        - session_sizes (dict): Session key -> input size.
+        Returns:
+        - plan (list): List of (resources, tasks) per job array, where
+        resources holds mem_per_cpu and time_limit and tasks is a list of
+        lists of session keys.
+        """
+        if not self.has_model():
+            resources = {'mem_per_cpu': self.default_mem_per_cpu,
+                         'time_limit': self.default_time_limit}
+            return [(resources, [[key] for key in session_sizes])]
+        estimates = {key: self.estimate(size) for key, size in session_sizes.items()}
+        tiers = {}
+        for keys, elapsed_s, mem_mb in self.pack_sessions(estimates):
+            time_limit = pick_tier(elapsed_s, TIME_TIERS, job_executor.parse_time_limit)
+            mem_per_cpu = pick_tier(
+                mem_mb * 1024 ** 2 / self.cpus_per_task, MEM_PER_CPU_TIERS,
+                job_executor.parse_memory)
+            if elapsed_s > job_executor.parse_time_limit(time_limit):
+                logging.warning(f"Sessions {keys} are predicted to need {elapsed_s:.0f} s, more than the largest time tier")
+            tiers.setdefault((mem_per_cpu, time_limit), []).append(keys)
+        plan = [({'mem_per_cpu': mem_per_cpu, 'time_limit': time_limit}, tasks)
+                for (mem_per_cpu, time_limit), tasks in tiers.items()]
+        logging.info(f"Planned {sum(len(tasks) for _, tasks in plan)} tasks for {len(session_sizes)} sessions in {len(plan)} resource tiers")
+        return plan
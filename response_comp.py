@@ -18,8 +18,12 @@ from tqdm import tqdm
 import pandas as pd
 
 import util
+import instrumentation
+import response_stats
 import plotter
+import figure_renderer
 from raster import RasterManager
+from raster_index import RasterIndex
 
 class ResponseComparator:
     def __init__(self, params):
@@ -36,6 +40,11 @@ class ResponseComparator:
         logger.addHandler(handler)
         return logger
 
+    def get_n_pre_bins(self):
+        # Raster bins before the event; the rest of each raster follows it
+        return int(round(self.params.get('raster_pre_event_time', 0.5)
+                         / self.params.get('raster_bin_size', 0.001)))
+
     @staticmethod
     def default_dict_function():
         return {
@@ -46,24 +55,24 @@ class ResponseComparator:
             'either': defaultdict(list)
         }
 
-    def calculate_roi_response_for_unit(self, unit, filtered_data, output_base_dir):
+    def calculate_roi_response_for_unit(self, unit, region, raster_index, output_base_dir):
         try:
-            unit_data = filtered_data[filtered_data['uuid'] == unit]
-            if unit_data.empty:
+            unit_key = (region, unit, 'start_time', 'mon_down')
+            rois = raster_index.unique('fix_roi', *unit_key)
+            if not rois:
                 self.logger.info(f"No data for unit {unit}, skipping.")
                 return
-            rois = unit_data['fix_roi'].unique()
-            region = unit_data['region'].iloc[0]
             output_dir = os.path.join(output_base_dir, region)
             os.makedirs(output_dir, exist_ok=True)
+            n_pre_bins = self.get_n_pre_bins()
             pre_means, post_means, pre_errors, post_errors = [], [], [], []
             for roi in rois:
-                roi_data = unit_data[unit_data['fix_roi'] == roi]
-                if roi_data.empty:
+                roi_rasters = raster_index.get_rasters(*unit_key, roi)
+                if len(roi_rasters) == 0:
                     self.logger.info(f"No data for unit {unit} in ROI {roi}, skipping ROI.")
                     continue
-                pre_spikes = np.array([raster[:500] for raster in roi_data['raster']])
-                post_spikes = np.array([raster[500:1000] for raster in roi_data['raster']])
+                pre_spikes = roi_rasters[:, :n_pre_bins]
+                post_spikes = roi_rasters[:, n_pre_bins:]
                 if pre_spikes.ndim != 2 or post_spikes.ndim != 2:
                     self.logger.warning(f"Unexpected array dimensions for unit {unit}, ROI {roi}: pre_spikes {pre_spikes.shape}, post_spikes {post_spikes.shape}. Skipping ROI.")
                     continue
@@ -86,16 +95,16 @@ class ResponseComparator:
                 for j, roi2 in enumerate(rois):
                     if i >= j:
                         continue
-                    roi1_pre = np.array([raster[:500] for raster in unit_data[unit_data['fix_roi'] == roi1]['raster']]).mean(axis=1)
-                    roi2_pre = np.array([raster[:500] for raster in unit_data[unit_data['fix_roi'] == roi2]['raster']]).mean(axis=1)
+                    roi1_pre = raster_index.get_rasters(*unit_key, roi1)[:, :n_pre_bins].mean(axis=1)
+                    roi2_pre = raster_index.get_rasters(*unit_key, roi2)[:, :n_pre_bins].mean(axis=1)
                     if roi1_pre.ndim != 1 or roi2_pre.ndim != 1:
                         self.logger.warning(f"Unexpected array dimensions for statistical comparison: roi1_pre {roi1_pre.shape}, roi2_pre {roi2_pre.shape}. Skipping comparison.")
                         continue
                     t_stat_pre, p_val_pre = ttest_ind(roi1_pre, roi2_pre)
                     if p_val_pre < 0.05:
                         significant_pre[i, j] = True
-                    roi1_post = np.array([raster[500:1000] for raster in unit_data[unit_data['fix_roi'] == roi1]['raster']]).mean(axis=1)
-                    roi2_post = np.array([raster[500:1000] for raster in unit_data[unit_data['fix_roi'] == roi2]['raster']]).mean(axis=1)
+                    roi1_post = raster_index.get_rasters(*unit_key, roi1)[:, n_pre_bins:].mean(axis=1)
+                    roi2_post = raster_index.get_rasters(*unit_key, roi2)[:, n_pre_bins:].mean(axis=1)
                     if roi1_post.ndim != 1 or roi2_post.ndim != 1:
                         self.logger.warning(f"Unexpected array dimensions for statistical comparison: roi1_post {roi1_post.shape}, roi2_post {roi2_post.shape}. Skipping comparison.")
                         continue
@@ -115,27 +124,37 @@ class ResponseComparator:
     def compute_pre_and_post_fixation_response_to_roi_for_each_unit(self, labelled_fixation_rasters):
         root_dir = self.params['root_data_dir']
         use_parallel = self.params.get('use_parallel', False)
-        output_base_dir = util.add_date_dir_to_path(os.path.join(root_dir, 'plots', 'roi_response_comparison_each_unit'))
+        output_base_dir = os.path.join(root_dir, 'plots', 'roi_response_comparison_each_unit')
+        # A stable plot directory lets unchanged figures be skipped across days
+        if self.params.get('use_dated_plot_dirs', True):
+            output_base_dir = util.add_date_dir_to_path(output_base_dir)
         processed_data_file = os.path.join(root_dir, 'processed_data', 'roi_spike_count_comparison_for_each_unit.pkl')
 
-        filtered_data = labelled_fixation_rasters[(labelled_fixation_rasters['block'] == 'mon_down') & (labelled_fixation_rasters['aligned_to'] == 'start_time')]
-        unique_units = filtered_data['uuid'].unique()
+        # Rasters of other event types share the aligned_to and block labels
+        filtered_data = labelled_fixation_rasters[(labelled_fixation_rasters['behavior'] == 'fixation') & (labelled_fixation_rasters['block'] == 'mon_down') & (labelled_fixation_rasters['aligned_to'] == 'start_time')]
 
         if self.params.get('reload_existing_unit_roi_comp_stats') and os.path.exists(processed_data_file):
             with open(processed_data_file, 'rb') as f:
                 self.results = pickle.load(f)
             self.logger.info(f"Loaded existing results from {processed_data_file}")
+        elif self.params.get('use_bulk_unit_stats', True):
+            self.compute_and_plot_unit_stats_in_bulk(filtered_data, output_base_dir, processed_data_file)
         else:
-            if use_parallel:
-                with ThreadPoolExecutor(max_workers=16) as executor:
-                    futures = {executor.submit(self.analyze_and_plot_unit, unit, filtered_data, output_base_dir): unit for unit in unique_units}
-                    for future in tqdm(as_completed(futures), total=len(futures), desc="ROI response comparison computed for unit"):
-                        unit_results = future.result()
+            # Each unit's trials are a contiguous slice of the index
+            raster_index = RasterIndex(filtered_data)
+            unit_regions = [(unit, region) for (region, unit), _ in raster_index.iter_groups(2)]
+            # Timed as one stage; a record per unit would cost more than the unit
+            with instrumentation.stage_timer('response_comp.analyze_units', n_items=len(unit_regions)):
+                if use_parallel:
+                    with ThreadPoolExecutor(max_workers=16) as executor:
+                        futures = {executor.submit(self.analyze_and_plot_unit, unit, region, raster_index, output_base_dir): unit for unit, region in unit_regions}
+                        for future in tqdm(as_completed(futures), total=len(futures), desc="ROI response comparison computed for unit"):
+                            unit_results = future.result()
+                            self.merge_results(self.results, unit_results)
+                else:
+                    for unit, region in tqdm(unit_regions, desc="ROI response comparison computed for unit"):
+                        unit_results = self.analyze_and_plot_unit(unit, region, raster_index, output_base_dir)
                         self.merge_results(self.results, unit_results)
-            else:
-                for unit in tqdm(unique_units, desc="ROI response comparison computed for unit"):
-                    unit_results = self.analyze_and_plot_unit(unit, filtered_data, output_base_dir)
-                    self.merge_results(self.results, unit_results)
             
             with open(processed_data_file, 'wb') as f:
                 pickle.dump(self.results, f)
@@ -146,25 +165,108 @@ class ResponseComparator:
             plotter.plot_pie_charts(region, self.results[region], summary_output_dir)
             plotter.plot_venn_diagrams(region, self.results[region], summary_output_dir)
 
-    def analyze_and_plot_unit(self, unit, filtered_data, output_base_dir):
+    def compute_and_plot_unit_stats_in_bulk(self, filtered_data, output_base_dir, processed_data_file):
+        """
+        Tests all units and ROI comparisons in one vectorized pass, with
+        t-tests or, if params['unit_stats_method'] is 'resampling', with
+        permutation tests and bootstrap intervals. Saves the tidy results
+        table and the per-trial responses next to the significance lists,
+        then renders the unit figures from those summaries in a separate
+        stage, see render_unit_figures.
+        Parameters:
+        - filtered_data (pd.DataFrame): Raster table of the trials to compare.
+        - output_base_dir (str): Directory of the plots.
+        - processed_data_file (str): Path of the pickled significance lists.
+        """
+        trials = response_stats.compute_trial_responses(filtered_data, self.get_n_pre_bins())
+        if self.params.get('unit_stats_method', 'ttest') == 'resampling':
+            with instrumentation.stage_timer('response_stats.compute_unit_roi_resampling_stats', n_items=len(filtered_data)):
+                unit_stats = response_stats.compute_unit_roi_resampling_stats(
+                    filtered_data,
+                    n_permutations=self.params.get('n_permutations', 10000),
+                    n_bootstrap=self.params.get('n_bootstrap', 2000),
+                    seed=self.params.get('resampling_seed', 0),
+                    alpha=self.params.get('unit_stats_alpha', 0.05),
+                    fdr_correction=self.params.get('unit_stats_fdr_correction', False),
+                    n_workers=self.params.get('resampling_workers'),
+                    trials=trials)
+        else:
+            with instrumentation.stage_timer('response_stats.compute_unit_roi_stats', n_items=len(filtered_data)):
+                unit_stats = response_stats.compute_unit_roi_stats(
+                    filtered_data,
+                    alpha=self.params.get('unit_stats_alpha', 0.05),
+                    equal_var=not self.params.get('use_welch_ttest', False),
+                    fdr_correction=self.params.get('unit_stats_fdr_correction', False),
+                    trials=trials)
+        self.unit_stats = unit_stats
+        self.results = response_stats.unit_stats_to_significance_dict(unit_stats)
+        base_path = os.path.splitext(processed_data_file)[0]
+        unit_stats.to_pickle(base_path + '_unit_stats.pkl')
+        trials.to_pickle(base_path + '_unit_trials.pkl')
+        self.logger.info(f"Saved unit stats and trial responses to {base_path}_unit_*.pkl")
+        with open(processed_data_file, 'wb') as f:
+            pickle.dump(self.results, f)
+            self.logger.info(f"Saved results to {processed_data_file}")
+        os.makedirs(output_base_dir, exist_ok=True)
+        for region, region_results in self.results.items():
+            with open(os.path.join(output_base_dir, f'{region}_significant_units.pkl'), 'wb') as f:
+                pickle.dump(region_results, f)
+        if self.params.get('render_unit_figures', True):
+            self.render_unit_figures(trials, unit_stats, output_base_dir)
+
+    def render_unit_figures(self, trials, unit_stats, output_base_dir):
+        """
+        Renders the ROI comparison figure of each unit from the per-trial
+        responses, in a process pool. Figures whose inputs did not change
+        since they were last rendered into output_base_dir are skipped,
+        unless params['force_rerender_figures'] is set; with
+        params['render_significant_units_only'] only units significant in
+        some comparison are drawn.
+        Parameters:
+        - trials (pd.DataFrame): Output of response_stats.compute_trial_responses.
+        - unit_stats (pd.DataFrame): Per unit and comparison test results.
+        - output_base_dir (str): Directory of the plots.
+        Returns:
+        - n_rendered (int): Number of figures rendered.
+        """
+        units = None
+        if self.params.get('render_significant_units_only', False):
+            units = unit_stats.loc[unit_stats['either'], 'uuid'].unique()
+        rois = ['eye_bbox', 'left_obj_bbox', 'right_obj_bbox', 'face_bbox']
+        render_queue = figure_renderer.FigureRenderQueue(
+            n_workers=self.params.get('figure_render_workers'),
+            force=self.params.get('force_rerender_figures', False))
+        for unit, region, pre_data, post_data in response_stats.iter_unit_trial_summaries(trials, rois, units):
+            if not pre_data or not post_data:
+                self.logger.info(f"No valid data to plot for unit {unit}, skipping.")
+                continue
+            unit_output_dir = os.path.join(output_base_dir, region)
+            os.makedirs(unit_output_dir, exist_ok=True)
+            render_queue.add(plotter.plot_roi_comparisons_for_unit,
+                             os.path.join(unit_output_dir, f'unit_{unit}_roi_comparison.png'),
+                             unit, region, pre_data, post_data, unit_output_dir)
+        with instrumentation.stage_timer('response_comp.render_unit_figures', n_items=len(render_queue)):
+            return render_queue.render(desc="ROI response comparison plotted for unit")
+
+    def analyze_and_plot_unit(self, unit, region, raster_index, output_base_dir):
         unit_results = defaultdict(self.default_dict_function)
         try:
-            unit_data = filtered_data[filtered_data['uuid'] == unit]
-            if unit_data.empty:
+            unit_key = (region, unit, 'start_time', 'mon_down')
+            if raster_index.count(*unit_key) == 0:
                 self.logger.info(f"No data for unit {unit}, skipping.")
                 return unit_results
             rois = ['eye_bbox', 'left_obj_bbox', 'right_obj_bbox', 'face_bbox']
-            region = unit_data['region'].iloc[0]
             unit_output_dir = os.path.join(output_base_dir, region)
             os.makedirs(unit_output_dir, exist_ok=True)
+            n_pre_bins = self.get_n_pre_bins()
             pre_data, post_data = {}, {}
             for roi in rois:
-                roi_data = unit_data[unit_data['fix_roi'] == roi]
-                if roi_data.empty:
+                roi_rasters = raster_index.get_rasters(*unit_key, roi)
+                if len(roi_rasters) == 0:
                     self.logger.info(f"No data for unit {unit} in ROI {roi}, skipping ROI.")
                     continue
-                pre_data[roi] = np.array([raster[:500] for raster in roi_data['raster']])
-                post_data[roi] = np.array([raster[500:] for raster in roi_data['raster']])
+                pre_data[roi] = roi_rasters[:, :n_pre_bins]
+                post_data[roi] = roi_rasters[:, n_pre_bins:]
             if not pre_data or not post_data:
                 self.logger.info(f"No valid data to plot for unit {unit}, skipping.")
                 return unit_results
@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Vectorized ROI response statistics for all units at once.
+"""
+
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+
+# ROI comparisons tested for every unit; 'left_right_combined' pools the
+# trials of both objects
+COMPARISONS = [
+    ('eye_bbox', 'left_obj_bbox'),
+    ('eye_bbox', 'right_obj_bbox'),
+    ('eye_bbox', 'left_right_combined'),
+    ('face_bbox', 'left_obj_bbox'),
+    ('face_bbox', 'right_obj_bbox'),
+    ('face_bbox', 'left_right_combined')
+]
+
+COMBINED_ROIS = {'left_right_combined': ['left_obj_bbox', 'right_obj_bbox']}
+
+EPOCHS = ['pre', 'post']
+
+SIGNIFICANCE_KEYS = ['pre', 'post', 'both', 'neither', 'either']
+
+
+def get_comparison_key(roi1, roi2):
+    return roi1 + " vs " + roi2
+
+
+def stack_rasters(rasters):
+    """
+    Stacks a column of equal-length raster arrays into one 2D array.
+    Parameters:
+    - rasters (pd.Series): Column of 1D raster arrays.
+    Returns:
+    - raster_matrix (np.ndarray): (n_trials, n_bins) array.
+    """
+    if len(rasters) == 0:
+        return np.empty((0, 0))
+    return np.stack(rasters.to_numpy())
+
+
+def compute_trial_responses(filtered_data, n_pre_bins=500):
+    """
+    Computes the mean pre- and post-event spike count of every trial of all
+    units in one pass over the stacked rasters.
+    Parameters:
+    - filtered_data (pd.DataFrame): Raster table with uuid, region, fix_roi
+    and raster columns.
+    - n_pre_bins (int): Number of raster bins before the event.
+    Returns:
+    - trials (pd.DataFrame): One row per trial with uuid, region, fix_roi,
+    pre and post.
+    """
+    raster_matrix = stack_rasters(filtered_data['raster']).astype(float)
+    return pd.DataFrame({
+        'uuid': filtered_data['uuid'].to_numpy(),
+        'region': filtered_data['region'].to_numpy(),
+        'fix_roi': filtered_data['fix_roi'].to_numpy(),
+        'pre': raster_matrix[:, :n_pre_bins].mean(axis=1),
+        'post': raster_matrix[:, n_pre_bins:].mean(axis=1)})
+
+
+def compute_group_moments(trials):
+    """
+    Sums the trial responses per unit and ROI, as count, sum and sum of
+    squares per epoch, so that ROIs can be pooled by adding moments.
+    Parameters:
+    - trials (pd.DataFrame): Output of compute_trial_responses.
+    Returns:
+    - moments (pd.DataFrame): Indexed by (uuid, fix_roi), with n_, sum_ and
+    sumsq_ columns for each epoch.
+    """
+    values = trials[EPOCHS]
+    moments = pd.concat(
+        [values.notna().rename(columns=lambda c: f'n_{c}'),
+         values.fillna(0.0).rename(columns=lambda c: f'sum_{c}'),
+         (values.fillna(0.0) ** 2).rename(columns=lambda c: f'sumsq_{c}')], axis=1)
+    moments['uuid'] = trials['uuid'].to_numpy()
+    moments['fix_roi'] = trials['fix_roi'].to_numpy()
+    return moments.groupby(['uuid', 'fix_roi'], sort=False).sum()
+
+
+def get_roi_moments(moments, units, roi):
+    """
+    Returns the moments of one ROI, or a pooled ROI, aligned to units; units
+    without trials on the ROI get zero counts.
+    """
+    rois = COMBINED_ROIS.get(roi, [roi])
+    total = None
+    for r in rois:
+        index = pd.MultiIndex.from_arrays([units, np.full(len(units), r, dtype=object)])
+        roi_moments = moments.reindex(index).fillna(0.0).to_numpy()
+        total = roi_moments if total is None else total + roi_moments
+    return pd.DataFrame(total, columns=moments.columns)
+
+
+def ttest_from_moments(n1, s1, ss1, n2, s2, ss2, equal_var=True):
+    """
+    Two-sample t-tests from per-group count, sum and sum of squares, for
+    arrays of independent tests at once.
+    Parameters:
+    - n1, s1, ss1 (np.ndarray): Count, sum and sum of squares of group 1.
+    - n2, s2, ss2 (np.ndarray): Same for group 2.
+    - equal_var (bool): Student's t-test if True, Welch's t-test otherwise.
+    Returns:
+    - t (np.ndarray): t statistics, NaN where undefined.
+    - p (np.ndarray): Two-sided p-values, NaN where undefined.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m1, m2 = s1 / n1, s2 / n2
+        v1 = (ss1 - n1 * m1 ** 2) / (n1 - 1)
+        v2 = (ss2 - n2 * m2 ** 2) / (n2 - 1)
+        # Rounding can make a zero variance slightly negative
+        v1, v2 = np.clip(v1, 0.0, None), np.clip(v2, 0.0, None)
+        if equal_var:
+            df = n1 + n2 - 2
+            pooled = ((n1 - 1) * v1 + (n2 - 1) * v2) / df
+            se = np.sqrt(pooled * (1 / n1 + 1 / n2))
+        else:
+            a1, a2 = v1 / n1, v2 / n2
+            df = (a1 + a2) ** 2 / (a1 ** 2 / (n1 - 1) + a2 ** 2 / (n2 - 1))
+            se = np.sqrt(a1 + a2)
+        t = (m1 - m2) / se
+        valid = (n1 >= 2) & (n2 >= 2) & np.isfinite(t) & (df > 0)
+        t = np.where(valid, t, np.nan)
+        p = np.full(t.shape, np.nan)
+        p[valid] = 2 * stats.t.sf(np.abs(t[valid]), df[valid])
+    return t, p
+
+
+def fdr_bh(p_values):
+    """
+    Benjamini-Hochberg adjusted p-values; NaNs are ignored and kept.
+    Parameters:
+    - p_values (np.ndarray): Raw p-values.
+    Returns:
+    - p_adjusted (np.ndarray): Adjusted p-values.
+    """
+    p_values = np.asarray(p_values, dtype=float)
+    p_adjusted = np.full(p_values.shape, np.nan)
+    valid = np.flatnonzero(~np.isnan(p_values))
+    if valid.size == 0:
+        return p_adjusted
+    order = valid[np.argsort(p_values[valid])]
+    ranked = p_values[order] * valid.size / np.arange(1, valid.size + 1)
+    ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+    p_adjusted[order] = np.minimum(ranked, 1.0)
+    return p_adjusted
+
+
+def compute_unit_roi_stats(filtered_data, alpha=0.05, equal_var=True,
+                           fdr_correction=False, n_pre_bins=500, trials=None):
+    """
+    Tests the pre- and post-event responses of all units for all ROI
+    comparisons at once.
+    Parameters:
+    - filtered_data (pd.DataFrame): Raster table of the trials to compare.
+    - alpha (float): Significance level.
+    - equal_var (bool): Student's t-test if True, Welch's t-test otherwise.
+    - fdr_correction (bool): Whether significance uses Benjamini-Hochberg
+    adjusted p-values, per comparison and epoch across units.
+    - n_pre_bins (int): Number of raster bins before the event.
+    - trials (pd.DataFrame): Trial responses from compute_trial_responses,
+    if already computed.
+    Returns:
+    - unit_stats (pd.DataFrame): One row per unit and comparison with the
+    trial counts, t statistics, p-values and significance of both epochs.
+    Comparisons where a unit has no trials on either side are left out.
+    """
+    if trials is None:
+        trials = compute_trial_responses(filtered_data, n_pre_bins)
+    moments = compute_group_moments(trials)
+    unit_regions = trials.drop_duplicates('uuid').set_index('uuid')['region']
+    units = unit_regions.index.to_numpy()
+    tables = []
+    for roi1, roi2 in COMPARISONS:
+        g1 = get_roi_moments(moments, units, roi1)
+        g2 = get_roi_moments(moments, units, roi2)
+        table = pd.DataFrame({'uuid': units, 'region': unit_regions.to_numpy(),
+                              'comparison': get_comparison_key(roi1, roi2),
+                              'roi1': roi1, 'roi2': roi2})
+        for epoch in EPOCHS:
+            table[f'n_roi1_{epoch}'] = g1[f'n_{epoch}'].to_numpy().astype(int)
+            table[f'n_roi2_{epoch}'] = g2[f'n_{epoch}'].to_numpy().astype(int)
+            t, p = ttest_from_moments(
+                g1[f'n_{epoch}'].to_numpy(), g1[f'sum_{epoch}'].to_numpy(), g1[f'sumsq_{epoch}'].to_numpy(),
+                g2[f'n_{epoch}'].to_numpy(), g2[f'sum_{epoch}'].to_numpy(), g2[f'sumsq_{epoch}'].to_numpy(),
+                equal_var)
+            table[f't_{epoch}'] = t
+            table[f'p_{epoch}'] = p
+        has_trials = (table['n_roi1_pre'] > 0) & (table['n_roi2_pre'] > 0) & \
+            (table['n_roi1_post'] > 0) & (table['n_roi2_post'] > 0)
+        tables.append(table[has_trials])
+    unit_stats = pd.concat(tables, ignore_index=True)
+    unit_stats['test'] = 'student_t' if equal_var else 'welch_t'
+    return add_significance_columns(unit_stats, alpha, fdr_correction)
+
+
+def add_significance_columns(unit_stats, alpha=0.05, fdr_correction=False):
+    """
+    Adds the per-epoch significance, the pre/post/both/neither category and
+    the either flag from the p_pre and p_post columns.
+    Parameters:
+    - unit_stats (pd.DataFrame): Table with p_pre, p_post and comparison.
+    - alpha (float): Significance level.
+    - fdr_correction (bool): Whether significance uses Benjamini-Hochberg
+    adjusted p-values, per comparison and epoch across units.
+    Returns:
+    - unit_stats (pd.DataFrame): The table with the added columns.
+    """
+    for epoch in EPOCHS:
+        p_column = f'p_{epoch}'
+        if fdr_correction:
+            p_column = f'p_{epoch}_fdr'
+            unit_stats[p_column] = unit_stats.groupby('comparison')[f'p_{epoch}'] \
+                .transform(lambda p: fdr_bh(p.to_numpy()))
+        # NaN p-values count as not significant
+        unit_stats[f'significant_{epoch}'] = (unit_stats[p_column] < alpha).to_numpy()
+    sig_pre, sig_post = unit_stats['significant_pre'], unit_stats['significant_post']
+    unit_stats['category'] = np.select(
+        [sig_pre & sig_post, sig_pre, sig_post], ['both', 'pre', 'post'], 'neither')
+    unit_stats['either'] = sig_pre | sig_post
+    return unit_stats
+
+
+def build_comparison_samples(trials):
+    """
+    Collects, for every unit and comparison with trials on both sides, the
+    trial responses of both groups as one padded row: the n1 roi1 trials
+    followed by the n2 roi2 trials.
+    Parameters:
+    - trials (pd.DataFrame): Output of compute_trial_responses.
+    Returns:
+    - rows (pd.DataFrame): uuid, region, comparison, roi1, roi2, n1 and n2
+    of every test.
+    - samples (np.ndarray): (n_epochs, n_tests, n_max) responses, NaN padded.
+    """
+    group_rows = trials.groupby(['uuid', 'fix_roi'], sort=False).indices
+    unit_regions = trials.drop_duplicates('uuid').set_index('uuid')['region']
+    values = trials[EPOCHS].to_numpy().T
+    empty = np.empty(0, dtype=np.int64)
+    rows, indices = [], []
+    for roi1, roi2 in COMPARISONS:
+        for unit, region in unit_regions.items():
+            idx1 = group_rows.get((unit, roi1), empty)
+            idx2 = np.concatenate([group_rows.get((unit, r), empty)
+                                   for r in COMBINED_ROIS.get(roi2, [roi2])])
+            if idx1.size == 0 or idx2.size == 0:
+                continue
+            rows.append((unit, region, get_comparison_key(roi1, roi2), roi1, roi2,
+                         idx1.size, idx2.size))
+            indices.append(np.concatenate([idx1, idx2]))
+    rows = pd.DataFrame(rows, columns=['uuid', 'region', 'comparison', 'roi1', 'roi2', 'n1', 'n2'])
+    n_max = max((idx.size for idx in indices), default=0)
+    samples = np.full((len(EPOCHS), len(indices), n_max), np.nan)
+    for i, idx in enumerate(indices):
+        samples[:, i, :idx.size] = values[:, idx]
+    return rows, samples
+
+
+def resample_block(samples, n1, n2, n_permutations, n_bootstrap, seed,
+                   ci=0.95, max_batch_elements=20000000):
+    """
+    Permutation p-values and bootstrap confidence intervals of the difference
+    of group means, for a block of tests at once. Every batch of resamples is
+    evaluated for all tests and both epochs as array operations; the pre and
+    post responses of a trial share its permutation.
+    Parameters:
+    - samples (np.ndarray): (n_epochs, n_tests, n_max) padded responses, the
+    n1 group 1 values followed by the n2 group 2 values.
+    - n1, n2 (np.ndarray): Group sizes of each test.
+    - n_permutations (int): Number of label permutations.
+    - n_bootstrap (int): Number of bootstrap resamples.
+    - seed (list): Seed of the block's random generator.
+    - ci (float): Confidence level of the bootstrap interval.
+    - max_batch_elements (int): Bound on the resamples x tests x samples
+    array, sets the batch size.
+    Returns:
+    - block_stats (dict): diff, p, ci_low and ci_high, each (n_epochs, n_tests).
+    """
+    rng = np.random.default_rng(seed)
+    n_epochs, n_tests, n_max = samples.shape
+    n_total = n1 + n2
+    positions = np.arange(n_max)
+    is_group1 = positions[None, :] < n1[:, None]
+    is_group2 = ~is_group1 & (positions[None, :] < n_total[:, None])
+    filled = np.nan_to_num(samples)
+    sum1 = (filled * is_group1).sum(axis=-1)
+    sum_all = filled.sum(axis=-1)
+    diff = sum1 / n1 - (sum_all - sum1) / n2
+    batch_size = max(1, int(max_batch_elements // max(1, n_tests * n_max)))
+
+    # Permutations: the n1 smallest random keys of a test's real samples
+    # form its permuted group 1
+    exceed = np.zeros((n_epochs, n_tests))
+    done = 0
+    while done < n_permutations:
+        batch = min(batch_size, n_permutations - done)
+        keys = rng.random((batch, n_tests, n_max))
+        keys[:, positions[None, :] >= n_total[:, None]] = np.inf
+        thresholds = np.take_along_axis(
+            np.sort(keys, axis=-1), (n1 - 1)[None, :, None], axis=-1)
+        mask = keys <= thresholds
+        perm_sum1 = np.einsum('btn,etn->ebt', mask, filled)
+        perm_diff = perm_sum1 / n1 - (sum_all[:, None] - perm_sum1) / n2
+        exceed += (np.abs(perm_diff) >= np.abs(diff)[:, None] - 1e-12).sum(axis=1)
+        done += batch
+    p = (exceed + 1) / (n_permutations + 1)
+
+    # Bootstrap: resample each group with replacement within its own slots
+    boot_diffs = np.empty((n_epochs, n_bootstrap, n_tests))
+    done = 0
+    while done < n_bootstrap:
+        batch = min(batch_size, n_bootstrap - done)
+        u = rng.random((batch, n_tests, n_max))
+        # Slot j of group 1 draws from [0, n1), of group 2 from [n1, n1 + n2)
+        draw = np.where(is_group1, np.floor(u * n1[:, None]),
+                        n1[:, None] + np.floor(u * n2[:, None])).astype(np.int64)
+        draw = np.minimum(draw, n_max - 1)
+        drawn = np.take_along_axis(
+            np.broadcast_to(filled[:, None], (n_epochs, batch, n_tests, n_max)),
+            np.broadcast_to(draw[None], (n_epochs, batch, n_tests, n_max)), axis=-1)
+        boot_sum1 = (drawn * is_group1).sum(axis=-1)
+        boot_sum2 = (drawn * is_group2).sum(axis=-1)
+        boot_diffs[:, done:done + batch] = boot_sum1 / n1 - boot_sum2 / n2
+        done += batch
+    tail = (1 - ci) / 2 * 100
+    ci_low, ci_high = np.percentile(boot_diffs, [tail, 100 - tail], axis=1)
+    return {'diff': diff, 'p': p, 'ci_low': ci_low, 'ci_high': ci_high}
+
+
+def _resample_block_task(args):
+    return resample_block(*args)
+
+
+def compute_unit_roi_resampling_stats(filtered_data, n_permutations=10000,
+                                      n_bootstrap=2000, seed=0, alpha=0.05,
+                                      fdr_correction=False, ci=0.95,
+                                      tests_per_block=256, n_workers=None,
+                                      n_pre_bins=500, trials=None):
+    """
+    Permutation tests and bootstrap confidence intervals of the difference of
+    mean responses, for all units and ROI comparisons. Tests are split into
+    blocks that run in a process pool; each block has its own generator
+    seeded from (seed, block index), so results do not depend on n_workers.
+    Parameters:
+    - filtered_data (pd.DataFrame): Raster table of the trials to compare.
+    - n_permutations (int): Number of label permutations per test.
+    - n_bootstrap (int): Number of bootstrap resamples per test.
+    - seed (int): Seed of the resampling.
+    - alpha (float): Significance level.
+    - fdr_correction (bool): Whether significance uses Benjamini-Hochberg
+    adjusted p-values, per comparison and epoch across units.
+    - ci (float): Confidence level of the bootstrap intervals.
+    - tests_per_block (int): Number of unit x comparison tests per block.
+    - n_workers (int): Number of worker processes; serial if 1.
+    - n_pre_bins (int): Number of raster bins before the event.
+    - trials (pd.DataFrame): Trial responses from compute_trial_responses,
+    if already computed.
+    Returns:
+    - unit_stats (pd.DataFrame): One row per unit and comparison with the
+    trial counts, mean differences, permutation p-values, bootstrap
+    intervals and significance of both epochs.
+    """
+    if trials is None:
+        trials = compute_trial_responses(filtered_data, n_pre_bins)
+    rows, samples = build_comparison_samples(trials)
+    n1 = rows['n1'].to_numpy()
+    n2 = rows['n2'].to_numpy()
+    tasks = []
+    for block_index, start in enumerate(range(0, len(rows), tests_per_block)):
+        stop = start + tests_per_block
+        block_n_max = int((n1[start:stop] + n2[start:stop]).max())
+        tasks.append((samples[:, start:stop, :block_n_max], n1[start:stop], n2[start:stop],
+                      n_permutations, n_bootstrap, [seed, block_index], ci))
+    if n_workers == 1 or len(tasks) <= 1:
+        block_results = [_resample_block_task(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            block_results = list(executor.map(_resample_block_task, tasks))
+    unit_stats = rows.rename(columns={'n1': 'n_roi1', 'n2': 'n_roi2'})
+    for key in ['diff', 'p', 'ci_low', 'ci_high']:
+        values = np.concatenate([block[key] for block in block_results], axis=1) \
+            if block_results else np.empty((len(EPOCHS), 0))
+        for e, epoch in enumerate(EPOCHS):
+            unit_stats[f'{key}_{epoch}'] = values[e]
+    unit_stats['test'] = 'permutation'
+    return add_significance_columns(unit_stats, alpha, fdr_correction)
+
+
+def new_significance_lists():
+    return {key: defaultdict(list) for key in SIGNIFICANCE_KEYS}
+
+
+def unit_stats_to_significance_dict(unit_stats):
+    """
+    Converts the results table to the nested significance lists used by the
+    summary plots: region -> 'pre'/'post'/'both'/'neither'/'either' ->
+    comparison -> list of units.
+    Parameters:
+    - unit_stats (pd.DataFrame): Output of compute_unit_roi_stats.
+    Returns:
+    - results (defaultdict): Nested significance lists.
+    """
+    results = defaultdict(new_significance_lists)
+    for (region, category, comparison), units in unit_stats.groupby(
+            ['region', 'category', 'comparison'], sort=False)['uuid']:
+        results[region][category][comparison].extend(units.tolist())
+    for (region, comparison), units in unit_stats[unit_stats['either']].groupby(
+            ['region', 'comparison'], sort=False)['uuid']:
+        results[region]['either'][comparison].extend(units.tolist())
+    return results
+
+
+def iter_unit_trial_summaries(trials, rois, units=None):
+    """
+    Yields the compact per-unit summaries the unit figures are drawn from:
+    the mean pre- and post-event response of each trial, by ROI, as
+    (n_trials, 1) arrays so that they plot like the full rasters.
+    Parameters:
+    - trials (pd.DataFrame): Output of compute_trial_responses.
+    - rois (list): ROIs to include.
+    - units (iterable): Units to yield; all units if None.
+    Yields:
+    - (unit, region, pre_data, post_data): ROI -> array dictionaries.
+    """
+    if units is not None:
+        trials = trials[trials['uuid'].isin(set(units))]
+    for unit, unit_trials in trials.groupby('uuid', sort=False):
+        pre_data, post_data = {}, {}
+        for roi, roi_trials in unit_trials.groupby('fix_roi', sort=False):
+            if roi in rois:
+                pre_data[roi] = roi_trials['pre'].to_numpy()[:, None]
+                post_data[roi] = roi_trials['post'].to_numpy()[:, None]
+        yield unit, unit_trials['region'].iloc[0], pre_data, post_data
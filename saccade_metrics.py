@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Kinematic metrics of detected saccades.
+"""
+
+import os
+import logging
+
+import numpy as np
+import pandas as pd
+
+import event_tables
+
+
+# Kinematic columns added to the saccade table; amplitudes in degrees,
+# velocities in degrees per second, direction in degrees counterclockwise
+# from rightward, curvature as maximum deviation from the straight path
+# over amplitude
+METRIC_COLUMNS = ['amplitude', 'peak_velocity', 'mean_velocity', 'direction',
+                  'curvature']
+
+# Columns identifying a saccade across the saccade and metric tables
+KEY_COLUMNS = ['session_name', 'start_idx', 'end_idx', 'category', 'run', 'block']
+
+
+def compute_saccade_metrics(x, y, vel_norm, start_stops):
+    """
+    Computes the kinematics of all saccades of a trace in one segmented pass.
+    Parameters:
+    - x, y (np.ndarray): Smoothed positions in degrees.
+    - vel_norm (np.ndarray): Speed in degrees per second.
+    - start_stops (np.ndarray): (n_saccades, 2) inclusive sample ranges,
+    disjoint and in order.
+    Returns:
+    - metrics (dict): METRIC_COLUMNS -> (n_saccades,) arrays.
+    """
+    start_stops = np.asarray(start_stops, dtype=np.int64).reshape(-1, 2)
+    starts, stops = start_stops[:, 0], start_stops[:, 1]
+    n_saccades = len(starts)
+    if n_saccades == 0:
+        return {column: np.empty(0) for column in METRIC_COLUMNS}
+    n_samples = stops - starts + 1
+    # Reduce over [start, stop + 1) segments; the odd slices between
+    # saccades are dropped, and the padding keeps stop + 1 in bounds
+    bounds = np.column_stack((starts, stops + 1)).ravel()
+    padded_vel = np.append(vel_norm, 0.0)
+    peak_velocity = np.maximum.reduceat(padded_vel, bounds)[::2]
+    mean_velocity = np.add.reduceat(padded_vel, bounds)[::2] / n_samples
+    dx = x[stops] - x[starts]
+    dy = y[stops] - y[starts]
+    amplitude = np.hypot(dx, dy)
+    direction = np.degrees(np.arctan2(dy, dx))
+    # Perpendicular distance of every saccade sample from its start-end
+    # chord, with the samples of all saccades laid end to end
+    offsets = np.cumsum(n_samples) - n_samples
+    saccade_of_sample = np.repeat(np.arange(n_saccades), n_samples)
+    sample = np.repeat(starts - offsets, n_samples) + np.arange(n_samples.sum())
+    deviation = np.abs(dx[saccade_of_sample] * (y[sample] - y[starts][saccade_of_sample])
+                       - dy[saccade_of_sample] * (x[sample] - x[starts][saccade_of_sample]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        curvature = np.maximum.reduceat(deviation, offsets) / amplitude ** 2
+    curvature[amplitude == 0] = np.nan
+    return {'amplitude': amplitude, 'peak_velocity': peak_velocity,
+            'mean_velocity': mean_velocity, 'direction': direction,
+            'curvature': curvature}
+
+
+def get_saccade_metrics_dir(params):
+    return os.path.join(params['processed_data_dir'], 'saccade_metrics')
+
+
+def save_session_saccade_metrics(saccade_table, params, session_name):
+    """
+    Saves the key and metric columns of a session's saccades, written by
+    each fixation job for its own session.
+    Parameters:
+    - saccade_table (pd.DataFrame): Saccades with METRIC_COLUMNS.
+    - params (dict): Dictionary of parameters.
+    - session_name (str): Name of the session.
+    Returns:
+    - file_path (str): Path of the saved table.
+    """
+    metrics_dir = get_saccade_metrics_dir(params)
+    os.makedirs(metrics_dir, exist_ok=True)
+    table = saccade_table[KEY_COLUMNS + METRIC_COLUMNS]
+    if event_tables.is_parquet_available():
+        file_path = os.path.join(metrics_dir, f'{session_name}.parquet')
+        event_tables.save_event_table(table, file_path)
+    else:
+        file_path = os.path.join(metrics_dir, f'{session_name}.csv')
+        table.to_csv(file_path, index=False)
+    return file_path
+
+
+def load_saccade_metrics(params, sessions=None):
+    """
+    Loads the saccade metrics of all, or the given, sessions.
+    Parameters:
+    - params (dict): Dictionary containing the processed data directory.
+    - sessions (list): Session names to load; all sessions if None.
+    Returns:
+    - saccade_metrics (pd.DataFrame): KEY_COLUMNS and METRIC_COLUMNS.
+    """
+    metrics_dir = get_saccade_metrics_dir(params)
+    tables = []
+    if os.path.isdir(metrics_dir):
+        for file_name in sorted(os.listdir(metrics_dir)):
+            session_name, ext = os.path.splitext(file_name)
+            if sessions is not None and session_name not in sessions:
+                continue
+            file_path = os.path.join(metrics_dir, file_name)
+            if ext == '.parquet':
+                tables.append(event_tables.load_event_table(file_path))
+            elif ext == '.csv':
+                tables.append(pd.read_csv(file_path))
+    if not tables:
+        logging.warning(f"No saccade metrics found in {metrics_dir}")
+        return pd.DataFrame(columns=KEY_COLUMNS + METRIC_COLUMNS)
+    return pd.concat(tables, ignore_index=True)
+
+
+def fit_main_sequence(saccade_metrics, by=('category',), min_amplitude=0.5):
+    """
+    Fits the main sequence, log peak velocity against log amplitude, per
+    group of saccades, e.g. per dose category.
+    Parameters:
+    - saccade_metrics (pd.DataFrame): Output of load_saccade_metrics.
+    - by (tuple): Columns to group by.
+    - min_amplitude (float): Smallest amplitude in degrees included in the
+    fit.
+    Returns:
+    - main_sequence (pd.DataFrame): Per group, the number of saccades, the
+    exponent and the peak velocity at 1 degree of the fit
+    peak_velocity = v1 * amplitude ** exponent.
+    """
+    valid = saccade_metrics[(saccade_metrics['amplitude'] >= min_amplitude)
+                            & (saccade_metrics['peak_velocity'] > 0)]
+    log_amplitude = np.log(valid['amplitude'].astype(float))
+    log_velocity = np.log(valid['peak_velocity'].astype(float))
+    groups = [valid[column] for column in by]
+    # Least squares slope and intercept per group from grouped moments
+    moments = pd.DataFrame({'x': log_amplitude, 'y': log_velocity,
+                            'xx': log_amplitude ** 2, 'xy': log_amplitude * log_velocity}) \
+        .groupby(groups, observed=True).agg(['sum', 'size'])
+    n = moments[('x', 'size')]
+    sx, sy = moments[('x', 'sum')], moments[('y', 'sum')]
+    sxx, sxy = moments[('xx', 'sum')], moments[('xy', 'sum')]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        exponent = (n * sxy - sx * sy) / (n * sxx - sx ** 2)
+        intercept = (sy - exponent * sx) / n
+    return pd.DataFrame({'n_saccades': n, 'exponent': exponent,
+                         'v1': np.exp(intercept)}).reset_index()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar table of detected saccades.
+"""
+
+import pandas as pd
+
+
+# Columns of a saccade row; start_idx and end_idx are inclusive sample
+# indices into the session's gaze positions
+SACCADE_COLUMNS = ["start_time", "end_time", "duration", "start_idx", "end_idx",
+                   "start_roi", "end_roi", "session_name", "category", "run",
+                   "block"]
+
+
+class SaccadeTable:
+    """
+    Saccade labels that refer to their trajectories by (session_name,
+    start_idx, end_idx) instead of carrying a copy of the gaze samples. The
+    trajectories are sliced out of the session gaze positions on access.
+    """
+    def __init__(self, table, gaze_store=None):
+        self.table = table
+        self.gaze_store = {} if gaze_store is None else dict(gaze_store)
+
+    @classmethod
+    def from_saccade_rows(cls, saccades, labelled_gaze_positions=None):
+        """
+        Builds a saccade table from the saccade rows of the detectors.
+        Parameters:
+        - saccades (list): List of saccade rows ordered as SACCADE_COLUMNS.
+        - labelled_gaze_positions (list): Optional list of (positions, info)
+        tuples used to resolve trajectories.
+        Returns:
+        - saccade_table (SaccadeTable): The saccade table.
+        """
+        table = pd.DataFrame(saccades, columns=SACCADE_COLUMNS)
+        saccade_table = cls(table)
+        if labelled_gaze_positions is not None:
+            saccade_table.attach_labelled_gaze_positions(labelled_gaze_positions)
+        return saccade_table
+
+    def attach_gaze(self, session_name, positions):
+        self.gaze_store[session_name] = positions
+
+    def attach_labelled_gaze_positions(self, labelled_gaze_positions):
+        for positions, info in labelled_gaze_positions:
+            self.attach_gaze(info['session_name'], positions)
+
+    def __len__(self):
+        return len(self.table)
+
+    def trajectory(self, row):
+        """
+        Returns the gaze samples of one saccade.
+        Parameters:
+        - row (int): Positional row of the saccade in the table.
+        Returns:
+        - trajectory (np.ndarray): (n, 2) view into the session gaze positions.
+        """
+        saccade = self.table.iloc[row]
+        positions = self.gaze_store[saccade['session_name']]
+        return positions[int(saccade['start_idx']):int(saccade['end_idx']) + 1]
+
+    def iter_trajectories(self, session_name=None):
+        """
+        Yields the trajectories of all saccades, or those of one session, as
+        views into the gaze positions, grouped by session.
+        Parameters:
+        - session_name (str): Session to restrict to; all sessions if None.
+        Yields:
+        - trajectory (np.ndarray): (n, 2) view of one saccade.
+        """
+        table = self.table
+        if session_name is not None:
+            table = table[table['session_name'] == session_name]
+        for session, session_saccades in table.groupby('session_name', sort=False, observed=True):
+            positions = self.gaze_store[session]
+            starts = session_saccades['start_idx'].to_numpy()
+            ends = session_saccades['end_idx'].to_numpy()
+            for start, end in zip(starts, ends):
+                yield positions[start:end + 1]
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Manifest of the files in each session folder, with their sizes and
+mtimes.
+"""
+
+import os
+import pickle
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+
+# File kinds found in a session folder and the suffix identifying each
+SESSION_FILE_SUFFIXES = {
+    'metaInfo': 'metaInfo.mat',
+    'runs': 'runs.mat',
+    'M1_farPlaneCal': 'M1_farPlaneCal.mat',
+    'M1_gaze': 'M1_gaze.mat',
+    'spikeTs': 'spikeTs.mat'
+}
+
+# In-memory manifest shared by all loaders: session path -> folder entry
+_session_manifest = {}
+
+
+def get_session_manifest_path(params):
+    """
+    Returns the path of the persisted session manifest.
+    Parameters:
+    - params (dict): Dictionary containing the processed data directory.
+    Returns:
+    - manifest_path (str): Path to the manifest file.
+    """
+    return os.path.join(params['processed_data_dir'], 'session_manifest.pkl')
+
+
+def classify_file_name(file_name):
+    """
+    Finds the kind of a session file from its suffix.
+    Parameters:
+    - file_name (str): Name of the file.
+    Returns:
+    - kind (str or None): Key of SESSION_FILE_SUFFIXES, or None if the file
+    is not one of the known kinds.
+    """
+    for kind, suffix in SESSION_FILE_SUFFIXES.items():
+        if file_name.endswith(suffix):
+            return kind
+    return None
+
+
+def scan_session_folder(session_path):
+    """
+    Lists a session folder once and classifies its files by suffix.
+    Parameters:
+    - session_path (str): Path to the session directory.
+    Returns:
+    - entry (dict): Dictionary with the folder's mtime_ns and, for each file
+    kind, a sorted list of (file name, mtime_ns, size) tuples.
+    """
+    # Taken before listing, so that files added during the scan change it
+    dir_mtime_ns = os.stat(session_path).st_mtime_ns
+    files = {kind: [] for kind in SESSION_FILE_SUFFIXES}
+    with os.scandir(session_path) as it:
+        for dir_entry in it:
+            if not dir_entry.is_file():
+                continue
+            kind = classify_file_name(dir_entry.name)
+            if kind is None:
+                continue
+            stat = dir_entry.stat()
+            files[kind].append((dir_entry.name, stat.st_mtime_ns, stat.st_size))
+    for kind in files:
+        files[kind].sort()
+    return {'dir_mtime_ns': dir_mtime_ns, 'files': files}
+
+
+def is_session_entry_current(session_path, entry):
+    """
+    Checks a stored folder entry without listing the folder: the folder's
+    mtime changes when files are added, removed or renamed, and the files
+    rewritten in place are found by their own size and mtime.
+    Parameters:
+    - session_path (str): Path to the session directory.
+    - entry (dict): Stored folder entry, or None.
+    Returns:
+    - is_current (bool): Whether the entry still describes the folder.
+    """
+    if entry is None or 'dir_mtime_ns' not in entry:
+        return False
+    try:
+        if os.stat(session_path).st_mtime_ns != entry['dir_mtime_ns']:
+            return False
+        for kind_files in entry['files'].values():
+            for name, mtime_ns, size in kind_files:
+                stat = os.stat(os.path.join(session_path, name))
+                if (stat.st_mtime_ns, stat.st_size) != (mtime_ns, size):
+                    return False
+    except OSError:
+        return False
+    return True
+
+
+def refresh_session_entry(session_path, entry):
+    """
+    Returns the stored folder entry if it is current, and a fresh scan of the
+    folder otherwise.
+    Parameters:
+    - session_path (str): Path to the session directory.
+    - entry (dict): Stored folder entry, or None.
+    Returns:
+    - entry (dict): Current folder entry.
+    """
+    if is_session_entry_current(session_path, entry):
+        return entry
+    return scan_session_folder(session_path)
+
+
+def load_or_build_session_manifest(params):
+    """
+    Reuses the persisted entry of every session folder whose mtime and
+    recorded files are unchanged, and lists only the other folders again.
+    The manifest is rewritten only if any file was added, removed or
+    modified.
+    Parameters:
+    - params (dict): Dictionary containing session paths and the processed
+    data directory.
+    Returns:
+    - manifest (dict): Dictionary of session path to folder entry.
+    """
+    session_paths = params['session_paths']
+    manifest_path = get_session_manifest_path(params)
+    cached_manifest = {}
+    if os.path.exists(manifest_path) and \
+            not params.get('rescan_session_folders', False):
+        try:
+            with open(manifest_path, 'rb') as f:
+                cached_manifest = pickle.load(f)
+        except Exception as e:
+            logging.warning(f"Could not read session manifest {manifest_path}: {e}")
+    manifest = {}
+    num_workers = max(1, min(multiprocessing.cpu_count(), len(session_paths)))
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        cached_entries = [cached_manifest.get(session_path) for session_path in session_paths]
+        for session_path, entry in zip(session_paths, executor.map(
+                refresh_session_entry, session_paths, cached_entries)):
+            manifest[session_path] = entry
+    changed_paths = [session_path for session_path in session_paths
+                     if cached_manifest.get(session_path) != manifest[session_path]]
+    if changed_paths:
+        logging.info(f"Files changed in {len(changed_paths)} of {len(session_paths)} session folders")
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        tmp_path = manifest_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(manifest, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, manifest_path)
+    _session_manifest.update(manifest)
+    return manifest
+
+
+def get_session_entry(session_path):
+    """
+    Returns the manifest entry of a session, scanning the folder on first use
+    if the manifest was not loaded for it.
+    Parameters:
+    - session_path (str): Path to the session directory.
+    Returns:
+    - entry (dict): Folder entry of the session.
+    """
+    entry = _session_manifest.get(session_path)
+    if entry is None:
+        entry = scan_session_folder(session_path)
+        _session_manifest[session_path] = entry
+    return entry
+
+
+def find_session_files(session_path, kind):
+    """
+    Returns the files of one kind in a session folder, like a glob on the
+    kind's suffix but without listing the folder again.
+    Parameters:
+    - session_path (str): Path to the session directory.
+    - kind (str): Key of SESSION_FILE_SUFFIXES.
+    Returns:
+    - file_paths (list): List of matching file paths.
+    """
+    entry = get_session_entry(session_path)
+    return [os.path.join(session_path, name)
+            for name, _, _ in entry['files'][kind]]
+
+
+def get_session_file_mtimes(session_path, kinds):
+    """
+    Returns the names, sizes and mtimes of the files of the given kinds.
+    Parameters:
+    - session_path (str): Path to the session directory.
+    - kinds (list): List of keys of SESSION_FILE_SUFFIXES.
+    Returns:
+    - file_mtimes (dict): Dictionary of kind to tuple of (file name, size,
+    mtime_ns).
+    """
+    entry = get_session_entry(session_path)
+    return {kind: tuple((name, size, mtime_ns) for name, mtime_ns, size in entry['files'][kind])
+            for kind in kinds}
+
+
+def get_source_signature(session_paths, kinds):
+    """
+    Summarises the names, sizes and mtimes of the given file kinds across sessions,
+    e.g. for keying cached results that were computed from those files.
+    Parameters:
+    - session_paths (list): List of session directory paths.
+    - kinds (list): List of keys of SESSION_FILE_SUFFIXES.
+    Returns:
+    - signature (list): List of [session path, file mtimes] pairs.
+    """
+    return [[session_path, get_session_file_mtimes(session_path, kinds)]
+            for session_path in session_paths]
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cached index of the session meta info, rebuilt per session when its
+source files change.
+"""
+
+import os
+import pickle
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+
+import util
+import load_data
+import session_manifest
+
+
+# Session files that the meta info is extracted from
+META_SOURCE_KINDS = ['metaInfo', 'runs', 'M1_farPlaneCal']
+
+# Params that change the ROI bounding box corners stored in the index
+ROI_PARAM_KEYS = [
+    'remap_source_coord_from_inverted_to_standard_y_axis',
+    'map_roi_coord_to_eyelink_space',
+    'inter_eye_dist_denom_for_eye_bbox_offset',
+    'offset_multiples_in_x_dir',
+    'offset_multiples_in_y_dir',
+    'bbox_expansion_factor'
+]
+
+# Bookkeeping columns which are not part of the meta info of a session
+INDEX_COLUMNS = ['session_path', 'source_mtimes', 'roi_signature']
+
+
+def get_session_meta_index_path(params):
+    """
+    Returns the path of the on-disk session meta info index.
+    Parameters:
+    - params (dict): Dictionary containing the processed data directory.
+    Returns:
+    - index_path (str): Path to the index file.
+    """
+    processed_data_dir = params['processed_data_dir']
+    flag_info = util.get_filename_flag_info(params)
+    return os.path.join(processed_data_dir, f'session_meta_index{flag_info}.pkl')
+
+
+def get_roi_signature(params):
+    """
+    Collects the params which affect the ROI corners into a comparable tuple.
+    Parameters:
+    - params (dict): Dictionary of parameters.
+    Returns:
+    - roi_signature (tuple): Tuple of (param name, value) pairs.
+    """
+    return tuple((key, params.get(key)) for key in ROI_PARAM_KEYS)
+
+
+def get_source_mtimes(session_path):
+    """
+    Collects the modification times of the files the meta info is read from.
+    Parameters:
+    - session_path (str): Path to the session directory.
+    Returns:
+    - source_mtimes (dict): Dictionary of file kind to tuple of (file name,
+    size, mtime_ns) triples.
+    """
+    return session_manifest.get_session_file_mtimes(
+        session_path, META_SOURCE_KINDS)
+
+
+def extract_session_meta_entry(session_path, params):
+    """
+    Loads the metaInfo, runs and farPlaneCal files of one session.
+    Parameters:
+    - session_path (str): Path to the session directory.
+    - params (dict): Dictionary of parameters.
+    Returns:
+    - entry (dict): Meta info of the session along with index bookkeeping.
+    """
+    source_mtimes = get_source_mtimes(session_path)
+    entry = {
+        'session_name': os.path.basename(os.path.normpath(session_path))}
+    entry.update(load_data.get_monkey_and_dose_data(session_path))
+    entry.update(load_data.get_runs_data(session_path))
+    entry['roi_bb_corners'] = \
+        load_data.load_farplane_cal_and_get_bl_and_tr_roi_coords_m1(
+            session_path, params)
+    entry.update({'session_path': session_path,
+                  'source_mtimes': source_mtimes,
+                  'roi_signature': get_roi_signature(params)})
+    return entry
+
+
+def is_entry_stale(entry, session_path, params):
+    """
+    Checks if an index entry has to be rebuilt.
+    Parameters:
+    - entry (dict or None): Cached index entry for the session.
+    - session_path (str): Path to the session directory.
+    - params (dict): Dictionary of parameters.
+    Returns:
+    - is_stale (bool): True if the entry is missing or out of date.
+    """
+    if entry is None:
+        return True
+    if entry.get('roi_signature') != get_roi_signature(params):
+        return True
+    return entry.get('source_mtimes') != get_source_mtimes(session_path)
+
+
+def load_session_meta_index(index_path):
+    """
+    Loads the session meta info index from disk.
+    Parameters:
+    - index_path (str): Path to the index file.
+    Returns:
+    - entries (dict): Dictionary of session name to index entry. Empty if no
+    readable index exists.
+    """
+    if not os.path.exists(index_path):
+        return {}
+    try:
+        with open(index_path, 'rb') as f:
+            index_df = pickle.load(f)
+    except Exception as e:
+        logging.warning(f"Could not read session meta index {index_path}: {e}")
+        return {}
+    return {record['session_name']: record
+            for record in index_df.to_dict('records')}
+
+
+def save_session_meta_index(entries, index_path):
+    """
+    Saves the session meta info index as a single table.
+    Parameters:
+    - entries (list): List of index entries.
+    - index_path (str): Path to the index file.
+    """
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    index_df = pd.DataFrame.from_records(entries)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(index_df, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, index_path)
+
+
+def entry_to_meta_info(entry):
+    """
+    Strips the index bookkeeping and missing values from an index entry.
+    Parameters:
+    - entry (dict): Index entry.
+    Returns:
+    - meta_info (dict): Meta info dictionary as used in params['meta_info_list'].
+    """
+    meta_info = {}
+    for key, value in entry.items():
+        if key in INDEX_COLUMNS:
+            continue
+        # Keys missing for a session are NaN-filled in the table; drop them
+        # again so that the meta info matches what the loaders returned
+        if key not in ('OT_dose', 'NAL_dose') and isinstance(value, float) \
+                and pd.isna(value):
+            continue
+        meta_info[key] = value
+    return meta_info
+
+
+def build_or_load_session_meta_index(params):
+    """
+    Returns the meta info of all sessions, reusing the on-disk index and only
+    re-reading sessions whose source files changed.
+    Parameters:
+    - params (dict): Dictionary containing session paths and the processed
+    data directory.
+    Returns:
+    - meta_info_list (list): List of meta info dictionaries in the order of
+    params['session_paths'].
+    """
+    session_paths = params['session_paths']
+    use_parallel = params.get('use_parallel', True)
+    index_path = get_session_meta_index_path(params)
+    cached_entries = load_session_meta_index(index_path)
+    entries = {}
+    stale_paths = []
+    for session_path in session_paths:
+        session_name = os.path.basename(os.path.normpath(session_path))
+        cached_entry = cached_entries.get(session_name)
+        if is_entry_stale(cached_entry, session_path, params):
+            stale_paths.append(session_path)
+        else:
+            entries[session_path] = cached_entry
+    if stale_paths:
+        logging.info(f"Rebuilding session meta index for {len(stale_paths)} of {len(session_paths)} sessions")
+        if use_parallel:
+            num_workers = min(multiprocessing.cpu_count(), len(stale_paths))
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                futures = {executor.submit(
+                    extract_session_meta_entry, session_path, params):
+                    session_path for session_path in stale_paths}
+                for future in as_completed(futures):
+                    entries[futures[future]] = future.result()
+        else:
+            for session_path in stale_paths:
+                entries[session_path] = extract_session_meta_entry(
+                    session_path, params)
+        save_session_meta_index(
+            [entries[session_path] for session_path in session_paths],
+            index_path)
+    return [entry_to_meta_info(entries[session_path])
+            for session_path in session_paths]
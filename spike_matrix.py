@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Binned spike counts of all units of a session, cached on disk.
+"""
+
+import os
+import json
+import logging
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import timebase
+import artifact_cache
+
+
+# Base bin of the session spike matrices in seconds
+BASE_BIN_SIZE = 0.001
+
+
+class SpikeMatrix:
+    """
+    Spike counts of all units of a session on a fixed time grid: bin k of
+    the matrix covers [t0 + k * bin_size, t0 + (k + 1) * bin_size). The
+    counts may be a memory-mapped array. Event-aligned rasters are windows
+    of it, cut for all units at once by indexing a strided view.
+    """
+    def __init__(self, counts, uuids, bin_ticks, t0_ticks=0, input_hash=''):
+        self.counts = counts
+        self.input_hash = input_hash
+        self.uuids = list(uuids)
+        self.bin_ticks = int(bin_ticks)
+        self.t0_ticks = int(t0_ticks)
+        self.unit_row = {uuid: row for row, uuid in enumerate(self.uuids)}
+
+    @property
+    def bin_size(self):
+        return self.bin_ticks / timebase.TICKS_PER_SECOND
+
+    @property
+    def n_bins(self):
+        return self.counts.shape[1]
+
+    def get_window_starts(self, event_times, pre_event_time):
+        """
+        Returns the matrix bin each event window starts at. Window starts
+        are rounded down to the grid; events on the grid, such as gaze
+        sample times with a base bin of one sample, are aligned exactly.
+        """
+        start_ticks = timebase.seconds_to_ticks(event_times) - timebase.seconds_to_ticks(pre_event_time)
+        return (start_ticks - self.t0_ticks) // self.bin_ticks
+
+    def event_windows(self, event_times, pre_event_time, n_bins, units=None):
+        """
+        Cuts the windows of n_bins base bins starting pre_event_time before
+        each event, for all units at once.
+        Parameters:
+        - event_times (array): Event times in seconds.
+        - pre_event_time (float): Window start before the event in seconds.
+        - n_bins (int): Window length in base bins.
+        - units (list): uuids of the units to return; all if None.
+        Returns:
+        - windows (np.ndarray): (n_units, n_events, n_bins) counts; windows
+        reaching past the matrix are zero outside it.
+        """
+        rows = np.arange(len(self.uuids)) if units is None else \
+            np.array([self.unit_row[uuid] for uuid in units], dtype=np.int64)
+        starts = self.get_window_starts(np.asarray(event_times, dtype=float), pre_event_time)
+        windows = np.zeros((len(rows), len(starts), n_bins), dtype=self.counts.dtype)
+        if n_bins > self.n_bins:
+            inside = np.zeros(len(starts), dtype=bool)
+        else:
+            inside = (starts >= 0) & (starts + n_bins <= self.n_bins)
+            # Strided view of every window of every unit; indexing it copies
+            # only the requested units' windows at the events
+            all_windows = sliding_window_view(self.counts, n_bins, axis=1)
+            windows[:, inside] = all_windows[rows[:, None], starts[inside][None, :]]
+        # Windows overlapping an end of the matrix are filled bin by bin
+        for event in np.flatnonzero(~inside):
+            first, stop = max(starts[event], 0), min(starts[event] + n_bins, self.n_bins)
+            if first < stop:
+                windows[:, event, first - starts[event]:stop - starts[event]] = self.counts[rows, first:stop]
+        return windows
+
+
+def rebin(windows, factor):
+    """
+    Sums consecutive groups of factor bins along the last axis, dropping a
+    trailing partial group.
+    """
+    n_bins = windows.shape[-1] // factor * factor
+    return windows[..., :n_bins].reshape(windows.shape[:-1] + (-1, factor)).sum(axis=-1)
+
+
+def compute_spike_matrix(session_neurons, bin_size=BASE_BIN_SIZE, duration=None):
+    """
+    Bins the spike trains of a session's units into one count matrix, with
+    a single bincount over integer tick bins.
+    Parameters:
+    - session_neurons (pd.DataFrame): Units of the session with 'uuid' and
+    'spikeS' columns.
+    - bin_size (float): Bin size in seconds.
+    - duration (float): Session duration in seconds; up to the last spike
+    if None.
+    Returns:
+    - spike_matrix (SpikeMatrix): Counts as the smallest unsigned dtype
+    that holds them.
+    """
+    bin_ticks = int(timebase.seconds_to_ticks(bin_size))
+    uuids = session_neurons['uuid'].tolist()
+    spike_ticks = [timebase.seconds_to_ticks(np.asarray(spikes, dtype=float).ravel())
+                   for spikes in session_neurons['spikeS']]
+    n_spikes = np.array([len(ticks) for ticks in spike_ticks], dtype=np.int64)
+    all_ticks = np.concatenate(spike_ticks) if spike_ticks else np.empty(0, dtype=np.int64)
+    # The grid starts at 0 unless spikes precede it
+    t0_ticks = min(0, int(all_ticks.min()) // bin_ticks * bin_ticks) if len(all_ticks) else 0
+    spike_bins = (all_ticks - t0_ticks) // bin_ticks
+    n_bins = int(spike_bins.max()) + 1 if len(spike_bins) else 0
+    if duration is not None:
+        n_bins = max(n_bins, int(-(-(timebase.seconds_to_ticks(duration) - t0_ticks) // bin_ticks)))
+    unit_of_spike = np.repeat(np.arange(len(uuids)), n_spikes)
+    counts = np.bincount(unit_of_spike * n_bins + spike_bins, minlength=len(uuids) * n_bins) \
+        .reshape(len(uuids), n_bins)
+    max_count = int(counts.max()) if counts.size else 0
+    dtype = next(dtype for dtype in (np.uint8, np.uint16, np.uint32, np.uint64)
+                 if max_count <= np.iinfo(dtype).max)
+    return SpikeMatrix(counts.astype(dtype), uuids, bin_ticks, t0_ticks)
+
+
+def get_spike_matrix_dir(params):
+    return os.path.join(params['processed_data_dir'], 'spike_matrices')
+
+
+def get_spike_matrix_path(params, session_name):
+    return os.path.join(get_spike_matrix_dir(params), f'{session_name}.npy')
+
+
+def save_spike_matrix(spike_matrix, file_path, input_hash=None):
+    """
+    Saves the counts as .npy, so that they can be memory-mapped, and the
+    units and grid to a .json file next to them.
+    """
+    tmp_path = file_path + '.tmp.npy'
+    np.save(tmp_path, spike_matrix.counts)
+    os.replace(tmp_path, file_path)
+    meta = {'uuids': spike_matrix.uuids, 'bin_ticks': spike_matrix.bin_ticks,
+            't0_ticks': spike_matrix.t0_ticks, 'ticks_per_second': timebase.TICKS_PER_SECOND,
+            'input_hash': input_hash or ''}
+    with open(os.path.splitext(file_path)[0] + '.json', 'w') as f:
+        json.dump(meta, f)
+
+
+def load_spike_matrix(file_path, mmap_mode='r'):
+    """
+    Loads a spike matrix saved by save_spike_matrix.
+    Parameters:
+    - file_path (str): Path of the .npy counts.
+    - mmap_mode (str): np.load mmap_mode; None to read into memory.
+    Returns:
+    - spike_matrix (SpikeMatrix): Matrix with the input hash it was saved
+    with.
+    """
+    with open(os.path.splitext(file_path)[0] + '.json', 'r') as f:
+        meta = json.load(f)
+    if meta.get('ticks_per_second') != timebase.TICKS_PER_SECOND:
+        raise ValueError(f"Spike matrix {file_path} was saved with another tick size")
+    return SpikeMatrix(np.load(file_path, mmap_mode=mmap_mode), meta['uuids'],
+                       meta['bin_ticks'], meta['t0_ticks'], meta['input_hash'])
+
+
+def get_or_build_spike_matrix(session_name, session_neurons, params):
+    """
+    Loads the memory-mapped spike matrix of a session, or computes and saves
+    it if the spike trains or the bin size changed since it was saved.
+    Parameters:
+    - session_name (str): Name of the session.
+    - session_neurons (pd.DataFrame): Units of the session.
+    - params (dict): Dictionary containing the processed data directory and
+    optionally 'spike_matrix_bin_size', default BASE_BIN_SIZE.
+    Returns:
+    - spike_matrix (SpikeMatrix): Spike matrix of the session.
+    """
+    bin_size = float(params.get('spike_matrix_bin_size') or BASE_BIN_SIZE)
+    input_hash = artifact_cache.compute_input_hash(
+        session_neurons['uuid'].tolist(),
+        [np.asarray(spikes, dtype=float) for spikes in session_neurons['spikeS']],
+        float(bin_size), timebase.TICKS_PER_SECOND)
+    file_path = get_spike_matrix_path(params, session_name)
+    if os.path.exists(file_path) and not params.get('remake_spike_matrices', False):
+        try:
+            spike_matrix = load_spike_matrix(file_path)
+            if spike_matrix.input_hash == input_hash:
+                return spike_matrix
+        except Exception as e:
+            logging.warning(f"Could not load spike matrix {file_path}: {e}")
+    spike_matrix = compute_spike_matrix(session_neurons, bin_size)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    save_spike_matrix(spike_matrix, file_path, input_hash)
+    return load_spike_matrix(file_path)
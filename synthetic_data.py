@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic sessions with known fixations, saccades and spike trains.
+"""
+
+import numpy as np
+import pandas as pd
+
+import util
+import defaults
+
+
+ROI_NAMES = ['eye_bbox', 'face_bbox', 'left_obj_bbox', 'right_obj_bbox']
+REGIONS = ['ACC', 'BLA', 'OFC', 'dmPFC']
+
+
+def make_roi_bb_corners(monitor_info=None):
+    """
+    Makes ROI bounding boxes laid out like the task screen: a face in the
+    upper middle with the eyes inside it, and an object on each side below.
+    Parameters:
+    - monitor_info (dict): Monitor info; defaults.fetch_monitor_info() if None.
+    Returns:
+    - roi_bb_corners (dict): ROI name -> {'bottomLeft', 'topRight'} corners.
+    """
+    if monitor_info is None:
+        monitor_info = defaults.fetch_monitor_info()
+    w = monitor_info['horizontal_resolution']
+    h = monitor_info['vertical_resolution']
+    def box(x0, y0, x1, y1):
+        return {'bottomLeft': np.array([x0 * w, y0 * h]),
+                'topRight': np.array([x1 * w, y1 * h])}
+    return {'face_bbox': box(0.35, 0.45, 0.65, 0.95),
+            'eye_bbox': box(0.40, 0.70, 0.60, 0.82),
+            'left_obj_bbox': box(0.05, 0.05, 0.25, 0.35),
+            'right_obj_bbox': box(0.75, 0.05, 0.95, 0.35)}
+
+
+def make_runs(duration_s, n_runs, rng, run_fraction=0.8):
+    """
+    Splits a session into runs separated by breaks.
+    Parameters:
+    - duration_s (float): Session duration in seconds.
+    - n_runs (int): Number of runs.
+    - rng (np.random.Generator): Random generator.
+    - run_fraction (float): Fraction of the session spent in runs.
+    Returns:
+    - startS, stopS (np.ndarray): Run start and stop times in seconds.
+    """
+    slot = duration_s / n_runs
+    run_len = slot * run_fraction
+    starts = np.arange(n_runs) * slot + rng.uniform(0.0, slot - run_len, n_runs)
+    return starts, starts + run_len
+
+
+def min_jerk_profile(n):
+    """
+    Returns the normalised minimum-jerk position profile of a movement of n
+    samples, rising from 0 to 1.
+    """
+    s = np.linspace(0.0, 1.0, n)
+    return 10 * s ** 3 - 15 * s ** 4 + 6 * s ** 5
+
+
+def pick_saccade_target(start, amplitude_px, screen, rng, max_tries=20):
+    """
+    Picks a target amplitude_px away from start that lies on the screen,
+    falling back to a step towards the screen centre.
+    """
+    for _ in range(max_tries):
+        angle = rng.uniform(0, 2 * np.pi)
+        target = start + amplitude_px * np.array([np.cos(angle), np.sin(angle)])
+        if 0 <= target[0] <= screen[0] and 0 <= target[1] <= screen[1]:
+            return target
+    towards_centre = screen / 2 - start
+    norm = np.linalg.norm(towards_centre)
+    if norm == 0:
+        return start + np.array([amplitude_px, 0.0])
+    return start + towards_centre / norm * min(amplitude_px, norm)
+
+
+def make_gaze_session(n_samples, rng, sampling_rate=1 / 1000, monitor_info=None,
+                      fixation_ms=(150, 600), saccade_ms=(80, 100),
+                      saccade_deg=(15, 25), noise_px=1.0, roi_fixation_prob=0.6):
+    """
+    Generates a gaze trace of alternating fixations and minimum-jerk saccades
+    with known start and end samples. Fixations land inside a random ROI with
+    probability roi_fixation_prob, otherwise anywhere on the screen.
+    Parameters:
+    - n_samples (int): Number of gaze samples.
+    - rng (np.random.Generator): Random generator.
+    - sampling_rate (float): Sample period in seconds, as in the MAT files.
+    - monitor_info (dict): Monitor info; defaults.fetch_monitor_info() if None.
+    - fixation_ms (tuple): Range of fixation durations in ms.
+    - saccade_ms (tuple): Range of saccade durations in ms.
+    - saccade_deg (tuple): Range of saccade amplitudes in degrees.
+    - noise_px (float): Standard deviation of the sample noise in px.
+    - roi_fixation_prob (float): Probability that a fixation is on an ROI.
+    Returns:
+    - positions (np.ndarray): (n_samples, 2) gaze positions in px.
+    - fixations (pd.DataFrame): Ground truth fixations with start_idx,
+    end_idx, fix_x and fix_y.
+    - saccades (pd.DataFrame): Ground truth saccades with start_idx, end_idx
+    and amplitude_deg.
+    """
+    if monitor_info is None:
+        monitor_info = defaults.fetch_monitor_info()
+    screen = np.array([monitor_info['horizontal_resolution'],
+                       monitor_info['vertical_resolution']], dtype=float)
+    roi_bb_corners = make_roi_bb_corners(monitor_info)
+    deg_per_px = util.px2deg(1.0, monitor_info)
+    samples_per_ms = 1 / (sampling_rate * 1000)
+    positions = np.empty((n_samples, 2))
+    fixations, saccades = [], []
+    current = screen / 2
+    i = 0
+    while i < n_samples:
+        fix_len = int(rng.uniform(*fixation_ms) * samples_per_ms)
+        end = min(i + fix_len, n_samples)
+        positions[i:end] = current
+        fixations.append((i, end - 1, current[0], current[1]))
+        i = end
+        if i >= n_samples:
+            break
+        sac_len = int(rng.uniform(*saccade_ms) * samples_per_ms)
+        amplitude_px = rng.uniform(*saccade_deg) / deg_per_px
+        if rng.random() < roi_fixation_prob:
+            roi = roi_bb_corners[ROI_NAMES[rng.integers(len(ROI_NAMES))]]
+            target = rng.uniform(roi['bottomLeft'], roi['topRight'])
+        else:
+            target = pick_saccade_target(current, amplitude_px, screen, rng)
+        end = min(i + sac_len, n_samples)
+        profile = min_jerk_profile(sac_len)[:end - i, None]
+        positions[i:end] = current + profile * (target - current)
+        saccades.append((i, end - 1, np.linalg.norm(target - current) * deg_per_px))
+        current = target
+        i = end
+    positions += rng.normal(0.0, noise_px, positions.shape)
+    fixations = pd.DataFrame(fixations, columns=['start_idx', 'end_idx', 'fix_x', 'fix_y'])
+    saccades = pd.DataFrame(saccades, columns=['start_idx', 'end_idx', 'amplitude_deg'])
+    return positions, fixations, saccades
+
+
+def make_session_info(session_name, n_samples, rng, sampling_rate=1 / 1000,
+                      n_runs=4, category='saline', monitor_info=None):
+    """
+    Makes the meta info of a synthetic session as attached to the labelled
+    gaze positions.
+    Returns:
+    - info (dict): Session meta info.
+    """
+    startS, stopS = make_runs(n_samples * sampling_rate, n_runs, rng)
+    return {'session_name': session_name, 'category': category,
+            'sampling_rate': sampling_rate, 'num_runs': n_runs,
+            'startS': startS, 'stopS': stopS,
+            'roi_bb_corners': make_roi_bb_corners(monitor_info)}
+
+
+def get_roi_and_block(x, y, start_time, end_time, info):
+    """
+    Labels events by ROI and block, like the fixation labelling of the
+    pipeline. ROI names are checked in ROI_NAMES order so that eye wins over
+    face.
+    """
+    fix_roi = np.full(len(x), 'out_of_roi', dtype=object)
+    for roi in reversed(ROI_NAMES):
+        corners = info['roi_bb_corners'][roi]
+        inside = (x >= corners['bottomLeft'][0]) & (x <= corners['topRight'][0]) & \
+            (y >= corners['bottomLeft'][1]) & (y <= corners['topRight'][1])
+        fix_roi[inside] = roi
+    startS, stopS = np.asarray(info['startS']), np.asarray(info['stopS'])
+    run = np.searchsorted(startS, start_time, side='right') - 1
+    in_run = (run >= 0) & (end_time <= stopS[np.clip(run, 0, None)])
+    block = np.where(in_run, 'mon_down', 'mon_up').astype(object)
+    block[(start_time < startS[0]) | (end_time > stopS[-1])] = 'discard'
+    # Events before the first run are not in a run
+    return fix_roi, block, pd.array(np.where(run >= 0, run, None), dtype='Int64')
+
+
+def make_labelled_fixations(fixations, info):
+    """
+    Turns ground truth fixations into a labelled fixation table.
+    Parameters:
+    - fixations (pd.DataFrame): Ground truth fixations of make_gaze_session.
+    - info (dict): Session meta info.
+    Returns:
+    - labelled_fixations (pd.DataFrame): Labelled fixations.
+    """
+    sampling_rate = info['sampling_rate']
+    start_time = fixations['start_idx'].to_numpy() * sampling_rate
+    end_time = fixations['end_idx'].to_numpy() * sampling_rate
+    x = fixations['fix_x'].to_numpy()
+    y = fixations['fix_y'].to_numpy()
+    fix_roi, block, run = get_roi_and_block(x, y, start_time, end_time, info)
+    return pd.DataFrame({
+        'start_time': start_time, 'end_time': end_time,
+        'fix_duration': end_time - start_time,
+        'mean_x_pos': x, 'mean_y_pos': y, 'fix_roi': fix_roi,
+        'session_name': info['session_name'], 'category': info['category'],
+        'run': run, 'block': block, 'agent': 'Lynch'})
+
+
+def make_spike_trains(n_units, duration_s, rng, session_name='synthetic',
+                      rate_hz=(1.0, 30.0), event_times=None, response_gain=2.0,
+                      response_window_s=(0.05, 0.25)):
+    """
+    Generates Poisson spike trains. Units with a response to events fire at
+    response_gain times their rate in the window after each event time.
+    Parameters:
+    - n_units (int): Number of units.
+    - duration_s (float): Duration in seconds.
+    - rng (np.random.Generator): Random generator.
+    - session_name (str): Session name of the units.
+    - rate_hz (tuple): Range of baseline firing rates.
+    - event_times (array-like): Optional event times the odd units respond to.
+    - response_gain (float): Rate multiplier in the response window.
+    - response_window_s (tuple): Response window relative to each event.
+    Returns:
+    - labelled_spiketimes (pd.DataFrame): One row per unit, with the columns
+    of the processed spiketimes.
+    """
+    rows = []
+    for unit in range(n_units):
+        rate = rng.uniform(*rate_hz)
+        spikes = np.sort(rng.uniform(0.0, duration_s, rng.poisson(rate * duration_s)))
+        if event_times is not None and unit % 2 == 1:
+            window = response_window_s[1] - response_window_s[0]
+            n_extra = rng.poisson(rate * (response_gain - 1) * window, len(event_times))
+            extra = np.repeat(np.asarray(event_times) + response_window_s[0], n_extra) + \
+                rng.uniform(0.0, window, n_extra.sum())
+            spikes = np.sort(np.concatenate([spikes, extra]))
+        rows.append({'spikeS': spikes, 'spikeMs': spikes * 1000,
+                     'session_name': session_name, 'channel': f'WB{unit // 4 + 1:02d}',
+                     'channel_label': f'SPK{unit // 4 + 1:02d}',
+                     'unit_no_within_channel': unit % 4 + 1, 'unit_label': 'a',
+                     'uuid': f'{session_name}_unit{unit}', 'n_spikes': len(spikes),
+                     'region': REGIONS[unit % len(REGIONS)]})
+    return pd.DataFrame(rows)
+
+
+def make_labelled_fixation_rasters(n_fixations_per_roi, rng, uuid='synthetic_unit0',
+                                   region='ACC', n_bins=1000, rate_hz=10.0,
+                                   bin_size=0.001, roi_gain=None):
+    """
+    Generates binned rasters like the output of the raster stage for one unit,
+    aligned to fixation start in the mon_down block.
+    Parameters:
+    - n_fixations_per_roi (int): Number of fixations on each ROI.
+    - rng (np.random.Generator): Random generator.
+    - uuid (str): Unit id.
+    - region (str): Brain region.
+    - n_bins (int): Bins per raster, pre- and post-event halves.
+    - rate_hz (float): Baseline firing rate.
+    - bin_size (float): Bin size in seconds.
+    - roi_gain (dict): Optional ROI -> post-event rate multiplier.
+    Returns:
+    - rasters (pd.DataFrame): One row per fixation.
+    """
+    if roi_gain is None:
+        roi_gain = {'eye_bbox': 2.0, 'face_bbox': 1.5}
+    rows = []
+    for roi in ROI_NAMES:
+        rates = np.full(n_bins, rate_hz * bin_size)
+        rates[n_bins // 2:] *= roi_gain.get(roi, 1.0)
+        counts = rng.poisson(rates, (n_fixations_per_roi, n_bins))
+        for raster in counts:
+            rows.append({'raster': raster, 'uuid': uuid, 'region': region,
+                         'fix_roi': roi, 'block': 'mon_down',
+                         'aligned_to': 'start_time', 'session_name': 'synthetic'})
+    return pd.DataFrame(rows)
+
+
+def make_synthetic_session(duration_s, seed=0, n_units=16, session_name='synthetic',
+                           sampling_rate=1 / 1000, n_runs=4):
+    """
+    Generates one session with gaze, runs, ROIs, labelled fixations and spike
+    trains that respond to fixation onsets.
+    Parameters:
+    - duration_s (float): Session duration in seconds.
+    - seed (int): Seed of the random generator.
+    - n_units (int): Number of units.
+    - session_name (str): Session name.
+    - sampling_rate (float): Gaze sample period in seconds.
+    - n_runs (int): Number of runs.
+    Returns:
+    - session (dict): Dictionary with positions, info, time_vec, the ground
+    truth fixations and saccades, labelled_fixations and labelled_spiketimes.
+    """
+    rng = np.random.default_rng(seed)
+    n_samples = int(duration_s / sampling_rate)
+    positions, fixations, saccades = make_gaze_session(n_samples, rng, sampling_rate)
+    info = make_session_info(session_name, n_samples, rng, sampling_rate, n_runs)
+    labelled_fixations = make_labelled_fixations(fixations, info)
+    labelled_spiketimes = make_spike_trains(
+        n_units, duration_s, rng, session_name,
+        event_times=labelled_fixations['start_time'].to_numpy())
+    return {'positions': positions, 'info': info,
+            'time_vec': np.arange(n_samples) * sampling_rate,
+            'fixations': fixations, 'saccades': saccades,
+            'labelled_fixations': labelled_fixations,
+            'labelled_spiketimes': labelled_spiketimes}
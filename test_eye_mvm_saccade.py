@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks the saccade times of runs that do not start at the first sample.
+"""
+
+import numpy as np
+
+import synthetic_data
+from eye_mvm_saccade import EyeMVMSaccadeDetector
+
+
+SAMPLING_RATE = 0.001
+
+
+def make_session_with_one_saccade(saccade_start, n_samples=2000, step_px=10, n_steps=10):
+    # Gaze at rest except for a ramp of n_steps samples from saccade_start
+    positions = np.zeros((n_samples, 2))
+    ramp = np.arange(1, n_steps + 1) * step_px
+    positions[saccade_start:saccade_start + n_steps, 0] = ramp
+    positions[saccade_start + n_steps:, 0] = ramp[-1]
+    info = {'session_name': 'synthetic', 'category': 'saline',
+            'sampling_rate': SAMPLING_RATE, 'num_runs': 2,
+            'startS': [0.1, 0.8], 'stopS': [0.5, 1.5],
+            'roi_bb_corners': synthetic_data.make_roi_bb_corners()}
+    return positions, info
+
+
+def test_saccade_times_are_taken_at_session_sample_indices():
+    positions, info = make_session_with_one_saccade(saccade_start=1000)
+    time_vec = np.arange(len(positions)) * SAMPLING_RATE
+    detector = EyeMVMSaccadeDetector((30, 1000), 3, lambda x: x)
+    saccades = detector.extract_saccade_table(positions, time_vec, info)
+    assert len(saccades) == 1
+    saccade = saccades.iloc[0]
+    # The central difference velocity is above threshold from the sample
+    # before the ramp to its last sample; run 1 starts at sample 801, so
+    # run-relative indices would give times around 0.2 s
+    assert saccade['start_idx'] == 999 and saccade['end_idx'] == 1009
+    assert saccade['start_time'] == time_vec[999]
+    assert saccade['end_time'] == time_vec[1009]
+    assert saccade['duration'] == time_vec[1009] - time_vec[999]
+    assert saccade['run'] == 1
+    assert saccade['block'] == 'mon_down'
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks the raster stage against the per-fixation loop it replaced, and the
+spike matrix path against the per-unit path.
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import synthetic_data
+from raster import RasterManager
+
+
+PRE_EVENT_TIME = 0.5
+POST_EVENT_TIME = 0.5
+
+
+def baseline_process_unit(uuid, session_fixations, session_neurons, raster_bin_size,
+                          raster_pre_event_time, raster_post_event_time):
+    # The rasters of RasterManager.process_unit before it was vectorized
+    neuron_spikes = np.array(session_neurons[session_neurons['uuid'] == uuid]['spikeS'].values[0])
+    bins = np.arange(-raster_pre_event_time, raster_post_event_time, raster_bin_size)
+    results = []
+    for _, fixation in session_fixations.iterrows():
+        for aligned_to in ['start_time', 'end_time']:
+            event_time = float(fixation[aligned_to])
+            relevant_spikes = neuron_spikes[(neuron_spikes >= event_time - raster_pre_event_time)
+                                            & (neuron_spikes < event_time + raster_post_event_time)]
+            raster = np.histogram(relevant_spikes - event_time, bins=bins)[0].astype(int)
+            results.append({'raster': raster, 'fix_roi': fixation['fix_roi'], 'aligned_to': aligned_to})
+    return pd.DataFrame(results)
+
+
+def make_raster_manager(work_dir, raster_bin_size, **params):
+    raster_manager = RasterManager(dict(
+        params, processed_data_dir=work_dir, raster_bin_size=raster_bin_size,
+        raster_pre_event_time=PRE_EVENT_TIME, raster_post_event_time=POST_EVENT_TIME))
+    raster_manager.logger.setLevel(logging.WARNING)
+    return raster_manager
+
+
+@pytest.fixture(scope='module')
+def session():
+    return synthetic_data.make_synthetic_session(60, seed=3, n_units=4)
+
+
+@pytest.mark.parametrize('raster_bin_size', [0.001, 0.01])
+def test_process_unit_matches_baseline(session, raster_bin_size, tmp_path):
+    fixations = session['labelled_fixations']
+    neurons = session['labelled_spiketimes']
+    raster_manager = make_raster_manager(str(tmp_path), raster_bin_size)
+    for uuid in neurons['uuid']:
+        new = raster_manager.process_unit(
+            uuid, fixations, neurons, None, raster_bin_size, PRE_EVENT_TIME, POST_EVENT_TIME)
+        old = baseline_process_unit(
+            uuid, fixations, neurons, raster_bin_size, PRE_EVENT_TIME, POST_EVENT_TIME)
+        # Both emit the onset then the offset of each fixation, in table order
+        assert len(new) == len(old) == 2 * len(fixations)
+        assert (new['fix_roi'].to_numpy() == old['fix_roi'].to_numpy()).all()
+        assert (new['aligned_to'].to_numpy() == old['aligned_to'].to_numpy()).all()
+        np.testing.assert_array_equal(np.stack(new['raster']), np.stack(old['raster']))
+
+
+@pytest.mark.parametrize('raster_bin_size, matrix_bin_size',
+                         [(0.001, 0.001), (0.005, 0.001), (0.01, 0.001), (0.01, None)])
+def test_spike_matrix_path_matches_per_unit_path(session, raster_bin_size, matrix_bin_size,
+                                                 tmp_path):
+    fixations = session['labelled_fixations']
+    neurons = session['labelled_spiketimes']
+    work_dir = str(tmp_path)
+    rasters = {}
+    for use_spike_matrix in [False, True]:
+        raster_manager = make_raster_manager(
+            work_dir, raster_bin_size, use_spike_matrix=use_spike_matrix,
+            spike_matrix_bin_size=matrix_bin_size)
+        session_rasters = raster_manager.generate_session_raster(
+            work_dir + '/synthetic', fixations, neurons)
+        # Units may come back in any order; events keep their order per unit
+        session_rasters = session_rasters.sort_values('uuid', kind='stable')
+        rasters[use_spike_matrix] = np.stack(session_rasters['raster'])
+    assert rasters[True].shape == rasters[False].shape
+    np.testing.assert_array_equal(rasters[True], rasters[False])
+
+
+def test_spike_matrix_path_rejects_incompatible_bin_size(session, tmp_path):
+    fixations = session['labelled_fixations']
+    neurons = session['labelled_spiketimes']
+    raster_manager = make_raster_manager(
+        str(tmp_path), 0.0015, use_spike_matrix=True, spike_matrix_bin_size=0.001)
+    events = raster_manager.get_session_events('synthetic', fixations, None, ['fixation'])
+    with pytest.raises(ValueError):
+        raster_manager.process_session_events_from_spike_matrix(
+            'synthetic', events, neurons, 0.0015, PRE_EVENT_TIME, POST_EVENT_TIME)
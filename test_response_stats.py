@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks the vectorized unit statistics against scipy and statsmodels, and
+the resampling statistics against exact and scipy references.
+"""
+
+import itertools
+import logging
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats
+
+import response_stats
+import synthetic_data
+from raster_index import RasterIndex
+from response_comp import ResponseComparator
+
+
+def get_moments(samples):
+    samples = np.asarray(samples, dtype=float)
+    return len(samples), samples.sum(), (samples ** 2).sum()
+
+
+@pytest.mark.parametrize('equal_var', [True, False])
+def test_ttest_from_moments_matches_scipy(equal_var):
+    rng = np.random.default_rng(0)
+    groups = []
+    for n1, n2, shift in [(2, 2, 0.0), (5, 30, 0.5), (40, 12, -1.0),
+                          (200, 180, 0.1), (3, 500, 2.0)]:
+        groups.append((rng.normal(0, 1, n1), rng.normal(shift, 2, n2)))
+    moments = np.array([get_moments(a) + get_moments(b) for a, b in groups]).T
+    t, p = response_stats.ttest_from_moments(*moments, equal_var=equal_var)
+    for i, (a, b) in enumerate(groups):
+        expected = stats.ttest_ind(a, b, equal_var=equal_var)
+        assert t[i] == pytest.approx(expected.statistic, rel=1e-9)
+        assert p[i] == pytest.approx(expected.pvalue, rel=1e-7)
+
+
+def test_ttest_from_moments_is_nan_where_undefined():
+    # One trial in a group, and two constant groups
+    moments = np.array([get_moments([1.0]) + get_moments([1.0, 2.0, 3.0]),
+                        get_moments([2.0, 2.0]) + get_moments([2.0, 2.0, 2.0])]).T
+    t, p = response_stats.ttest_from_moments(*moments)
+    assert np.isnan(t).all() and np.isnan(p).all()
+
+
+def test_fdr_bh_matches_reference():
+    p_values = np.array([0.01, 0.04, 0.03, 0.005, np.nan, 0.5])
+    # p * n / rank over the valid p-values, made monotone from the largest rank
+    expected = np.array([0.025, 0.05, 0.05, 0.025, np.nan, 0.5])
+    np.testing.assert_allclose(response_stats.fdr_bh(p_values), expected)
+
+
+def test_fdr_bh_matches_statsmodels():
+    multitest = pytest.importorskip('statsmodels.stats.multitest')
+    rng = np.random.default_rng(1)
+    p_values = np.concatenate((rng.uniform(0, 1, 200), rng.uniform(0, 0.01, 20)))
+    _, expected, _, _ = multitest.multipletests(p_values, method='fdr_bh')
+    np.testing.assert_allclose(response_stats.fdr_bh(p_values), expected, rtol=1e-12)
+
+
+def make_unit_rasters():
+    # Units with different trial counts and ROI preferences, some of them
+    # without any response difference
+    rng = np.random.default_rng(4)
+    gains = [{}, {'eye_bbox': 2.0}, {'face_bbox': 1.5, 'left_obj_bbox': 0.5},
+             {'right_obj_bbox': 3.0}, {'eye_bbox': 1.1, 'face_bbox': 1.1}]
+    tables = []
+    for unit, roi_gain in enumerate(gains):
+        tables.append(synthetic_data.make_labelled_fixation_rasters(
+            3 + 4 * unit, rng, uuid=f'unit{unit}',
+            region=synthetic_data.REGIONS[unit % 2], roi_gain=roi_gain))
+    return pd.concat(tables, ignore_index=True)
+
+
+def get_per_unit_results(comparator, rasters, output_dir):
+    # The per-unit scipy path, as analyze_and_plot_unit feeds it
+    results = {}
+    raster_index = RasterIndex(rasters)
+    for (region, unit), _ in raster_index.iter_groups(2):
+        unit_key = (region, unit, 'start_time', 'mon_down')
+        pre_data, post_data = {}, {}
+        for roi in synthetic_data.ROI_NAMES:
+            roi_rasters = raster_index.get_rasters(*unit_key, roi)
+            pre_data[roi] = roi_rasters[:, :500]
+            post_data[roi] = roi_rasters[:, 500:]
+        unit_results = comparator.analyze_significant_differences(
+            unit, region, pre_data, post_data, output_dir)
+        for key, comps in zip(response_stats.SIGNIFICANCE_KEYS, unit_results):
+            for comp, units in comps.items():
+                results.setdefault(region, {}).setdefault(key, {}) \
+                    .setdefault(comp, []).extend(units)
+    return results
+
+
+def flatten_significance_lists(results):
+    # Drops empty lists, which only one of the paths creates
+    plain = {}
+    for region, region_results in results.items():
+        for key, comps in region_results.items():
+            for comp, units in comps.items():
+                if units:
+                    plain[region, key, comp] = sorted(units)
+    return plain
+
+
+def test_bulk_unit_stats_match_per_unit_path(tmp_path):
+    rasters = make_unit_rasters()
+    comparator = ResponseComparator({})
+    comparator.logger.setLevel(logging.WARNING)
+    per_unit_results = get_per_unit_results(comparator, rasters, str(tmp_path))
+    unit_stats = response_stats.compute_unit_roi_stats(rasters)
+    bulk_results = response_stats.unit_stats_to_significance_dict(unit_stats)
+    assert flatten_significance_lists(bulk_results) == flatten_significance_lists(per_unit_results)
+    assert unit_stats['significant_pre'].any() and not unit_stats['either'].all()
+    # Same p-values as scipy on the per-trial mean responses
+    trials = response_stats.compute_trial_responses(rasters)
+    for row in unit_stats.itertuples():
+        unit_trials = trials[trials['uuid'] == row.uuid]
+        rois2 = response_stats.COMBINED_ROIS.get(row.roi2, [row.roi2])
+        group1 = unit_trials[unit_trials['fix_roi'] == row.roi1]
+        group2 = unit_trials[unit_trials['fix_roi'].isin(rois2)]
+        for epoch in response_stats.EPOCHS:
+            expected = stats.ttest_ind(group1[epoch], group2[epoch]).pvalue
+            assert getattr(row, f'p_{epoch}') == pytest.approx(expected, rel=1e-7)
+
+
+
+@pytest.mark.parametrize('pre_event_time, bin_size, n_pre_bins',
+                         [(0.5, 0.001, 500), (0.5, 0.01, 50), (0.3, 0.005, 60), (0.2, 0.001, 200)])
+def test_n_pre_bins_follow_raster_params(pre_event_time, bin_size, n_pre_bins):
+    comparator = ResponseComparator({'raster_pre_event_time': pre_event_time,
+                                     'raster_bin_size': bin_size})
+    assert comparator.get_n_pre_bins() == n_pre_bins
+
+def make_resampling_block(groups):
+    # Pads (pre, post) group pairs into the (n_epochs, n_tests, n_max) layout
+    # of build_comparison_samples
+    n1 = np.array([len(g1[0]) for g1, _ in groups])
+    n2 = np.array([len(g2[0]) for _, g2 in groups])
+    samples = np.full((len(response_stats.EPOCHS), len(groups), (n1 + n2).max()), np.nan)
+    for i, (g1, g2) in enumerate(groups):
+        for e in range(len(response_stats.EPOCHS)):
+            samples[e, i, :n1[i] + n2[i]] = np.concatenate([g1[e], g2[e]])
+    return samples, n1, n2
+
+
+def exact_permutation_p(a, b):
+    # Two-sided p-value over all splits of the pooled values
+    pooled = np.concatenate([a, b])
+    observed = abs(a.mean() - b.mean())
+    n_extreme, n_splits = 0, 0
+    for group1 in itertools.combinations(range(len(pooled)), len(a)):
+        mask = np.zeros(len(pooled), dtype=bool)
+        mask[list(group1)] = True
+        n_extreme += abs(pooled[mask].mean() - pooled[~mask].mean()) >= observed - 1e-12
+        n_splits += 1
+    return n_extreme / n_splits
+
+
+def test_resample_block_p_matches_exact_permutation_test():
+    rng = np.random.default_rng(7)
+    groups = []
+    for n1, n2, shift in [(3, 4, 0.0), (4, 4, 1.5), (2, 6, 3.0), (5, 3, 0.7)]:
+        groups.append(([rng.normal(0, 1, n1), rng.normal(0, 1, n1)],
+                       [rng.normal(shift, 1, n2), rng.normal(-shift, 1, n2)]))
+    samples, n1, n2 = make_resampling_block(groups)
+    n_permutations = 40000
+    block_stats = response_stats.resample_block(samples, n1, n2, n_permutations, 10, [0, 0])
+    for i, (g1, g2) in enumerate(groups):
+        for e in range(len(response_stats.EPOCHS)):
+            exact = exact_permutation_p(g1[e], g2[e])
+            # Monte Carlo p-values are (exceed + 1) / (n + 1), within a few
+            # standard errors of the exact p-value
+            assert block_stats['diff'][e, i] == pytest.approx(g1[e].mean() - g2[e].mean())
+            assert block_stats['p'][e, i] == pytest.approx(
+                exact, abs=4 * np.sqrt(exact * (1 - exact) / n_permutations) + 2e-4)
+
+
+def test_resample_block_ci_matches_scipy_bootstrap():
+    rng = np.random.default_rng(8)
+    groups = []
+    for n1, n2, shift in [(20, 25, 0.0), (12, 40, 1.0), (30, 8, -2.0)]:
+        groups.append(([rng.normal(0, 1, n1), rng.exponential(1, n1)],
+                       [rng.normal(shift, 2, n2), rng.exponential(2, n2)]))
+    samples, n1, n2 = make_resampling_block(groups)
+    n_bootstrap = 20000
+    block_stats = response_stats.resample_block(samples, n1, n2, 10, n_bootstrap, [0, 0])
+    for i, (g1, g2) in enumerate(groups):
+        for e in range(len(response_stats.EPOCHS)):
+            expected = stats.bootstrap(
+                (g1[e], g2[e]), lambda x, y, axis: x.mean(axis=axis) - y.mean(axis=axis),
+                n_resamples=n_bootstrap, confidence_level=0.95, method='percentile',
+                random_state=np.random.default_rng(i))
+            # Both are Monte Carlo estimates of the same percentiles
+            tolerance = 0.1 * expected.standard_error
+            assert block_stats['ci_low'][e, i] == pytest.approx(
+                expected.confidence_interval.low, abs=tolerance)
+            assert block_stats['ci_high'][e, i] == pytest.approx(
+                expected.confidence_interval.high, abs=tolerance)
+
+
+def test_resampling_stats_do_not_depend_on_n_workers():
+    rasters = make_unit_rasters()
+    trials = response_stats.compute_trial_responses(rasters)
+    unit_stats = {}
+    for n_workers in [1, 3]:
+        unit_stats[n_workers] = response_stats.compute_unit_roi_resampling_stats(
+            rasters, n_permutations=500, n_bootstrap=200, seed=11,
+            tests_per_block=4, n_workers=n_workers, trials=trials)
+    assert len(unit_stats[1]) > 3 * 4
+    pd.testing.assert_frame_equal(unit_stats[1], unit_stats[3])
+    # A different seed gives different resamples
+    other = response_stats.compute_unit_roi_resampling_stats(
+        rasters, n_permutations=500, n_bootstrap=200, seed=12,
+        tests_per_block=4, n_workers=1, trials=trials)
+    assert not np.array_equal(other['p_pre'], unit_stats[1]['p_pre'])
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks that the saccade labels survive a save and load, and that their
+trajectories are recovered from the session gaze.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import synthetic_data
+import fix_and_saccades
+import load_data
+from saccade_table import SaccadeTable, SACCADE_COLUMNS
+
+
+@pytest.fixture(scope='module')
+def session():
+    return synthetic_data.make_synthetic_session(20, seed=5, n_units=1)
+
+
+def make_labelled_saccades(session):
+    saccades = session['saccades']
+    sample_ranges = np.stack([saccades['start_idx'], saccades['end_idx']])
+    rows = fix_and_saccades.format_saccades(sample_ranges, session['positions'], session['info'])
+    return pd.DataFrame(rows, columns=SACCADE_COLUMNS)
+
+
+@pytest.mark.parametrize('event_table_format', ['parquet', 'csv'])
+def test_saccade_labels_round_trip(session, event_table_format, tmp_path):
+    params = {'processed_data_dir': str(tmp_path), 'event_table_format': event_table_format}
+    labelled_saccades = make_labelled_saccades(session)
+    fix_and_saccades.save_saccade_labels(labelled_saccades, params)
+    loaded = load_data.load_saccade_labels(params)
+    assert list(loaded.columns) == SACCADE_COLUMNS
+    assert len(loaded) == len(labelled_saccades) > 0
+    for column in SACCADE_COLUMNS:
+        expected = labelled_saccades[column].to_numpy(dtype=object)
+        actual = loaded[column].to_numpy(dtype=object)
+        if column == 'run':
+            # All saccades are unassigned before the runs are labelled
+            assert pd.isna(actual).all() and pd.isna(expected).all()
+        elif column in ['start_time', 'end_time', 'duration']:
+            np.testing.assert_allclose(actual.astype(float), expected.astype(float))
+        else:
+            assert (actual == expected).all(), column
+
+
+def test_trajectories_are_recovered_from_session_gaze(session, tmp_path):
+    params = {'processed_data_dir': str(tmp_path)}
+    fix_and_saccades.save_saccade_labels(make_labelled_saccades(session), params)
+    loaded = load_data.load_saccade_labels(params, sessions=[session['info']['session_name']])
+    saccade_table = SaccadeTable(loaded)
+    saccade_table.attach_gaze(session['info']['session_name'], session['positions'])
+    expected = [session['positions'][start:end + 1]
+                for start, end in zip(session['saccades']['start_idx'], session['saccades']['end_idx'])]
+    trajectories = list(saccade_table.iter_trajectories())
+    assert len(trajectories) == len(expected)
+    for row, (trajectory, gaze) in enumerate(zip(trajectories, expected)):
+        np.testing.assert_array_equal(trajectory, gaze)
+        np.testing.assert_array_equal(saccade_table.trajectory(row), gaze)
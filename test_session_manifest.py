@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks that the session manifest reuses the stored entries of unchanged
+session folders and rescans the changed ones.
+"""
+
+import os
+
+import pytest
+
+import session_manifest
+
+
+@pytest.fixture
+def sessions(tmp_path, monkeypatch):
+    session_paths = []
+    for name in ['session_a', 'session_b']:
+        session_path = tmp_path / 'data' / name
+        session_path.mkdir(parents=True)
+        for suffix in ['metaInfo.mat', 'M1_gaze.mat']:
+            (session_path / f'{name}_{suffix}').write_bytes(b'0' * 10)
+        session_paths.append(str(session_path))
+    scanned = []
+    scan_session_folder = session_manifest.scan_session_folder
+    def counting_scan(session_path):
+        scanned.append(session_path)
+        return scan_session_folder(session_path)
+    monkeypatch.setattr(session_manifest, 'scan_session_folder', counting_scan)
+    params = {'session_paths': session_paths, 'processed_data_dir': str(tmp_path / 'processed')}
+    return params, scanned
+
+
+def set_mtime_ns(path, mtime_ns):
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_unchanged_folders_are_not_listed_again(sessions):
+    params, scanned = sessions
+    first = session_manifest.load_or_build_session_manifest(params)
+    assert sorted(scanned) == sorted(params['session_paths'])
+    scanned.clear()
+    assert session_manifest.load_or_build_session_manifest(params) == first
+    assert scanned == []
+
+
+def test_changed_folders_are_rescanned(sessions):
+    params, scanned = sessions
+    session_a, session_b = params['session_paths']
+    session_manifest.load_or_build_session_manifest(params)
+    # A file rewritten in place leaves the folder mtime unchanged
+    gaze_file = os.path.join(session_a, 'session_a_M1_gaze.mat')
+    folder_mtime_ns = os.stat(session_a).st_mtime_ns
+    with open(gaze_file, 'wb') as f:
+        f.write(b'1' * 20)
+    set_mtime_ns(session_a, folder_mtime_ns)
+    # A new file changes the folder mtime
+    with open(os.path.join(session_b, 'session_b_runs.mat'), 'wb') as f:
+        f.write(b'0')
+    set_mtime_ns(session_b, os.stat(session_b).st_mtime_ns + 1)
+    scanned.clear()
+    manifest = session_manifest.load_or_build_session_manifest(params)
+    assert sorted(scanned) == [session_a, session_b]
+    assert manifest[session_a]['files']['M1_gaze'][0][2] == 20
+    assert [name for name, _, _ in manifest[session_b]['files']['runs']] == ['session_b_runs.mat']
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks the vectorized helpers in util against the loops they replaced.
+"""
+
+import numpy as np
+import pytest
+
+import util
+
+
+def baseline_find_islands(binary_vec, min_samples=0):
+    islands = []
+    island_started = False
+    island_start = 0
+    for i, val in enumerate(binary_vec):
+        if val == 1 and not island_started:
+            island_started = True
+            island_start = i
+        elif val == 0 and island_started:
+            island_started = False
+            if i - island_start >= min_samples:
+                islands.append([island_start, i - 1])
+    if island_started and len(binary_vec) - island_start >= min_samples:
+        islands.append([island_start, len(binary_vec) - 1])
+    return np.array(islands)
+
+
+def baseline_determine_block(start_time, end_time, startS, stopS):
+    if start_time < startS[0] or end_time > stopS[-1]:
+        return 'discard'
+    for i, (run_start, run_stop) in enumerate(zip(startS, stopS), start=1):
+        if start_time >= run_start and end_time <= run_stop:
+            return 'mon_down'
+        elif i < len(startS) and end_time <= startS[i]:
+            return 'mon_up'
+    return 'discard'
+
+
+@pytest.mark.parametrize('min_samples', [0, 1, 3, 10])
+def test_find_islands_matches_baseline(min_samples):
+    rng = np.random.default_rng(0)
+    vectors = [np.zeros(20, dtype=int), np.ones(20, dtype=int), np.array([1]),
+               np.array([0, 1, 1, 0, 1]), np.array([1, 0, 0, 1, 1, 1])]
+    vectors += [(rng.uniform(size=500) < density).astype(int)
+                for density in (0.1, 0.5, 0.9)]
+    for binary_vec in vectors:
+        islands = util.find_islands(binary_vec, min_samples)
+        expected = baseline_find_islands(binary_vec, min_samples)
+        if expected.size == 0:
+            assert islands.size == 0
+        else:
+            np.testing.assert_array_equal(islands, expected)
+
+
+def make_runs_and_events(rng, n_runs, n_events):
+    starts = np.sort(rng.uniform(0, 100, n_runs))
+    stops = starts + np.diff(np.append(starts, 110)) * rng.uniform(0.3, 1.0, n_runs)
+    start_times = rng.uniform(-5, 115, n_events)
+    end_times = start_times + rng.exponential(3, n_events)
+    return starts, stops, start_times, end_times
+
+
+def test_determine_blocks_matches_baseline():
+    rng = np.random.default_rng(2)
+    for n_runs in (1, 2, 5):
+        startS, stopS, start_times, end_times = make_runs_and_events(rng, n_runs, 2000)
+        blocks = util.determine_blocks(start_times, end_times, startS, stopS)
+        expected = [baseline_determine_block(start, end, startS, stopS)
+                    for start, end in zip(start_times, end_times)]
+        assert list(blocks) == expected
+
+
+def test_determine_blocks_with_per_event_runs_matches_baseline():
+    # Events of sessions with different numbers of runs, padded with NaN
+    rng = np.random.default_rng(3)
+    sessions = [make_runs_and_events(rng, n_runs, 300) for n_runs in (1, 3, 6)]
+    max_runs = max(len(startS) for startS, _, _, _ in sessions)
+    padded_starts, padded_stops, start_times, end_times, expected = [], [], [], [], []
+    for startS, stopS, starts, ends in sessions:
+        pad = np.full(max_runs - len(startS), np.nan)
+        padded_starts.append(np.tile(np.append(startS, pad), (len(starts), 1)))
+        padded_stops.append(np.tile(np.append(stopS, pad), (len(starts), 1)))
+        start_times.append(starts)
+        end_times.append(ends)
+        expected += [baseline_determine_block(start, end, startS, stopS)
+                     for start, end in zip(starts, ends)]
+    blocks = util.determine_blocks(
+        np.concatenate(start_times), np.concatenate(end_times),
+        np.vstack(padded_starts), np.vstack(padded_stops))
+    assert list(blocks) == expected
+
+
+def test_determine_blocks_without_runs():
+    blocks = util.determine_blocks([1.0, 2.0], [1.5, 2.5], [], [])
+    assert list(blocks) == ['discard', 'discard']
+
+
+def test_determine_runs_leaves_events_before_the_first_run_unassigned():
+    startS = [10.0, 40.0, 70.0]
+    runs = util.determine_runs([0.0, 9.9, 10.0, 39.0, 45.0, 70.0, 200.0], startS)
+    assert list(runs.fillna(-1)) == [-1, -1, 0, 0, 1, 2, 2]
+    assert runs.isna().sum() == 2
+
+
+def test_determine_runs_with_per_event_runs():
+    padded_starts = np.array([[10.0, 40.0, np.nan], [10.0, 40.0, np.nan], [5.0, 20.0, 30.0]])
+    runs = util.determine_runs([50.0, 1.0, 25.0], padded_starts)
+    assert list(runs.fillna(-1)) == [1, -1, 1]
+    assert list(util.determine_runs([1.0, 2.0], []).isna()) == [True, True]
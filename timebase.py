@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Integer time ticks for exact comparisons of gaze, event and spike times.
+"""
+
+import numpy as np
+
+
+# Integer ticks used for exact time comparisons across gaze, events and
+# spikes: nanoseconds, fine enough that rounding spike times recorded at
+# any usual sampling rate does not move them across a bin edge
+TICKS_PER_SECOND = 1000000000
+
+
+def seconds_to_ticks(seconds):
+    """
+    Converts times in seconds to int64 ticks, rounding to the nearest tick.
+    """
+    return np.rint(np.asarray(seconds, dtype=float) * TICKS_PER_SECOND).astype(np.int64)
+
+
+def ticks_to_seconds(ticks):
+    return np.asarray(ticks, dtype=np.int64) / TICKS_PER_SECOND
+
+
+class SampleClock:
+    """
+    Time base of a gaze recording: sample i is at i * sampling_rate seconds,
+    with sampling_rate the sample period as stored in the session info. The
+    time vector is never built; times, ticks and sample lookups are computed
+    from indices.
+    """
+    def __init__(self, n_samples, sampling_rate):
+        self.n_samples = int(n_samples)
+        self.sampling_rate = float(sampling_rate)
+        self.period_ticks = int(round(self.sampling_rate * TICKS_PER_SECOND))
+
+    def __len__(self):
+        return self.n_samples
+
+    def times(self, indices=None):
+        """
+        Returns the time in seconds of the given samples, equal to the
+        entries of util.create_timevec; all samples if indices is None.
+        """
+        if indices is None:
+            indices = np.arange(self.n_samples)
+        return np.asarray(indices) * self.sampling_rate
+
+    def ticks(self, indices):
+        return np.asarray(indices, dtype=np.int64) * self.period_ticks
+
+    def searchsorted(self, seconds, side='left'):
+        """
+        Returns the sample indices np.searchsorted would return on the time
+        vector, without building it.
+        Parameters:
+        - seconds (float or array): Times to look up.
+        - side (str): 'left' for the first sample at or after each time,
+        'right' for the first sample after it.
+        Returns:
+        - indices (np.ndarray): Sample indices in [0, n_samples].
+        """
+        seconds = np.asarray(seconds, dtype=float)
+        guess = np.ceil(seconds / self.sampling_rate)
+        guess = np.clip(np.nan_to_num(guess, nan=self.n_samples), 0, self.n_samples).astype(np.int64)
+        # The float division can be off by a sample against the products the
+        # time vector holds; step to the exact insertion point
+        while True:
+            too_high = (guess > 0) & ~self._is_before(guess - 1, seconds, side)
+            too_low = (guess < self.n_samples) & self._is_before(guess, seconds, side)
+            if not (too_high.any() or too_low.any()):
+                return guess
+            guess = guess - too_high + too_low
+
+    def _is_before(self, indices, seconds, side):
+        # Whether the sample belongs before the insertion point of seconds
+        sample_times = indices * self.sampling_rate
+        return sample_times < seconds if side == 'left' else sample_times <= seconds
+
+    def run_sample_bounds(self, startS, stopS):
+        """
+        Returns the sample range of each run, the samples with
+        run_start < t <= run_stop.
+        Returns:
+        - first, stop (np.ndarray): First sample and end (exclusive) of
+        each run.
+        """
+        return self.searchsorted(startS, side='right'), self.searchsorted(stopS, side='right')
+
+
+class ExplicitClock:
+    """
+    Wraps an explicit, sorted time vector in the SampleClock interface.
+    """
+    def __init__(self, time_vec):
+        self.time_vec = np.asarray(time_vec, dtype=float)
+        self.n_samples = len(self.time_vec)
+
+    def __len__(self):
+        return self.n_samples
+
+    def times(self, indices=None):
+        return self.time_vec if indices is None else self.time_vec[indices]
+
+    def ticks(self, indices):
+        return seconds_to_ticks(self.time_vec[indices])
+
+    def searchsorted(self, seconds, side='left'):
+        return np.searchsorted(self.time_vec, seconds, side=side)
+
+    def run_sample_bounds(self, startS, stopS):
+        return self.searchsorted(startS, side='right'), self.searchsorted(stopS, side='right')
+
+
+def as_clock(time_vec_or_clock):
+    """
+    Returns a clock for a SampleClock, ExplicitClock or explicit time vector.
+    """
+    if isinstance(time_vec_or_clock, (SampleClock, ExplicitClock)):
+        return time_vec_or_clock
+    return ExplicitClock(time_vec_or_clock)
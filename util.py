@@ -8,14 +8,13 @@ Created on Wed Apr 10 11:50:13 2024
 
 import os
 import numpy as np
+import pandas as pd
 from math import degrees, atan2, sqrt
 from datetime import datetime
 import itertools
 
 import defaults
 
-import pdb
-
 
 def get_params():
     params = {
@@ -38,7 +37,10 @@ def get_params():
         'bbox_expansion_factor': 1.3,
         'raster_bin_size': 0.001,  # in seconds
         'raster_pre_event_time': 0.5,
-        'raster_post_event_time': 0.5
+        'raster_post_event_time': 0.5,
+        'raster_event_types': ['fixation'],
+        'use_spike_matrix': False,
+        'use_bulk_unit_stats': True
     }
     return params
 
@@ -343,22 +345,15 @@ def find_islands(binary_vec, min_samples=0):
     - binary_vec (array): Binary vector.
     - min_samples (int): Minimum number of samples for an island.
     Returns:
-    - islands (array): Array containing start and stop indices of islands.
-    """
-    islands = []
-    island_started = False
-    island_start = 0
-    for i, val in enumerate(binary_vec):
-        if val == 1 and not island_started:
-            island_started = True
-            island_start = i
-        elif val == 0 and island_started:
-            island_started = False
-            if i - island_start >= min_samples:
-                islands.append([island_start, i - 1])
-    if island_started and len(binary_vec) - island_start >= min_samples:
-        islands.append([island_start, len(binary_vec) - 1])
-    return np.array(islands)
+    - islands (array): (n_islands, 2) array of inclusive start and stop
+    indices of the islands.
+    """
+    binary_vec = np.asarray(binary_vec, dtype=bool)
+    # Rising and falling edges of the zero-padded vector bound the islands
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], binary_vec, [False])).view(np.int8)))
+    starts, stops = edges[0::2], edges[1::2]
+    keep = stops - starts >= min_samples
+    return np.column_stack((starts[keep], stops[keep] - 1))
 
 
 def get_duration(start_stop):
@@ -418,6 +413,124 @@ def is_inside_roi(coord, bbox_corner_dict):
         return [is_inside_single(c[0], c[1]) for c in coord]
 
 
+# ROIs checked in order by determine_rois; the eyes lie inside the face and
+# take precedence over it
+ROI_PRIORITY = ['eye_bbox', 'face_bbox', 'left_obj_bbox', 'right_obj_bbox']
+
+
+def determine_rois(coords, bbox_corners, roi_names=ROI_PRIORITY):
+    """
+    Labels each coordinate with the first ROI in roi_names whose bounding
+    box contains it, edges included.
+    Parameters:
+    - coords (array): (n, 2) array of coordinates.
+    - bbox_corners (dict): ROI name -> 'bottomLeft'/'topRight' corners.
+    - roi_names (list): ROIs in order of precedence.
+    Returns:
+    - rois (np.ndarray): Object array of ROI names, 'out_of_roi' outside
+    all boxes.
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    x, y = coords[:, 0], coords[:, 1]
+    rois = np.full(len(coords), 'out_of_roi', dtype=object)
+    unlabelled = np.ones(len(coords), dtype=bool)
+    for roi_name in roi_names:
+        corners = bbox_corners.get(roi_name)
+        if corners is None:
+            continue
+        bottom_left, top_right = corners['bottomLeft'], corners['topRight']
+        inside = unlabelled & (x >= bottom_left[0]) & (x <= top_right[0]) & \
+            (y >= bottom_left[1]) & (y <= top_right[1])
+        rois[inside] = roi_name
+        unlabelled &= ~inside
+    return rois
+
+
+def determine_rois_by_session(coords, session_codes, bbox_corners_list, roi_names=ROI_PRIORITY):
+    """
+    Labels coordinates of many sessions with ROIs at once, each against the
+    bounding boxes of its own session, with the precedence of determine_rois.
+    Parameters:
+    - coords (array): (n, 2) array of coordinates.
+    - session_codes (array): Index into bbox_corners_list of each coordinate.
+    - bbox_corners_list (list): ROI bounding box dict of each session.
+    - roi_names (list): ROIs in order of precedence.
+    Returns:
+    - rois (np.ndarray): Object array of ROI names, 'out_of_roi' outside
+    all boxes.
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    # (n_sessions, n_rois, 4) table of left, bottom, right, top; NaN for
+    # ROIs a session lacks, which then contain no coordinate
+    corner_table = np.full((len(bbox_corners_list), len(roi_names), 4), np.nan)
+    for i, bbox_corners in enumerate(bbox_corners_list):
+        for j, roi_name in enumerate(roi_names):
+            corners = (bbox_corners or {}).get(roi_name)
+            if corners is not None:
+                corner_table[i, j, :2] = corners['bottomLeft']
+                corner_table[i, j, 2:] = corners['topRight']
+    corners = corner_table[np.asarray(session_codes, dtype=np.int64)]
+    x, y = coords[:, 0, None], coords[:, 1, None]
+    inside = (x >= corners[..., 0]) & (y >= corners[..., 1]) & \
+        (x <= corners[..., 2]) & (y <= corners[..., 3])
+    labels = np.array(list(roi_names) + ['out_of_roi'], dtype=object)
+    return labels[np.where(inside.any(axis=1), inside.argmax(axis=1), len(roi_names))]
+
+
+def determine_blocks(start_times, end_times, startS, stopS):
+    """
+    Labels events by block: 'mon_down' if the event lies within a run,
+    'mon_up' if it ends before the next run starts, and 'discard' if it
+    falls outside the runs or spans a run boundary.
+    Parameters:
+    - start_times, end_times (array): Event start and end times.
+    - startS, stopS (array): Run start and stop times, shared by all events,
+    or (n_events, n_runs) arrays of the runs of each event's session padded
+    with NaN.
+    Returns:
+    - blocks (np.ndarray): Object array of block labels.
+    """
+    start_times = np.asarray(start_times, dtype=float)[:, None]
+    end_times = np.asarray(end_times, dtype=float)[:, None]
+    startS = np.asarray(startS, dtype=float)
+    stopS = np.asarray(stopS, dtype=float)
+    if startS.shape[-1] == 0:
+        return np.full(len(start_times), 'discard', dtype=object)
+    in_run = (start_times >= startS) & (end_times <= stopS)
+    # An event ending before the start of run i + 1 is mon_up after run i
+    before_next = np.zeros_like(in_run)
+    before_next[:, :-1] = end_times <= startS[..., 1:]
+    matches = in_run | before_next
+    # The first matching run decides, as in a scan over the runs
+    first = matches.argmax(axis=1)
+    rows = np.arange(len(first))
+    blocks = np.where(in_run[rows, first], 'mon_down', 'mon_up').astype(object)
+    # Padding is NaN, so the last run is the largest stop that is a number
+    outside = (start_times[:, 0] < startS[..., 0]) | \
+        (end_times[:, 0] > np.fmax.reduce(stopS, axis=-1))
+    blocks[~matches.any(axis=1) | outside] = 'discard'
+    return blocks
+
+
+def determine_runs(start_times, startS):
+    """
+    Returns the run each event belongs to: the last run starting at or
+    before the event. Events before the first run are not in a run and get
+    a missing run, like the None run of the saccade rows.
+    Parameters:
+    - start_times (array): Event start times.
+    - startS (array): Run start times, shared by all events, or
+    (n_events, n_runs) arrays padded with NaN.
+    Returns:
+    - runs (pd.arrays.IntegerArray): Nullable Int64 run indices.
+    """
+    start_times = np.asarray(start_times, dtype=float)[:, None]
+    startS = np.asarray(startS, dtype=float)
+    n_started = (start_times >= startS).sum(axis=1)
+    return pd.arrays.IntegerArray(np.maximum(n_started - 1, 0).astype(np.int64),
+                                  n_started == 0)
+
+
 def distance(point1, point2):
     """
     Calculates the Euclidean distance between two points.
@@ -432,14 +545,30 @@ def distance(point1, point2):
     return sqrt((x2 - x1)**2 + (y2 - y1)**2)
 
 
-def px2deg(px, monitor_info=None):
+def distance2p(x1, y1, x2, y2):
+    """
+    Calculates the Euclidean distance between two points given by their
+    coordinates.
+    Parameters:
+    - x1, y1 (float): Coordinates of the first point.
+    - x2, y2 (float): Coordinates of the second point.
+    Returns:
+    - dist (float): Euclidean distance.
+    """
+    return np.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
+
+
+def get_deg_per_px(monitor_info=None):
     if monitor_info is None:
         monitor_info = defaults.fetch_monitor_info() # in defaults
     h = monitor_info['height']
     d = monitor_info['distance']
     r = monitor_info['vertical_resolution']
-    deg_per_px = degrees(atan2(0.5 * h, d)) / (0.5 * r)
-    deg = px * deg_per_px
+    return degrees(atan2(0.5 * h, d)) / (0.5 * r)
+
+
+def px2deg(px, monitor_info=None):
+    deg = px * get_deg_per_px(monitor_info)
     return deg
 
 